@@ -13,6 +13,13 @@ else:
     app_prefix = "."
 
 parser = argparse.ArgumentParser(description="Samba4 Gestor Web")
+parser.add_argument("--import-users", metavar="FILE",
+                    help="create the users of a CSV or LDIF file and exit")
+parser.add_argument("--format", choices=["csv", "ldif"],
+                    help="format of the import file, guessed from its extension by default")
+parser.add_argument("--base", metavar="DN",
+                    help="container the users of a CSV file are created in")
+parser.add_argument("--username", help="account the import binds as, its password is prompted for")
 args = parser.parse_args()
 
 if not os.path.exists(app_prefix):
@@ -30,6 +37,8 @@ sys.path.append(app_prefix)
 # Import our modules
 from libs.common import ReverseProxied
 from libs.common import iri_for as url_for
+from libs.ldap_func import LDAP_TRACE, ldap_in_group, ldap_release_connection
+from libs.ldap_trace import current_trace, trace_end, trace_footer, trace_start
 from settings import Settings
 
 # Prepare the web server
@@ -128,9 +137,89 @@ def pre_request():
     g.ldap = {'domain': app.config['LDAP_DOMAIN'], 'dn': app.config['LDAP_DN'], 'server': app.config['LDAP_SERVER'],
               'search_dn': app.config['SEARCH_DN']}
 
-    # The various caches
-    g.ldap_cache = {}
     g.app_version = "v2022.09.1"
 
+    if LDAP_TRACE:
+        trace_start()
+
+
+@app.after_request
+def report_ldap_trace(response):
+    """
+        Send admins what the request asked the directory in a Server-Timing
+        header, and in a footer when LDAP_TRACE_FOOTER is set. Others,
+        including requests that failed to authenticate, get nothing.
+    """
+    trace = current_trace()
+    if trace is None:
+        return response
+    trace.finish()
+    try:
+        admin = 'connection' in g.ldap and ldap_in_group(Settings.ADMIN_GROUP)
+    except Exception:
+        # The response itself is fine, only the timings are left out
+        logging.warning("Can't tell whether to send the LDAP trace",
+                        exc_info=True)
+        admin = False
+    if not admin:
+        return response
+
+    response.headers.add('Server-Timing', trace.server_timing())
+    if app.config.get('LDAP_TRACE_FOOTER'):
+        trace_footer(response, trace, app.config.get('LDAP_TRACE_REPEAT', 3))
+    return response
+
+
+@app.teardown_request
+def post_request(exception=None):
+    """
+        Drop the LDAP trace and give the LDAP connection back to the pool
+        once the request is done.
+    """
+    trace_end()
+    ldap_release_connection(discard=exception is not None)
+
+
+def import_users_file(path, file_format, base, username):
+    """
+        Create the users of a CSV or LDIF file, printing the result of every
+        row. Returns the number of rows that failed.
+    """
+    import getpass
+    from libs.ldap_func import ldap_bind
+    from libs.user_import import import_users, read_rows
+
+    password = getpass.getpass("Password for %s: " % username)
+    failed = []
+
+    def report(results):
+        for name, error in results:
+            print("%s: %s" % (name, error or "created"))
+            if error:
+                failed.append(name)
+
+    with app.app_context():
+        ldap_settings = {'domain': app.config['LDAP_DOMAIN'], 'dn': app.config['LDAP_DN'],
+                         'server': app.config['LDAP_SERVER'], 'search_dn': app.config['SEARCH_DN']}
+        if not ldap_bind(ldap_settings, username, password):
+            raise SystemExit("Invalid credentials")
+        try:
+            with open(path, 'rb') as stream:
+                import_users(read_rows(stream, file_format), base, report)
+        finally:
+            ldap_release_connection()
+    return len(failed)
+
+
+if args.import_users:
+    if not args.username:
+        parser.error("--import-users needs --username")
+    import_format = args.format or os.path.splitext(args.import_users)[1][1:].lower()
+    if import_format not in ("csv", "ldif"):
+        parser.error("can't guess the format of %s, use --format" % args.import_users)
+    if import_format == "csv" and not args.base:
+        parser.error("--base is needed to import a CSV file")
+    sys.exit(1 if import_users_file(args.import_users, import_format, args.base, args.username) else 0)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
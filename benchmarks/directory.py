@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+"""
+    A throwaway slapd, or an LDIF fixture for the in-memory backend, seeded
+    with an AD-like directory for the benchmarks.
+"""
+
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import time
+import uuid
+
+import ldif
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Schemas shipped with slapd that the seeded entries use
+BASE_SCHEMAS = ['core', 'cosine', 'inetorgperson', 'nis']
+
+DOMAIN_SID = "S-1-5-21-1004336348-1177238915-682003330"
+
+# Well known RIDs, the ones of seeded objects start at RID_BASE
+RID_DOMAIN_ADMINS = 512
+RID_DOMAIN_USERS = 513
+RID_BASE = 1100
+
+# groupType of a global security group
+GLOBAL_SECURITY_GROUP = -2147483646
+
+ADMIN_USERNAME = "bench-admin"
+ADMIN_PASSWORD = "Bench_Passw0rd"
+
+
+def sid_bytes(sid):
+    """
+        Return the binary form of a SID string, as AD stores objectSid.
+    """
+    parts = [int(part) for part in sid.split("-")[1:]]
+    revision, authority, sub_authorities = parts[0], parts[1], parts[2:]
+    return (struct.pack('BB', revision, len(sub_authorities)) +
+            struct.pack('>Q', authority)[2:] +
+            b"".join(struct.pack('<L', value) for value in sub_authorities))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Layout(object):
+    """
+        Shape of the seeded directory.
+
+        Users are spread over ous organizational units laid out depth levels
+        deep. Groups hold members_per_group users each and are nested in
+        chains of nesting groups, the first group of a chain being a member
+        of the second one and so on.
+    """
+
+    def __init__(self, domain="bench.local", users=1000, groups=100, ous=10,
+                 depth=2, nesting=3, members_per_group=50, seed=0):
+        self.domain = domain
+        self.dn = ",".join("DC=%s" % part for part in domain.split("."))
+        self.users = users
+        self.groups = groups
+        self.ous = max(ous, 1)
+        self.depth = max(depth, 1)
+        self.nesting = max(nesting, 1)
+        self.members_per_group = members_per_group
+        self.seed = seed
+
+        self.root_ou = "OU=Bench,%s" % self.dn
+        self.groups_ou = "OU=Groups,%s" % self.root_ou
+        self.users_container = "CN=Users,%s" % self.dn
+        self.admin_dn = "CN=%s,%s" % (ADMIN_USERNAME, self.users_container)
+        self.admins_dn = "CN=Domain Admins,%s" % self.users_container
+        self.domain_users_dn = "CN=Domain Users,%s" % self.users_container
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in
+                ('domain', 'users', 'groups', 'ous', 'depth', 'nesting',
+                 'members_per_group', 'seed')}
+
+    def ou_dns(self):
+        """
+            Return the DNs of the organizational units, parents first.
+        """
+        levels = [[self.root_ou]]
+        per_level = -(-self.ous // self.depth)
+        count = 0
+        for level in range(self.depth):
+            current = []
+            for index in range(per_level):
+                if count == self.ous:
+                    break
+                parent = levels[-1][index % len(levels[-1])]
+                current.append("OU=Unit%d-%d,%s" % (level, index, parent))
+                count += 1
+            if current:
+                levels.append(current)
+        return [dn for level in levels for dn in level]
+
+    def user_name(self, index):
+        return "user%06d" % index
+
+    def user_dn(self, index, ous):
+        return "CN=%s,%s" % (self.user_name(index), ous[index % len(ous)])
+
+    def group_name(self, index):
+        return "group%05d" % index
+
+    def group_dn(self, index):
+        return "CN=%s,%s" % (self.group_name(index), self.groups_ou)
+
+
+class Seeder(object):
+    """
+        Writes the LDIF of a Layout, identifiers are derived from the seed so
+        two runs with the same layout produce the same directory.
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.random = random.Random(layout.seed)
+        self.rid = RID_BASE
+
+    def write(self, path):
+        layout = self.layout
+        ous = layout.ou_dns()
+        user_ous = ous[1:] or ous
+
+        # Group memberships are worked out first so users get their memberOf
+        members = {}
+        member_of = {}
+        count = min(layout.members_per_group, layout.users)
+        for index in range(layout.groups):
+            users = self.random.sample(range(layout.users), count)
+            members[layout.group_dn(index)] = [
+                layout.user_dn(user, user_ous) for user in users]
+        # Chains of nested groups
+        for index in range(layout.groups - 1):
+            if (index + 1) % layout.nesting:
+                members[layout.group_dn(index + 1)].append(
+                    layout.group_dn(index))
+        for group, group_members in members.items():
+            for member in group_members:
+                member_of.setdefault(member.lower(), []).append(group)
+
+        admin_groups = [layout.admins_dn, layout.domain_users_dn]
+        if layout.groups:
+            admin_groups.append(layout.group_dn(0))
+            members[layout.group_dn(0)].append(layout.admin_dn)
+
+        with open(path, 'w') as output:
+            writer = ldif.LDIFWriter(output, cols=1000)
+            writer.unparse(layout.dn, self._entry(
+                layout.dn, ['top', 'domain', 'adObject'],
+                sid=DOMAIN_SID, dc=layout.domain.split(".")[0]))
+            writer.unparse(layout.users_container, self._entry(
+                layout.users_container, ['top', 'container', 'adObject'],
+                cn="Users"))
+            for dn, rid, name in ((layout.admins_dn, RID_DOMAIN_ADMINS,
+                                   "Domain Admins"),
+                                  (layout.domain_users_dn, RID_DOMAIN_USERS,
+                                   "Domain Users")):
+                writer.unparse(dn, self._group(dn, name, [layout.admin_dn],
+                                               [], rid))
+            writer.unparse(layout.admin_dn, self._user(
+                layout.admin_dn, ADMIN_USERNAME, admin_groups,
+                userPassword=ADMIN_PASSWORD))
+
+            for dn in ous + [layout.groups_ou]:
+                writer.unparse(dn, self._entry(
+                    dn, ['top', 'organizationalUnit', 'adObject'],
+                    ou=dn.split(",")[0][3:]))
+            for index in range(layout.users):
+                dn = layout.user_dn(index, user_ous)
+                writer.unparse(dn, self._user(
+                    dn, layout.user_name(index),
+                    member_of.get(dn.lower(), [])))
+            for index in range(layout.groups):
+                dn = layout.group_dn(index)
+                writer.unparse(dn, self._group(
+                    dn, layout.group_name(index), members.get(dn, []),
+                    member_of.get(dn.lower(), [])))
+
+    def _entry(self, dn, object_classes, sid=None, **attributes):
+        entry = {'objectClass': object_classes,
+                 'distinguishedName': [dn],
+                 'name': [dn.split(",")[0].split("=", 1)[1]],
+                 'objectGUID': [uuid.UUID(int=self.random.getrandbits(128),
+                                          version=4).bytes_le],
+                 'whenCreated': ["20220101000000.0Z"],
+                 'whenChanged': ["20220101000000.0Z"]}
+        if sid:
+            entry['objectSid'] = [sid_bytes(sid)]
+        for key, value in attributes.items():
+            entry[key] = value if isinstance(value, list) else [value]
+        return {key: [value if isinstance(value, bytes) else
+                      str(value).encode('utf-8') for value in values]
+                for key, values in entry.items()}
+
+    def _next_sid(self):
+        self.rid += 1
+        return "%s-%d" % (DOMAIN_SID, self.rid)
+
+    def _user(self, dn, name, member_of, **attributes):
+        number = self.random.randint(0, 9999)
+        values = {'cn': name, 'sAMAccountName': name,
+                  'userPrincipalName': "%s@%s" % (name, self.layout.domain),
+                  'givenName': "Given%04d" % number,
+                  'sn': "Surname%04d" % number,
+                  'displayName': "Given%04d Surname%04d" % (number, number),
+                  'mail': "%s@%s" % (name, self.layout.domain),
+                  'title': "Title %d" % (number % 50),
+                  'userAccountControl': 512,
+                  'primaryGroupID': RID_DOMAIN_USERS,
+                  'accountExpires': "0", 'lockoutTime': "0"}
+        if member_of:
+            values['memberOf'] = member_of
+        values.update(attributes)
+        return self._entry(dn, ['top', 'person', 'organizationalPerson',
+                                'inetOrgPerson', 'user', 'ieee802Device',
+                                'adObject'],
+                           sid=self._next_sid(), **values)
+
+    def _group(self, dn, name, members, member_of, rid=None):
+        values = {'cn': name, 'sAMAccountName': name,
+                  'groupType': GLOBAL_SECURITY_GROUP,
+                  'description': "Benchmark group %s" % name}
+        if members:
+            values['member'] = members
+        if member_of:
+            values['memberOf'] = member_of
+        sid = "%s-%d" % (DOMAIN_SID, rid) if rid else self._next_sid()
+        return self._entry(dn, ['top', 'group', 'adObject'], sid=sid,
+                           **values)
+
+
+class LocalDirectory(object):
+    """
+        A slapd listening on localhost with a seeded mdb database in path.
+        The configuration is generated from the schemas of schema_dir, with
+        the attributes deriving from distinguishedName turned into plain DN
+        attributes: AD doesn't have such subtypes and filters on
+        distinguishedName would otherwise match members and managers too.
+    """
+
+    def __init__(self, path, layout, slapd="slapd", slapadd="slapadd",
+                 schema_dir="/etc/ldap/schema", module_path="/usr/lib/ldap"):
+        self.path = path
+        self.layout = layout
+        self.slapd = slapd
+        self.slapadd = slapadd
+        self.schema_dir = schema_dir
+        self.module_path = module_path
+        self.port = None
+        self.process = None
+        self.config = os.path.join(path, "slapd.conf")
+
+    @property
+    def server(self):
+        return "127.0.0.1:%d" % self.port
+
+    def settings(self):
+        """
+            Return the settings connecting the application to the directory.
+        """
+        return {'LDAP_SERVER': self.server, 'LDAP_URI': "ldap://%s",
+                'LDAP_BIND_FORMAT': "CN=%(username)s,CN=Users,%(dn)s"}
+
+    def seed(self):
+        """
+            Write the configuration and bulk load the layout with slapadd.
+        """
+        os.makedirs(os.path.join(self.path, "data"), exist_ok=True)
+        self._write_config()
+        seed_path = os.path.join(self.path, "seed.ldif")
+        Seeder(self.layout).write(seed_path)
+        subprocess.run([self.slapadd, "-q", "-f", self.config, "-l",
+                        seed_path], check=True)
+
+    def start(self, timeout=30):
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [self.slapd, "-d", "0", "-f", self.config,
+             "-h", "ldap://%s/" % self.server])
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("slapd exited with %d" %
+                                   self.process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("slapd didn't start listening")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(10)
+        self.process = None
+
+    def _write_config(self):
+        includes = []
+        for name in BASE_SCHEMAS:
+            with open(os.path.join(self.schema_dir, "%s.schema" % name)) as f:
+                schema = f.read()
+            schema = re.sub(r"\bSUP\s+distinguishedName\b",
+                            "EQUALITY distinguishedNameMatch "
+                            "SYNTAX 1.3.6.1.4.1.1466.115.121.1.12", schema)
+            path = os.path.join(self.path, "%s.schema" % name)
+            with open(path, 'w') as f:
+                f.write(schema)
+            includes.append(path)
+        includes.append(os.path.join(HERE, "ad-lite.schema"))
+
+        lines = ["include %s" % path for path in includes]
+        lines += [
+            "pidfile %s" % os.path.join(self.path, "slapd.pid"),
+            "argsfile %s" % os.path.join(self.path, "slapd.args"),
+            "modulepath %s" % self.module_path,
+            "moduleload back_mdb",
+            "sizelimit unlimited",
+            "database mdb",
+            "maxsize 8589934592",
+            'suffix "%s"' % self.layout.dn,
+            'rootdn "%s"' % self.layout.admin_dn,
+            "rootpw %s" % ADMIN_PASSWORD,
+            "directory %s" % os.path.join(self.path, "data"),
+            "index objectClass eq",
+            "index sAMAccountName eq,sub",
+            "index distinguishedName eq",
+            "index member,memberOf eq",
+            "index objectSid,objectGUID eq",
+            "index cn,givenName,sn,displayName,mail eq,sub",
+        ]
+        with open(self.config, 'w') as config:
+            config.write("\n".join(lines) + "\n")
+
+
+class MemoryFixture(object):
+    """
+        The seeded layout as an LDIF fixture in path, for the 'memory'
+        backend of libs.ldap_func: no server to run and an exact count of
+        the operations, at the price of not measuring a real one.
+    """
+
+    server = "memory"
+
+    def __init__(self, path, layout):
+        self.path = path
+        self.layout = layout
+        self.fixture = os.path.join(path, "seed.ldif")
+
+    def settings(self):
+        return {'LDAP_SERVER': self.server, 'LDAP_BACKEND': 'memory',
+                'LDAP_MEMORY_FIXTURE': self.fixture}
+
+    def seed(self):
+        Seeder(self.layout).write(self.fixture)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
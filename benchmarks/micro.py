@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+"""
+    Time functions of libs.ldap_func against the in-memory backend.
+
+    The directory is the layout of directory.py loaded from an LDIF fixture,
+    so runs are repeatable and the operations every call sends to the
+    directory are counted exactly. Caches are emptied before every call.
+
+        python3 benchmarks/micro.py --users 20000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from directory import ADMIN_PASSWORD, ADMIN_USERNAME, Layout, MemoryFixture  # noqa: E402
+from run import (RoundTrips, clear_caches, load_app, percentile,  # noqa: E402
+                 write_settings)
+
+
+def cases(ldap_func, layout):
+    """
+        Return (name, call) pairs, call(i) making the i-th call of the case.
+    """
+    ous = layout.ou_dns()
+    user_ous = ous[1:] or ous
+    users = max(layout.users, 1)
+    groups = max(layout.groups, 1)
+
+    def user(i):
+        return layout.user_name(i * 7919 % users)
+
+    def group(i):
+        return layout.group_name(i * 31 % groups)
+
+    return [
+        ('ldap_get_user', lambda i: ldap_func.ldap_get_user(user(i))),
+        ('ldap_get_entries onelevel', lambda i: ldap_func.ldap_get_entries(
+            "objectClass=top", user_ous[i % len(user_ous)], "onelevel")),
+        ('ldap_get_entries_by_dn', lambda i: ldap_func.ldap_get_entries_by_dn(
+            [layout.user_dn((i + n) * 7919 % users, user_ous)
+             for n in range(100)])),
+        ('ldap_get_members', lambda i: ldap_func.ldap_get_members(group(i))),
+        ('ldap_get_membership', lambda i: ldap_func.ldap_get_membership(
+            user(i))),
+        ('ldap_in_group', lambda i: ldap_func.ldap_in_group(
+            layout.group_name(min(2, groups - 1)), user(i))),
+        ('ldap_suggest_users', lambda i: ldap_func.ldap_suggest_users(
+            "user%03d" % (i % 1000))),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--ous", type=int, default=10)
+    parser.add_argument("--members", type=int, default=50,
+                        help="users per group")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="calls per function")
+    parser.add_argument("--output", help="write the results as JSON here")
+    args = parser.parse_args()
+
+    layout = Layout(users=args.users, groups=args.groups, ous=args.ous,
+                    members_per_group=args.members, seed=args.seed)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="adwebmanager-micro-")
+    try:
+        fixture = MemoryFixture(workdir, layout)
+        fixture.seed()
+        write_settings(workdir, fixture, layout)
+        app, ldap_func = load_app(workdir, RoundTrips())
+        directory = ldap_func.memory_directory(fixture.fixture)
+
+        results = {}
+        with app.test_request_context():
+            app.preprocess_request()
+            if not ldap_func.ldap_bind(dict(ldap_func.g.ldap), ADMIN_USERNAME,
+                                       ADMIN_PASSWORD):
+                raise SystemExit("Can't bind to the fixture")
+
+            print("%-28s %10s %10s %10s %10s" % ("function", "p50 ms",
+                                                  "p95 ms", "max ms",
+                                                  "operations"))
+            for name, call in cases(ldap_func, layout):
+                latencies = []
+                operations = 0
+                for i in range(args.iterations):
+                    clear_caches(ldap_func)
+                    before = sum(directory.operations.values())
+                    started = time.perf_counter()
+                    call(i)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    operations += sum(directory.operations.values()) - before
+                results[name] = {
+                    'p50_ms': round(percentile(latencies, 50), 3),
+                    'p95_ms': round(percentile(latencies, 95), 3),
+                    'max_ms': round(max(latencies), 3),
+                    'operations': operations / float(args.iterations)}
+                print("%-28s %10.3f %10.3f %10.3f %10.1f" % (
+                    name, results[name]['p50_ms'], results[name]['p95_ms'],
+                    results[name]['max_ms'], results[name]['operations']))
+            ldap_func.ldap_release_connection()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'layout': layout.as_dict(),
+                       'iterations': args.iterations,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+"""
+    Time the main views against a local slapd seeded by directory.py, or
+    against the same directory held in memory with --backend memory.
+
+    Every request goes through the Flask test client, so everything but the
+    HTTP server is measured: authentication, the LDAP queries, the caches and
+    the templates. Views are timed with the caches of the process emptied
+    before every request (cold) and kept (warm), along with the number of
+    LDAP round trips each request made.
+
+        python3 benchmarks/run.py --users 100000 --output before.json
+        python3 benchmarks/run.py --users 100000 --compare before.json
+        python3 benchmarks/run.py --backend memory --views user_overview
+"""
+
+import argparse
+import base64
+import datetime
+import importlib
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from directory import (ADMIN_PASSWORD, ADMIN_USERNAME, Layout,  # noqa: E402
+                       LocalDirectory, MemoryFixture)
+
+# Connection methods sending a request to the server
+LDAP_REQUEST_METHODS = {'search', 'search_s', 'search_st', 'search_ext',
+                        'search_ext_s', 'add', 'add_s', 'add_ext',
+                        'add_ext_s', 'modify', 'modify_s', 'modify_ext',
+                        'modify_ext_s', 'delete', 'delete_s', 'delete_ext',
+                        'delete_ext_s', 'rename', 'rename_s', 'modrdn_s',
+                        'simple_bind', 'simple_bind_s', 'compare_s',
+                        'whoami_s', 'passwd_s'}
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+class RoundTrips(object):
+    """
+        Counts the requests sent through the connections it wraps.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def wrap(self, connection):
+        return _CountingConnection(connection, self)
+
+
+class _CountingConnection(object):
+
+    def __init__(self, connection, round_trips):
+        self._connection = connection
+        self._round_trips = round_trips
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if name not in LDAP_REQUEST_METHODS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._round_trips.count += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def write_settings(path, directory, layout):
+    settings = {
+        'SECRET_KEY': "benchmark",
+        'LDAP_DOMAIN': layout.domain,
+        'LDAP_DN': layout.dn,
+        'SEARCH_DN': layout.dn,
+        'ADMIN_GROUP': "Domain Admins",
+        'USE_LOGGING': False,
+        'SICCIP_AWARE': False,
+        'WTF_CSRF_ENABLED': False,
+        'TREE_BLACKLIST': [],
+        'SEARCH_ATTRS': [('sAMAccountName', 'Username'), ('givenName', 'Name')],
+        'TREE_ATTRIBUTES': [['mail', "Email"], ['__type', "Type"],
+                            ['active', "Status"]],
+        'AUTHZ_CACHE_PATH': os.path.join(path, "authz.sqlite"),
+        'JOBS_PATH': os.path.join(path, "jobs.sqlite"),
+        'PHOTO_CACHE_PATH': os.path.join(path, "photos"),
+    }
+    settings.update(directory.settings())
+    with open(os.path.join(path, "settings.py"), 'w') as output:
+        output.write("class Settings:\n")
+        for key, value in settings.items():
+            output.write("    %s = %r\n" % (key, value))
+
+
+def load_app(path, round_trips):
+    """
+        Import the application with the settings written in path, counting
+        the round trips of every connection it opens.
+    """
+    sys.path.insert(0, path)
+    sys.path.insert(1, REPO)
+    os.chdir(REPO)
+    # ADwebmanager parses the command line when imported
+    sys.argv = [sys.argv[0]]
+    application = importlib.import_module('ADwebmanager')
+    ldap_func = importlib.import_module('libs.ldap_func')
+
+    open_connection = ldap_func._ldap_open
+    ldap_func._ldap_open = lambda server: round_trips.wrap(
+        open_connection(server))
+    return application.app, ldap_func
+
+
+def clear_caches(ldap_func):
+    ldap_func.ldap_cache.clear()
+    ldap_func.ldap_authz_cache.clear()
+    ldap_func.ldap_user_index.clear()
+    ldap_func.ldap_primary_groups.clear()
+
+
+def scenarios(layout):
+    """
+        Return (name, request) pairs, request(i) giving the method, URL, form
+        and expected status of the i-th request of the scenario.
+    """
+    ous = layout.ou_dns()
+    user_ous = ous[1:] or ous
+    users = max(layout.users, 1)
+    groups = max(layout.groups, 1)
+
+    def tree(dn):
+        return "/tree/%s" % quote(dn, safe="=,")
+
+    def user(i):
+        # Spread over the whole directory, not only the first entries
+        return layout.user_name(i * 7919 % users)
+
+    return [
+        ('tree_onelevel', lambda i: (
+            'GET', tree(user_ous[i % len(user_ous)]), None, 200)),
+        ('tree_search', lambda i: (
+            'POST', tree(layout.root_ou),
+            {'filter_str': "user%03d" % (i % 1000),
+             'filter_select': 'sAMAccountName', 'filter_match': 'startswith',
+             'search': 'Search'}, 200)),
+        ('user_overview', lambda i: ('GET', "/user/%s" % user(i), None, 200)),
+        ('group_overview', lambda i: (
+            'GET', "/group/%s" % layout.group_name(i * 31 % groups), None,
+            200)),
+        ('user_edit_profile', lambda i: (
+            'POST', "/user/%s/+edit-profile" % user(i),
+            {'first_name': "Bench", 'last_name': "User %d" % i,
+             'user_name': user(i), 'mail': "%s@%s" % (user(i), layout.domain),
+             'role': "Title %d" % i}, 302)),
+    ]
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(percent / 100.0 * len(ordered))) - 1, 0)]
+
+
+def summarize(latencies, counts, errors):
+    summary = {'requests': len(latencies), 'errors': errors,
+               'latency_ms': {'min': min(latencies), 'max': max(latencies),
+                              'mean': sum(latencies) / len(latencies)},
+               'round_trips': {'min': min(counts), 'max': max(counts),
+                               'mean': sum(counts) / len(counts)}}
+    for percent in PERCENTILES:
+        summary['latency_ms']['p%d' % percent] = percentile(latencies, percent)
+    for key, value in summary['latency_ms'].items():
+        summary['latency_ms'][key] = round(value, 3)
+    return summary
+
+
+def run_scenario(client, ldap_func, round_trips, request, iterations, cold):
+    headers = {'Authorization': "Basic %s" % base64.b64encode(
+        ("%s:%s" % (ADMIN_USERNAME, ADMIN_PASSWORD)).encode()).decode()}
+    latencies = []
+    counts = []
+    errors = 0
+
+    if not cold:
+        method, url, form, expected = request(0)
+        client.open(url, method=method, data=form, headers=headers)
+
+    for i in range(iterations):
+        method, url, form, expected = request(i)
+        if cold:
+            clear_caches(ldap_func)
+        before = round_trips.count
+        started = time.perf_counter()
+        response = client.open(url, method=method, data=form, headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000)
+        counts.append(round_trips.count - before)
+        if response.status_code != expected:
+            errors += 1
+    return summarize(latencies, counts, errors)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO,
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain",
+                                     "--untracked-files=no"], cwd=REPO,
+                                    capture_output=True, text=True,
+                                    check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare(previous, current):
+    """
+        Print how the median, p95 and round trips moved since previous.
+    """
+    print("%-20s %-5s %22s %22s %16s" % ("view", "mode", "p50 ms", "p95 ms",
+                                          "round trips"))
+    for name, modes in current['results'].items():
+        for mode, result in modes.items():
+            before = previous.get('results', {}).get(name, {}).get(mode)
+            if not before:
+                continue
+            cells = []
+            for old, new in ((before['latency_ms']['p50'],
+                              result['latency_ms']['p50']),
+                             (before['latency_ms']['p95'],
+                              result['latency_ms']['p95'])):
+                change = (new - old) / old * 100 if old else 0
+                cells.append("%8.1f > %8.1f %+4.0f%%" % (old, new, change))
+            cells.append("%6.1f > %6.1f" % (before['round_trips']['mean'],
+                                            result['round_trips']['mean']))
+            print("%-20s %-5s %s" % (name, mode, " ".join(cells)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--ous", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=2,
+                        help="levels of organizational units")
+    parser.add_argument("--nesting", type=int, default=3,
+                        help="length of the chains of nested groups")
+    parser.add_argument("--members", type=int, default=50,
+                        help="users per group")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="requests per view and mode")
+    parser.add_argument("--views", nargs="*",
+                        help="only run these views")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="results of a previous run to compare with")
+    parser.add_argument("--workdir",
+                        help="keep the seeded directory here and reuse it "
+                             "while the layout doesn't change")
+    parser.add_argument("--backend", choices=("slapd", "memory"),
+                        default="slapd",
+                        help="directory the application talks to")
+    parser.add_argument("--slapd", default="slapd")
+    parser.add_argument("--slapadd", default="slapadd")
+    parser.add_argument("--schema-dir", default="/etc/ldap/schema")
+    parser.add_argument("--module-path", default="/usr/lib/ldap")
+    args = parser.parse_args()
+
+    layout = Layout(users=args.users, groups=args.groups, ous=args.ous,
+                    depth=args.depth, nesting=args.nesting,
+                    members_per_group=args.members, seed=args.seed)
+    # The application is loaded from the root of the repository
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else \
+        tempfile.mkdtemp(prefix="adwebmanager-bench-")
+    os.makedirs(workdir, exist_ok=True)
+
+    if args.backend == 'memory':
+        directory = MemoryFixture(workdir, layout)
+    else:
+        directory = LocalDirectory(workdir, layout, slapd=args.slapd,
+                                   slapadd=args.slapadd,
+                                   schema_dir=args.schema_dir,
+                                   module_path=args.module_path)
+    layout_path = os.path.join(workdir, "layout-%s.json" % args.backend)
+    seeded = None
+    if os.path.exists(layout_path):
+        with open(layout_path) as f:
+            seeded = json.load(f)
+    if seeded != layout.as_dict():
+        shutil.rmtree(os.path.join(workdir, "data"), ignore_errors=True)
+        started = time.perf_counter()
+        directory.seed()
+        with open(layout_path, 'w') as f:
+            json.dump(layout.as_dict(), f)
+        print("Seeded %d users in %.1fs" % (layout.users,
+                                            time.perf_counter() - started))
+
+    directory.start()
+    try:
+        write_settings(workdir, directory, layout)
+        round_trips = RoundTrips()
+        app, ldap_func = load_app(workdir, round_trips)
+        client = app.test_client()
+
+        commit, dirty = git_commit()
+        results = {'commit': commit, 'dirty': dirty,
+                   'created': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'backend': args.backend,
+                   'layout': layout.as_dict(),
+                   'iterations': args.iterations,
+                   'results': {}}
+        for name, request in scenarios(layout):
+            if args.views and name not in args.views:
+                continue
+            results['results'][name] = {}
+            for mode in ('cold', 'warm'):
+                result = run_scenario(client, ldap_func, round_trips, request,
+                                      args.iterations, mode == 'cold')
+                results['results'][name][mode] = result
+                print("%-20s %-5s p50 %8.1f ms  p95 %8.1f ms  %5.1f round "
+                      "trips  %d errors" % (
+                          name, mode, result['latency_ms']['p50'],
+                          result['latency_ms']['p95'],
+                          result['round_trips']['mean'], result['errors']))
+    finally:
+        directory.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % output)
+
+    if previous:
+        with open(previous) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,8 @@
 # You can find the license on Debian systems in the file
 # /usr/share/common-licenses/GPL-2
 
-import base64
 import re
+from urllib.parse import urlparse
 from flask import url_for, flash
 from werkzeug.urls import uri_to_iri
 
@@ -47,6 +47,19 @@ def iri_for(endpoint, **values):
     return uri_to_iri(url_for(endpoint, **values))
 
 
+def local_url(url, default):
+    """
+        Return url if it is a path of this site, default otherwise, so a
+        link taken from the request can't point elsewhere or run a script.
+    """
+    if not url or not url.startswith("/") or url.startswith("//") or "\\" in url:
+        return default
+    parsed = urlparse(url)
+    if parsed.scheme or parsed.netloc:
+        return default
+    return url
+
+
 def get_parsed_pager_attribute(pager):
     """
     Receive a codec pager attribute with the form
@@ -136,25 +149,38 @@ def password_is_valid(password):
         }
 
 
-def flash_password_errors(password_validation):
+def password_error_messages(password_validation):
     """
-    Flashes all error messages from the password validation
+    Returns the error messages of the password validation
 
     Args:
         password_validation (dict): dict returned from password_is_valid()
     """
+    messages = []
     for error_key, password_error in password_validation.items():
         if password_error:
             if error_key == 'length_error':
-                flash("Password must have at least 8 characters", "error")
+                messages.append("Password must have at least 8 characters")
             if error_key == 'digit_error':
-                flash("Password must have at least a digit", "error")
+                messages.append("Password must have at least a digit")
             if error_key == 'uppercase_error':
-                flash("Password must have at least an upercase letter", "error")
+                messages.append("Password must have at least an upercase letter")
             if error_key == 'lowercase_error':
-                flash("Password must have at least a lowercase letter", "error")
+                messages.append("Password must have at least a lowercase letter")
             if error_key == 'symbol_error':
-                flash("Password must have at least a symbol", "error")
+                messages.append("Password must have at least a symbol")
+    return messages
+
+
+def flash_password_errors(password_validation):
+    """
+    Flashes all error messages from the password validation
+
+    Args:
+        password_validation (dict): dict returned from password_is_valid()
+    """
+    for message in password_error_messages(password_validation):
+        flash(message, "error")
 
 
 def get_encoded_list(given_list: list):
@@ -175,27 +201,28 @@ def get_decoded_list(given_list: list):
 
 def get_attr(user):
     atts = ['otherMailbox', 'otherHomePhone', 'otherMobile',
-            'otherTelephone', 'macAddress', 'jpegPhoto']
+            'otherTelephone', 'macAddress']
     att_compilation = {}
     for att in atts:
         if att in user.keys():
-            if att == 'jpegPhoto':
-                imgbase64 = base64.b64encode(user.get(att)).decode()
-                att_compilation[att] = ['data:image/jpeg;base64,' + imgbase64]
-            else:
-                att_compilation[att] = user.get(att)
+            att_compilation[att] = user.get(att)
         else:
             att_compilation[att] = ['0']
     return att_compilation
 
 
-def get_valid_macs(macs: list):
+def get_valid_macs(macs: list, report=True):
+    """
+    Splits MAC addresses into valid and invalid ones, the invalid ones are
+    flashed unless report is False
+    """
     valid = []
     invalid = []
     for mac in macs:
         if re.match("[0-9a-f]{2}([-:]?)[0-9a-f]{2}(\\1[0-9a-f]{2}){4}$", mac.lower()):
             valid.append(mac.replace(":", "-").upper())
         else:
-            flash(f"Invalid MAC address: {mac}", "error")
+            if report:
+                flash(f"Invalid MAC address: {mac}", "error")
             invalid.append(mac.replace(":", "-").upper())
     return {'valid': valid, 'invalid': invalid}
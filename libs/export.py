@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import base64
+import csv
+import io
+import json
+import re
+
+import ldif
+from libs.ldap_func import LDAP_AD_MULTIVALUE_ATTRIBUTES, ldap_iter_entries
+
+# Formats entries can be exported in: (label, MIME type, file extension)
+EXPORT_FORMATS = {'csv': ("CSV", "text/csv", "csv"),
+                  'ldif': ("LDIF", "text/plain", "ldif"),
+                  'jsonl': ("JSON Lines", "application/x-ndjson", "jsonl")}
+
+# Kinds of entries that can be exported and the filter selecting them
+EXPORT_OBJECTS = {'all': ("Everything", "(objectClass=*)"),
+                  'users': ("Users", "(&(objectClass=user)(!(objectClass=computer)))"),
+                  'groups': ("Groups", "(objectClass=group)"),
+                  'computers': ("Computers", "(objectClass=computer)"),
+                  'ous': ("Organizational units", "(objectClass=organizationalUnit)")}
+
+# Bytes of output gathered before being handed to the client
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+# Attributes exported by default, all of them accepted by the user import
+EXPORT_DEFAULT_ATTRIBUTES = "sAMAccountName, givenName, sn, displayName, mail"
+
+_ATTRIBUTE_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9-]*$")
+
+_MULTIVALUED = [attribute.lower() for attribute in LDAP_AD_MULTIVALUE_ATTRIBUTES]
+
+
+def parse_attributes(text):
+    """
+        Return the attribute names of a comma or space separated list, raise
+        ValueError on a name that isn't one.
+    """
+    attributes = []
+    for name in re.split(r"[\s,]+", text.strip()):
+        if not name:
+            continue
+        if not _ATTRIBUTE_NAME.match(name):
+            raise ValueError("Invalid attribute name: %s" % name)
+        if name.lower() not in [attribute.lower() for attribute in attributes]:
+            attributes.append(name)
+    return attributes
+
+
+def export_entries(base, objects, attributes, file_format):
+    """
+        Generator over the text of the export of the objects of the subtree
+        of base with the given attributes.
+        The subtree is read one page at a time and written out as it comes,
+        so memory use doesn't depend on its size.
+    """
+    entries = ldap_iter_entries(EXPORT_OBJECTS[objects][1], base, 'subtree',
+                                attrlist=attributes,
+                                expand_primary_group=False, cache=False)
+    writer = {'csv': _write_csv, 'ldif': _write_ldif,
+              'jsonl': _write_jsonl}[file_format]
+
+    output = io.StringIO()
+    for chunk in writer(entries, attributes, output):
+        if output.tell() >= EXPORT_BUFFER_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+
+def _project(entry, attributes):
+    """
+        Return the (attribute, value) of the entry for each of attributes,
+        matching names whatever their case, value being None when missing.
+    """
+    keys = {key.lower(): key for key in entry}
+    return [(attribute, entry.get(keys.get(attribute.lower())))
+            for attribute in attributes]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        # Text the directory sent undecoded, base64 for binary values only
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return base64.b64encode(value).decode('ascii')
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
+def _write_csv(entries, attributes, output):
+    writer = csv.writer(output)
+    writer.writerow(['distinguishedName'] + attributes)
+    yield
+    for entry in entries:
+        row = [entry['distinguishedName']]
+        for attribute, value in _project(entry, attributes):
+            if value is None:
+                row.append('')
+            elif isinstance(value, list):
+                row.append(";".join(_text(item) for item in value))
+            else:
+                row.append(_text(value))
+        writer.writerow(row)
+        yield
+
+
+def _write_jsonl(entries, attributes, output):
+    for entry in entries:
+        row = {'distinguishedName': entry['distinguishedName']}
+        for attribute, value in _project(entry, attributes):
+            if value is None:
+                continue
+            # Multi-valued attributes are lists even with a single value
+            if isinstance(value, list) or attribute.lower() in _MULTIVALUED:
+                values = value if isinstance(value, list) else [value]
+                row[attribute] = [_json(item) for item in values]
+            else:
+                row[attribute] = _json(value)
+        output.write(json.dumps(row))
+        output.write("\n")
+        yield
+
+
+def _json(value):
+    if isinstance(value, bytes):
+        return _text(value)
+    return value
+
+
+def _write_ldif(entries, attributes, output):
+    writer = ldif.LDIFWriter(output)
+    for entry in entries:
+        record = {}
+        for attribute, value in _project(entry, attributes):
+            if value is None:
+                continue
+            values = value if isinstance(value, list) else [value]
+            record[attribute] = [_ldif(item) for item in values]
+        writer.unparse(entry['distinguishedName'], record)
+        yield
+
+
+def _ldif(value):
+    if isinstance(value, bytes):
+        return value
+    return _text(value).encode('utf-8')
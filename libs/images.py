@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+from io import BytesIO
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageOps
+from libs.storage import private_directory
+from settings import Settings
+
+# Uploaded photos are scaled down to fit in a square of this many pixels
+PHOTO_MAX_RESOLUTION = getattr(Settings, 'PHOTO_MAX_RESOLUTION', 512)
+
+# Largest jpegPhoto written to the directory, in bytes
+PHOTO_MAX_BYTES = getattr(Settings, 'PHOTO_MAX_BYTES', 100 * 1024)
+
+# Largest upload accepted, in bytes and in pixels once decoded
+PHOTO_MAX_UPLOAD = getattr(Settings, 'PHOTO_MAX_UPLOAD', 20 * 1024 * 1024)
+PHOTO_MAX_PIXELS = getattr(Settings, 'PHOTO_MAX_PIXELS', 50000000)
+
+# JPEG qualities tried in turn until a photo fits in PHOTO_MAX_BYTES
+PHOTO_QUALITIES = [90, 85, 75, 65, 50]
+
+# Processes normalizing uploads, 0 to do it in the request thread
+PHOTO_WORKERS = getattr(Settings, 'PHOTO_WORKERS', 2)
+
+# Seconds an upload may take to be normalized
+PHOTO_TIMEOUT = 30
+
+# Bounding boxes profile photos are served at, the first one by default
+PHOTO_SIZES = [96, 48, 192, 384]
+
+# Directory keeping the thumbnails, one file per photo and size. Its files
+# are served as they are, so it must only be writable by this user
+PHOTO_CACHE_PATH = getattr(Settings, 'PHOTO_CACHE_PATH', None) or \
+    os.path.join(private_directory("adwebmanager"), "photos")
+
+# Seconds browsers reuse a photo before asking whether it changed, pages
+# link to it with the whenChanged of the user so an edit is seen at once
+PHOTO_MAX_AGE = getattr(Settings, 'PHOTO_MAX_AGE', 86400)
+
+# Seconds an unused thumbnail stays on disk
+PHOTO_CACHE_TTL = getattr(Settings, 'PHOTO_CACHE_TTL', 30 * 86400)
+
+# Seconds between two looks for unused thumbnails
+PHOTO_PRUNE_INTERVAL = getattr(Settings, 'PHOTO_PRUNE_INTERVAL', 3600)
+
+
+class InvalidPhoto(Exception):
+    """
+        The upload can't be used as a profile photo, the message tells the
+        user why.
+    """
+    pass
+
+
+def read_upload(file):
+    """
+        Return the content of an uploaded file, at most PHOTO_MAX_UPLOAD
+        bytes of it.
+    """
+    data = file.read(PHOTO_MAX_UPLOAD + 1)
+    if len(data) > PHOTO_MAX_UPLOAD:
+        raise InvalidPhoto("The picture is too big, the limit is %d MB"
+                           % (PHOTO_MAX_UPLOAD // (1024 * 1024)))
+    return data
+
+
+def normalize_photo(data):
+    """
+        Return the image as a JPEG without metadata fitting in
+        PHOTO_MAX_RESOLUTION pixels per side and PHOTO_MAX_BYTES bytes.
+        Done in a PHOTO_WORKERS process, see process_photo().
+    """
+    Image.MAX_IMAGE_PIXELS = PHOTO_MAX_PIXELS
+    try:
+        image = Image.open(BytesIO(data))
+        if image.format == 'GIF':
+            raise InvalidPhoto('No gifs allowed in user profile picture')
+        if image.width * image.height > PHOTO_MAX_PIXELS:
+            raise InvalidPhoto("The picture has too many pixels")
+
+        # Let the JPEG decoder skip what will be scaled away anyway
+        image.draft('RGB', (PHOTO_MAX_RESOLUTION, PHOTO_MAX_RESOLUTION))
+        # Rotated pixels instead of the EXIF orientation that is dropped
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise InvalidPhoto("The picture can't be read")
+
+    resolution = PHOTO_MAX_RESOLUTION
+    while resolution >= 32:
+        image.thumbnail((resolution, resolution), Image.LANCZOS)
+        for quality in PHOTO_QUALITIES:
+            output = BytesIO()
+            # Nothing but the pixels is saved, no EXIF, ICC or comments
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+            if output.tell() <= PHOTO_MAX_BYTES:
+                return output.getvalue()
+        resolution = resolution * 3 // 4
+
+    raise InvalidPhoto("The picture can't be made smaller than %d bytes"
+                       % PHOTO_MAX_BYTES)
+
+
+_photo_pool = None
+_photo_pool_lock = threading.Lock()
+
+
+def process_photo(data):
+    """
+        Run normalize_photo() on the upload in the process pool so decoding
+        large images doesn't hold the request thread's interpreter.
+    """
+    global _photo_pool
+    if not PHOTO_WORKERS:
+        return normalize_photo(data)
+
+    with _photo_pool_lock:
+        if _photo_pool is None:
+            _photo_pool = ProcessPoolExecutor(max_workers=PHOTO_WORKERS)
+        pool = _photo_pool
+
+    try:
+        return pool.submit(normalize_photo, data).result(timeout=PHOTO_TIMEOUT)
+    except TimeoutError:
+        raise InvalidPhoto("The picture took too long to process")
+    except BrokenProcessPool:
+        # A worker died, e.g. out of memory, start a new pool next time
+        logging.exception("Photo processing pool broken")
+        with _photo_pool_lock:
+            if _photo_pool is pool:
+                _photo_pool = None
+        raise InvalidPhoto("The picture can't be read")
+
+
+def photo_size(size=None):
+    """
+        Return the smallest of PHOTO_SIZES holding size, the default one if
+        size is missing and the largest one if it's bigger than all of them.
+    """
+    if not size:
+        return PHOTO_SIZES[0]
+    for candidate in sorted(PHOTO_SIZES):
+        if candidate >= size:
+            return candidate
+    return max(PHOTO_SIZES)
+
+
+def photo_etag(guid, changed, size):
+    """
+        Return the entity tag of the thumbnail of size of the photo of the
+        entry with objectGUID guid, last changed at changed. It is checked
+        without reading the photo and changes with anything else on the
+        entry too.
+    """
+    key = ("%s/%s" % (guid, changed)).encode('utf-8')
+    return "%s-%d" % (hashlib.sha256(key).hexdigest()[:32], size)
+
+
+def photo_thumbnail(data, size):
+    """
+        Return the photo as a JPEG fitting in a size x size box. Thumbnails
+        are kept in PHOTO_CACHE_PATH, a photo that can't be decoded is
+        returned as is.
+    """
+    path = os.path.join(PHOTO_CACHE_PATH, "%s-%d.jpg" % (
+        hashlib.sha256(data).hexdigest()[:32], size))
+    try:
+        with open(path, 'rb') as cached:
+            thumbnail = cached.read()
+        os.utime(path)
+        return thumbnail
+    except OSError:
+        pass
+
+    try:
+        image = Image.open(BytesIO(data))
+        image.thumbnail((size, size))
+        output = BytesIO()
+        image.convert('RGB').save(output, format='JPEG', quality=85)
+        thumbnail = output.getvalue()
+    except (OSError, ValueError):
+        logging.warning("Can't make a thumbnail of a photo")
+        return data
+
+    try:
+        os.makedirs(PHOTO_CACHE_PATH, mode=0o700, exist_ok=True)
+        _prune()
+        # Written aside and renamed so readers never see half a file
+        fd, temp_path = tempfile.mkstemp(dir=PHOTO_CACHE_PATH)
+        with os.fdopen(fd, 'wb') as temp:
+            temp.write(thumbnail)
+        os.replace(temp_path, path)
+    except OSError:
+        logging.exception("Can't store a thumbnail in %s", PHOTO_CACHE_PATH)
+    return thumbnail
+
+
+_next_prune = 0
+_prune_lock = threading.Lock()
+
+
+def _prune():
+    global _next_prune
+    with _prune_lock:
+        if time.monotonic() < _next_prune:
+            return
+        _next_prune = time.monotonic() + PHOTO_PRUNE_INTERVAL
+
+    deadline = time.time() - PHOTO_CACHE_TTL
+    for entry in os.scandir(PHOTO_CACHE_PATH):
+        try:
+            if entry.stat().st_mtime < deadline:
+                os.unlink(entry.path)
+        except OSError:
+            pass
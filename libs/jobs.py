@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app, g, request
+from libs.ldap_func import ldap_batch, ldap_bind, ldap_release_connection
+from libs.storage import connect_private, private_directory
+from settings import Settings
+
+# Job states, the last three are final
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Items a job works on between two checks of its cancel flag
+JOB_CHUNK_SIZE = 100
+
+
+class Job(object):
+    """
+        Handle given to the function of a running job to report the result
+        of its items and notice when it has been cancelled.
+    """
+
+    def __init__(self, runner, job_id):
+        self.runner = runner
+        self.id = job_id
+
+    def report(self, results):
+        """
+            Record the (name, error) of processed items, error is None for
+            the ones that succeeded.
+        """
+        self.runner._report(self.id, results)
+
+    def cancelled(self):
+        return self.runner._cancelled(self.id)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobRunner(object):
+    """
+        Runs long directory operations outside of the request thread on at
+        most max_workers threads.
+
+        Jobs and the result of every item are stored in a SQLite database so
+        their progress can be polled from any worker process serving the
+        application and a job can be cancelled from any of them. A job only
+        stops between two chunks of items, what has been sent to the server
+        is never rolled back. Jobs record the process running them, those
+        left unfinished by a process that is gone are marked failed when
+        the next one starts.
+    """
+
+    def __init__(self, path, max_workers=2, keep=86400):
+        self.path = path
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local()
+        self._recovered = None
+
+    @property
+    def worker(self):
+        # Looked up every time, workers are often forked after the import
+        return "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = connect_private(self.path)
+            connection.row_factory = sqlite3.Row
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY, owner TEXT, title TEXT, "
+                               "status TEXT, total INTEGER, done INTEGER, "
+                               "failed INTEGER, cancel INTEGER, error TEXT, "
+                               "created REAL, finished REAL, worker TEXT)")
+            columns = [row[1] for row in
+                       connection.execute("PRAGMA table_info(jobs)")]
+            if 'worker' not in columns:
+                connection.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+            connection.execute("CREATE TABLE IF NOT EXISTS items ("
+                               "job TEXT, position INTEGER, name TEXT, "
+                               "error TEXT, PRIMARY KEY (job, position))")
+            connection.commit()
+            self._local.connection = connection
+        if self._recovered != os.getpid():
+            self._recovered = os.getpid()
+            self._recover(connection)
+        return connection
+
+    def _recover(self, connection):
+        """
+            Mark failed the unfinished jobs of the processes of this host
+            that are gone, nothing will ever finish them.
+        """
+        host = socket.gethostname()
+        for job in connection.execute(
+                "SELECT id, worker FROM jobs WHERE status IN (?, ?)",
+                (JOB_QUEUED, JOB_RUNNING)).fetchall():
+            if job['worker']:
+                worker_host, _, pid = job['worker'].rpartition(":")
+                if worker_host != host or _process_alive(int(pid)):
+                    continue
+            logging.warning("Job %s of %s interrupted", job['id'],
+                            job['worker'] or "an unknown process")
+            connection.execute("UPDATE jobs SET status = ?, error = ?, "
+                               "finished = ? WHERE id = ?",
+                               (JOB_FAILED, "Interrupted, the process "
+                                "running it stopped", time.time(), job['id']))
+        connection.commit()
+
+    def submit(self, owner, title, total, function, *args):
+        """
+            Queue function(job, *args) and return the id of the job.
+            total is the number of items the job reports on.
+        """
+        job_id = uuid.uuid4().hex
+        connection = self._connect()
+        self._expire(connection)
+        connection.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, 0, 0, 0, "
+                           "NULL, ?, NULL, ?)",
+                           (job_id, owner, title, JOB_QUEUED, total,
+                            time.time(), self.worker))
+        connection.commit()
+        self._executor.submit(self._run, job_id, function, args)
+        return job_id
+
+    def get(self, job_id, offset=0):
+        """
+            Return the job as a dict with the results of its items from offset
+            on, or None if it doesn't exist. The process running it isn't
+            part of it, it's only of use to the job store.
+        """
+        connection = self._connect()
+        job = connection.execute("SELECT * FROM jobs WHERE id = ?",
+                                 (job_id,)).fetchone()
+        if job is None:
+            return None
+
+        job = dict(job)
+        del job['worker']
+        job['cancel'] = bool(job['cancel'])
+        job['items'] = [dict(item) for item in connection.execute(
+            "SELECT position, name, error FROM items WHERE job = ? AND "
+            "position >= ? ORDER BY position", (job_id, offset))]
+        return job
+
+    def cancel(self, job_id):
+        """
+            Ask the job to stop, it does so before its next chunk of items.
+        """
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET cancel = 1 WHERE id = ?",
+                           (job_id,))
+        connection.commit()
+
+    def _run(self, job_id, function, args):
+        if self._cancelled(job_id):
+            self._finish(job_id, JOB_CANCELLED)
+            return
+
+        self._set_status(job_id, JOB_RUNNING)
+        try:
+            function(Job(self, job_id), *args)
+        except Exception as e:
+            logging.exception("Job %s failed", job_id)
+            self._finish(job_id, JOB_FAILED, str(e))
+            return
+
+        if self._cancelled(job_id):
+            self._finish(job_id, JOB_CANCELLED)
+        else:
+            self._finish(job_id, JOB_DONE)
+
+    def _report(self, job_id, results):
+        connection = self._connect()
+        position = connection.execute(
+            "SELECT done + failed FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()[0]
+        connection.executemany(
+            "INSERT INTO items VALUES (?, ?, ?, ?)",
+            [(job_id, position + index, name, error)
+             for index, (name, error) in enumerate(results)])
+        failed = len([error for name, error in results if error])
+        connection.execute("UPDATE jobs SET done = done + ?, "
+                           "failed = failed + ? WHERE id = ?",
+                           (len(results) - failed, failed, job_id))
+        connection.commit()
+
+    def _cancelled(self, job_id):
+        row = self._connect().execute("SELECT cancel FROM jobs WHERE id = ?",
+                                      (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _set_status(self, job_id, status):
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET status = ? WHERE id = ?",
+                           (status, job_id))
+        connection.commit()
+
+    def _finish(self, job_id, status, error=None):
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET status = ?, error = ?, "
+                           "finished = ? WHERE id = ?",
+                           (status, error, time.time(), job_id))
+        connection.commit()
+
+    def _expire(self, connection):
+        deadline = time.time() - self.keep
+        connection.execute("DELETE FROM items WHERE job IN (SELECT id FROM "
+                           "jobs WHERE finished < ?)", (deadline,))
+        connection.execute("DELETE FROM jobs WHERE finished < ?", (deadline,))
+
+
+# Jobs of this process, stored where every process can see them
+job_runner = JobRunner(
+    getattr(Settings, 'JOBS_PATH', None) or
+    os.path.join(private_directory("adwebmanager"), "jobs.sqlite"),
+    max_workers=getattr(Settings, 'JOBS_WORKERS', 2),
+    keep=getattr(Settings, 'JOBS_KEEP', 86400))
+
+
+def submit_ldap_job(title, total, function, *args):
+    """
+        Run function(job, *args) in a background job bound to the directory
+        as the user of the current request and return the id of the job.
+        The password is only kept in memory for as long as the job runs.
+        function reports on total items.
+    """
+    app = current_app._get_current_object()
+    ldap_settings = {key: g.ldap[key]
+                     for key in ('domain', 'dn', 'server', 'search_dn')}
+    auth = request.authorization
+
+    def run(job, *args):
+        with app.app_context():
+            if not ldap_bind(ldap_settings, auth.username, auth.password):
+                raise Exception("Invalid credentials")
+            try:
+                function(job, *args)
+            finally:
+                ldap_release_connection()
+
+    return job_runner.submit(g.ldap['username'], title, total, run, *args)
+
+
+def ldap_batch_job(job, operations, names):
+    """
+        Job running operations with ldap_batch() one chunk at a time and
+        reporting each of them under its name.
+    """
+    for start in range(0, len(operations), JOB_CHUNK_SIZE):
+        if job.cancelled():
+            return
+        results = ldap_batch(operations[start:start + JOB_CHUNK_SIZE])
+        job.report([(name, error) for name, (dn, error) in
+                    zip(names[start:start + JOB_CHUNK_SIZE], results)])
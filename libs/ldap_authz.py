@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import logging
+import sqlite3
+import threading
+import time
+
+from libs.storage import connect_private
+
+
+class AuthorizationCache(object):
+    """
+        Short-lived cache of group membership decisions, (server, username,
+        group) -> allowed.
+
+        Decisions are kept in a SQLite database so every worker process
+        serving the application shares them. It grants access, so it is
+        only used when it belongs to the user running the application and
+        nobody else can touch it. Any error of the database is logged and
+        treated as a cache miss, the decision is then simply computed again.
+    """
+
+    def __init__(self, path, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = connect_private(self.path)
+            connection.execute("CREATE TABLE IF NOT EXISTS decisions ("
+                               "server TEXT, username TEXT, groupname TEXT, "
+                               "allowed INTEGER, expires REAL, "
+                               "PRIMARY KEY (server, username, groupname))")
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, server, username, groupname):
+        """
+            Return the cached decision or None.
+        """
+        try:
+            row = self._connect().execute(
+                "SELECT allowed FROM decisions WHERE server = ? AND "
+                "username = ? AND groupname = ? AND expires > ?",
+                (server.lower(), username.lower(), groupname.lower(),
+                 time.time())).fetchone()
+        except sqlite3.Error:
+            logging.exception("Authorization cache unavailable")
+            return None
+        if row is None:
+            return None
+        return bool(row[0])
+
+    def set(self, server, username, groupname, allowed):
+        try:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?)",
+                (server.lower(), username.lower(), groupname.lower(),
+                 int(allowed), time.time() + self.ttl))
+            connection.execute("DELETE FROM decisions WHERE expires <= ?",
+                               (time.time(),))
+            connection.commit()
+        except sqlite3.Error:
+            logging.exception("Authorization cache unavailable")
+
+    def invalidate_users(self, usernames):
+        """
+            Forget the decisions about the given users.
+        """
+        try:
+            connection = self._connect()
+            connection.executemany(
+                "DELETE FROM decisions WHERE username = ?",
+                [(username.lower(),) for username in usernames])
+            connection.commit()
+        except sqlite3.Error:
+            logging.exception("Authorization cache unavailable")
+
+    def clear(self):
+        try:
+            connection = self._connect()
+            connection.execute("DELETE FROM decisions")
+            connection.commit()
+        except sqlite3.Error:
+            logging.exception("Authorization cache unavailable")
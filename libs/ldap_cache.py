@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import bisect
+from collections import OrderedDict
+import threading
+import time
+
+# Attributes holding the DN of other entries whose backlinks change with them
+LDAP_LINKED_ATTRIBUTES = ['member', 'memberOf', 'manager', 'directReports']
+
+# Attributes with a hash index for equality lookups
+LDAP_INDEXED_ATTRIBUTES = ['distinguishedName', 'sAMAccountName', 'objectSid',
+                           'objectClass']
+
+# Attributes compared without regard to case
+LDAP_CASE_INSENSITIVE_ATTRIBUTES = ['distinguishedName', 'sAMAccountName']
+
+
+def index_value(key, value):
+    """
+        Return the form of value used to look it up in the index of key.
+    """
+    if key in LDAP_CASE_INSENSITIVE_ATTRIBUTES and isinstance(value, str):
+        return value.lower()
+    return value
+
+
+def fetched_set(attrlist):
+    """
+        Return the set of attributes a read with attrlist fetched, None when
+        all of them were.
+    """
+    if attrlist is None:
+        return None
+    return frozenset(attribute.lower() for attribute in attrlist)
+
+
+def fetched_covers(fetched, attrlist):
+    """
+        Check whether an entry read with the fetched attributes can answer a
+        read of attrlist.
+    """
+    if fetched is None:
+        return True
+    if attrlist is None:
+        return False
+    return all(attribute.lower() in fetched for attribute in attrlist)
+
+
+def copy_entry(attributes):
+    """
+        Return a copy of the entry that can be modified by the caller without
+        touching the cached one.
+    """
+    return {key: list(value) if isinstance(value, list) else value
+            for key, value in attributes.items()}
+
+
+def entry_matches(entry, filter_dict):
+    """
+        Check whether the entry has all the key/values of the filter.
+        Multi-value attributes match when they contain the value.
+    """
+    for key, value in filter_dict.items():
+        if key not in entry:
+            return False
+
+        value = index_value(key, value)
+        if isinstance(entry[key], list):
+            if value not in [index_value(key, item) for item in entry[key]]:
+                return False
+            continue
+
+        if index_value(key, entry[key]) != value:
+            return False
+    return True
+
+
+class LDAPEntryCache(object):
+    """
+        Process-wide cache of decoded directory entries keyed by objectGUID.
+
+        Every entry belongs to a scope, the identity it was read with, and is
+        only ever returned to that same scope so an entry filtered by one
+        user's ACLs is never shown to another user. Invalidation on the other
+        hand is done by distinguishedName across all scopes since a write is
+        visible to everyone.
+
+        Entries expire after ttl seconds and the least recently used ones are
+        evicted once max_size entries are held.
+
+        Equality lookups on LDAP_INDEXED_ATTRIBUTES go through hash indexes
+        kept per scope, so find() doesn't depend on the size of the cache.
+
+        Entries remember the attributes they were read with, a lookup only
+        returns an entry that has been fetched with all the attributes it
+        asks for. Partial reads of the same entry are merged.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._dns = {}
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, scope, guid, attrlist=None):
+        with self._lock:
+            cached = self._get((scope, guid))
+            if cached is None or not fetched_covers(cached[2], attrlist):
+                return None
+            return copy_entry(cached[1])
+
+    def _get(self, key):
+        cached = self._entries.get(key)
+        if not cached:
+            return None
+
+        if cached[0] < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return cached
+
+    def put(self, scope, attributes, attrlist=None):
+        """
+            Cache or refresh an entry read with attrlist, it must have an
+            objectGUID.
+        """
+        key = (scope, attributes['objectGUID'])
+        fetched = fetched_set(attrlist)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            cached = self._get(key)
+            if cached:
+                self._remove(key)
+
+            if cached and fetched is not None:
+                # Keep what an earlier read fetched but this one didn't
+                old_expires, old_attributes, old_fetched = cached
+                merged = {name: value for name, value in old_attributes.items()
+                          if name.lower() not in fetched}
+                merged.update(attributes)
+                attributes = merged
+                if old_fetched is not None:
+                    fetched = old_fetched | fetched
+                else:
+                    fetched = None
+                expires = min(expires, old_expires)
+
+            self._entries[key] = (expires, copy_entry(attributes), fetched)
+            self._index(key, attributes)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def find(self, scope, filter_dict, attrlist=None):
+        """
+            Return a copy of the first entry of the scope that matches all the
+            key/values of the filter and has been fetched with attrlist or
+            None.
+        """
+        with self._lock:
+            candidates = None
+            for attribute, value in filter_dict.items():
+                if attribute not in LDAP_INDEXED_ATTRIBUTES:
+                    continue
+                keys = self._indexes.get(
+                    (scope, attribute, index_value(attribute, value)), ())
+                if candidates is None or len(keys) < len(candidates):
+                    candidates = keys
+                if not candidates:
+                    return None
+
+            if candidates is None:
+                # Nothing indexed in the filter, fall back to a scan
+                candidates = [key for key in self._entries if key[0] == scope]
+
+            for key in list(candidates):
+                cached = self._get(key)
+                if not cached or not fetched_covers(cached[2], attrlist):
+                    continue
+                if entry_matches(cached[1], filter_dict):
+                    return copy_entry(cached[1])
+        return None
+
+    def invalidate(self, dn, linked=None, subtree=False):
+        """
+            Drop every cached copy of the entry, of the entries it links to
+            and of the entries in linked. With subtree all the entries below
+            dn are dropped as well.
+        """
+        with self._lock:
+            dns = set([dn.lower()])
+            if subtree:
+                suffix = ",%s" % dn.lower()
+                dns.update(entry_dn for entry_dn in self._dns
+                           if entry_dn.endswith(suffix))
+
+            # Backlinks held by other entries change with these ones
+            for entry_dn in list(dns):
+                for key in self._dns.get(entry_dn, ()):
+                    attributes = self._entries[key][1]
+                    for attribute in LDAP_LINKED_ATTRIBUTES:
+                        value = attributes.get(attribute)
+                        if isinstance(value, list):
+                            dns.update(entry.lower() for entry in value)
+                        elif value:
+                            dns.add(value.lower())
+
+            if linked:
+                dns.update(value.lower() for value in linked)
+
+            for entry_dn in dns:
+                for key in list(self._dns.get(entry_dn, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dns.clear()
+            self._indexes.clear()
+
+    def _index_keys(self, key, attributes):
+        scope = key[0]
+        for attribute in LDAP_INDEXED_ATTRIBUTES:
+            values = attributes.get(attribute)
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                yield (scope, attribute, index_value(attribute, value))
+
+    def _index(self, key, attributes):
+        dn = attributes.get('distinguishedName')
+        if dn:
+            self._dns.setdefault(dn.lower(), set()).add(key)
+
+        for index_key in self._index_keys(key, attributes):
+            self._indexes.setdefault(index_key, set()).add(key)
+
+    def _unindex(self, key, attributes):
+        dn = attributes.get('distinguishedName')
+        if dn:
+            keys = self._dns.get(dn.lower())
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._dns[dn.lower()]
+
+        for index_key in self._index_keys(key, attributes):
+            keys = self._indexes.get(index_key)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._indexes[index_key]
+
+    def _remove(self, key):
+        cached = self._entries.pop(key, None)
+        if cached:
+            self._unindex(key, cached[1])
+
+
+class PrefixIndex(object):
+    """
+        Sorted list of names per scope answering case insensitive prefix
+        lookups with a binary search.
+
+        The names of a scope are loaded on the first lookup and again once
+        they are older than ttl seconds. Only one thread loads a scope at a
+        time, the others keep using the previous list meanwhile if there is
+        one.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._lists = {}
+
+    def find(self, scope, prefix, limit, load):
+        """
+            Return up to limit names of the scope starting with prefix in
+            alphabetical order. load() is called to get the names of the
+            scope when there are none or they expired.
+        """
+        keys, names = self._get(scope, load)
+        prefix = prefix.lower()
+        start = bisect.bisect_left(keys, prefix)
+        matches = []
+        for index in range(start, min(start + limit, len(keys))):
+            if not keys[index].startswith(prefix):
+                break
+            matches.append(names[index])
+        return matches
+
+    def clear(self):
+        with self._lock:
+            self._lists.clear()
+
+    def _get(self, scope, load):
+        with self._lock:
+            cached = self._lists.get(scope)
+            if cached and cached[0] > time.monotonic():
+                return cached[1], cached[2]
+            loading = self._loading.setdefault(scope, threading.Lock())
+
+        if cached and not loading.acquire(blocking=False):
+            # Someone else is refreshing it, the old list will do
+            return cached[1], cached[2]
+        if not cached:
+            loading.acquire()
+
+        try:
+            with self._lock:
+                fresh = self._lists.get(scope)
+            if fresh and fresh is not cached and \
+                    fresh[0] > time.monotonic():
+                return fresh[1], fresh[2]
+
+            names = sorted(set(load()), key=str.lower)
+            keys = [name.lower() for name in names]
+            with self._lock:
+                self._lists[scope] = (time.monotonic() + self.ttl, keys,
+                                      names)
+            return keys, names
+        finally:
+            loading.release()
@@ -16,13 +16,25 @@
 # You can find the license on Debian systems in the file
 # /usr/share/common-licenses/GPL-2
 
-from collections import UserList
+from collections import UserList, deque
 from flask import request, Response, g, session, abort
 from functools import wraps
+import heapq
+import itertools
 import ldap
 from ldap import modlist
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+import os
 import struct
+import time
 import uuid
+from libs.ldap_authz import AuthorizationCache
+from libs.ldap_cache import LDAP_LINKED_ATTRIBUTES, LDAPEntryCache, PrefixIndex
+from libs.ldap_memory import memory_directory
+from libs.ldap_trace import LDAPTracedConnection
+from libs.storage import private_directory
+from libs.ldap_pool import LDAPConnectionPool
 from settings import Settings
 
 LDAP_SCOPES = {"base": ldap.SCOPE_BASE,
@@ -52,11 +64,106 @@ LDAP_AD_MULTIVALUE_ATTRIBUTES = ['member', 'memberOf', 'objectClass', 'repsTo',
                                  'servicePrincipalName', 'sshPublicKey', 'managedObjects', 'directReports', 'wellKnownObjects',
                                  'proxyAddresses', 'otherMailbox', 'dsCorePropagationData',
                                  'msSFU30SearchAttributes', 'msSFU30ResultAttributes', 'msSFU30KeyAttributes',
-                                 'ipsecNFAReference', 'dNSProperty', 'otherHomePhone', 'otherMobile', 'otherTelephone']
-LDAP_AD_SID_ATTRIBUTES = ['objectSid']
+                                 'ipsecNFAReference', 'dNSProperty', 'otherHomePhone', 'otherMobile', 'otherTelephone',
+                                 'tokenGroups']
+LDAP_AD_SID_ATTRIBUTES = ['objectSid', 'tokenGroups']
 LDAP_AD_UINT_ATTRIBUTES = ['userAccountControl', 'groupType']
 LDAP_AD_Object_ATTRIBUTES = ['jpegPhoto', 'ipsecData', 'dnsRecord']
 
+# Extensible match rule walking nested DN-valued attributes server side
+LDAP_MATCHING_RULE_IN_CHAIN = "1.2.840.113556.1.4.1941"
+
+# Errors a server answers a query it doesn't implement with, any other one
+# may be transient and doesn't tell whether it would have worked
+LDAP_UNSUPPORTED_ERRORS = (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                           ldap.INAPPROPRIATE_MATCHING, ldap.UNDEFINED_TYPE,
+                           ldap.UNWILLING_TO_PERFORM)
+
+# Attributes every projected read asks for, enough to identify and cache the entry
+LDAP_KEY_ATTRIBUTES = ['objectGUID', 'objectClass', 'distinguishedName',
+                       'sAMAccountName', 'objectSid']
+
+# Attributes each kind of view needs, on top of LDAP_KEY_ATTRIBUTES.
+# Anything not listed here (photos, replication metadata, member lists...) is
+# only transferred for views that read the whole entry.
+LDAP_ATTRIBUTE_PROFILES = {
+    'exists': [],
+    'membership': ['memberOf', 'primaryGroupID'],
+    'tree': ['name', 'description', 'displayName', 'userAccountControl',
+             'showInAdvancedViewOnly'] +
+            [item[0] for item in getattr(Settings, 'TREE_ATTRIBUTES', [])
+             if not item[0].startswith('__') and item[0] != 'active'] +
+            [item[0] for item in getattr(Settings, 'SEARCH_ATTRS', [])],
+    'autocomplete': ['displayName', 'givenName', 'sn'],
+    'user_overview': ['givenName', 'sn', 'displayName', 'name', 'mail', 'title',
+                      'telephoneNumber', 'userAccountControl',
+                      'memberOf', 'primaryGroupID', 'whenChanged'],
+    'group_overview': ['description', 'mail', 'groupType', 'memberOf'],
+}
+
+# Entries asked for at once by paged searches
+LDAP_PAGE_SIZE = getattr(Settings, 'LDAP_PAGE_SIZE', 500)
+
+# Values joined in a single OR filter by batched lookups
+LDAP_FILTER_CHUNK_SIZE = 100
+
+# Characters of a group name ldap_search_groups needs, shorter prefixes
+# would match most of the groups of the domain
+LDAP_GROUP_SEARCH_MIN_PREFIX = getattr(Settings, 'LDAP_GROUP_SEARCH_MIN_PREFIX', 2)
+
+# Values added to or removed from a multi-valued attribute per modify request
+LDAP_MODIFY_CHUNK_SIZE = getattr(Settings, 'LDAP_MODIFY_CHUNK_SIZE', 500)
+
+# Asynchronous writes a batch keeps outstanding on the connection at once
+LDAP_BATCH_WINDOW = getattr(Settings, 'LDAP_BATCH_WINDOW', 20)
+
+# Seconds a primaryGroupID stays mapped to the DN of its group
+LDAP_PRIMARY_GROUP_TTL = getattr(Settings, 'LDAP_PRIMARY_GROUP_TTL', 3600)
+
+# URI of a server, %s being one of LDAP_SERVER
+LDAP_URI = getattr(Settings, 'LDAP_URI', "ldaps://%s:636")
+
+# Name users bind with, from their username, the domain and its base DN
+LDAP_BIND_FORMAT = getattr(Settings, 'LDAP_BIND_FORMAT', "%(username)s@%(domain)s")
+
+# Backend connections are opened with, one of LDAP_BACKENDS
+LDAP_BACKEND = getattr(Settings, 'LDAP_BACKEND', 'ldap')
+
+# LDIF file the 'memory' backend loads its directory from
+LDAP_MEMORY_FIXTURE = getattr(Settings, 'LDAP_MEMORY_FIXTURE', None)
+
+# Record the operations of every request and report them to admins in a
+# Server-Timing header, see libs.ldap_trace
+LDAP_TRACE = getattr(Settings, 'LDAP_TRACE', False)
+
+# Authenticated connections shared between requests
+ldap_pool = LDAPConnectionPool(
+    max_size=getattr(Settings, 'LDAP_POOL_SIZE', 20),
+    max_per_user=getattr(Settings, 'LDAP_POOL_SIZE_PER_USER', 2),
+    idle_timeout=getattr(Settings, 'LDAP_POOL_IDLE_TIMEOUT', 300),
+    check_interval=getattr(Settings, 'LDAP_POOL_CHECK_INTERVAL', 30),
+    rebind_interval=getattr(Settings, 'LDAP_POOL_REBIND_INTERVAL', 300))
+
+# Decoded entries shared between requests
+ldap_cache = LDAPEntryCache(
+    max_size=getattr(Settings, 'LDAP_CACHE_SIZE', 10000),
+    ttl=getattr(Settings, 'LDAP_CACHE_TTL', 60))
+
+# sAMAccountNames of the users for suggestions, see ldap_suggest_users
+ldap_user_index = PrefixIndex(ttl=getattr(Settings, 'USER_INDEX_TTL', 300))
+
+# (domain SID, primaryGroupID) -> (expiry, group DN), filled once per process
+ldap_primary_groups = {}
+
+# server -> which nested membership queries it answered, see ldap_in_group
+ldap_in_group_support = {}
+
+# ldap_in_group decisions shared by every worker
+ldap_authz_cache = AuthorizationCache(
+    getattr(Settings, 'AUTHZ_CACHE_PATH', None) or
+    os.path.join(private_directory("adwebmanager"), "authz.sqlite"),
+    ttl=getattr(Settings, 'AUTHZ_CACHE_TTL', 60))
+
 
 def ldap_change_password(old_password, new_password, username=None):
     """
@@ -68,7 +175,7 @@ def ldap_change_password(old_password, new_password, username=None):
 
     connection = g.ldap['connection']
 
-    user = ldap_get_user(username)
+    user = ldap_get_user(username, attrlist='exists')
     if not user:
         return False
 
@@ -84,6 +191,7 @@ def ldap_change_password(old_password, new_password, username=None):
         attributes = [(ldap.MOD_REPLACE, 'unicodePwd', new_password_u16),
                       (ldap.MOD_REPLACE, 'unicodePwd', new_password_u16)]
     connection.modify_s(user['distinguishedName'], attributes)
+    ldap_cache.invalidate(user['distinguishedName'])
 
 
 def ldap_create_entry(dn, attributes):
@@ -98,6 +206,7 @@ def ldap_create_entry(dn, attributes):
     #dn = dn.encode('utf-8')
 
     connection.add_s(dn, modlist.addModlist(attributes))
+    ldap_cache.invalidate(dn, _ldap_linked_values(attributes))
 
     return True
 
@@ -112,11 +221,71 @@ def ldap_delete_entry(dn):
 
     connection = g.ldap['connection']
     connection.delete_s(dn)
+    _ldap_invalidate_subtree(dn)
 
     return True
 
 
-def ldap_get_user(username=None, key="sAMAccountName"):
+def ldap_batch(operations, window=None):
+    """
+        Run a batch of writes without waiting for each one, up to window of
+        them are kept outstanding on the connection.
+        operations is an iterable of ('add', dn, attributes), ('delete', dn),
+        ('rename', dn, new_rdn, new_parent) and ('password', dn, password)
+        tuples, attributes being what ldap_create_entry() takes.
+        Return a list of (dn, error) in the order of operations, where error
+        is None if the operation succeeded and the server's message
+        otherwise.
+    """
+    connection = g.ldap['connection']
+    window = window or LDAP_BATCH_WINDOW
+    results = []
+    pending = deque()
+
+    def wait_oldest():
+        msgid, index, operation = pending.popleft()
+        dn = results[index][0]
+        try:
+            connection.result(msgid)
+        except ldap.LDAPError as e:
+            results[index] = (dn, _ldap_error_message(e))
+            return
+        if operation[0] == 'add':
+            ldap_cache.invalidate(dn, _ldap_linked_values(operation[2]))
+        else:
+            _ldap_invalidate_subtree(dn)
+
+    for operation in operations:
+        dn = operation[1]
+        results.append((dn, None))
+        try:
+            if operation[0] == 'add':
+                msgid = connection.add(dn, modlist.addModlist(operation[2]))
+            elif operation[0] == 'delete':
+                msgid = connection.delete(dn)
+            elif operation[0] == 'rename':
+                msgid = connection.rename(dn, operation[2], operation[3])
+            elif operation[0] == 'password':
+                password_u16 = ('"%s"' % operation[2]).encode("utf-16-le")
+                msgid = connection.modify(
+                    dn, [(ldap.MOD_REPLACE, 'unicodePwd', password_u16)])
+            else:
+                raise ValueError("Unknown batch operation: %s" % operation[0])
+        except ldap.LDAPError as e:
+            results[-1] = (dn, _ldap_error_message(e))
+            continue
+
+        pending.append((msgid, len(results) - 1, operation))
+        if len(pending) >= window:
+            wait_oldest()
+
+    while pending:
+        wait_oldest()
+
+    return results
+
+
+def ldap_get_user(username=None, key="sAMAccountName", attrlist=None):
     """
         Return the attributes for the user or None if it doesn't exist.
     """
@@ -125,51 +294,45 @@ def ldap_get_user(username=None, key="sAMAccountName"):
         username = g.ldap['username']
 
     return ldap_get_entry_simple({'objectClass': 'user',
-                                  key: username})
+                                  key: username}, attrlist)
 
 
-def ldap_get_group(groupname, key="sAMAccountName"):
+def ldap_get_group(groupname, key="sAMAccountName", attrlist=None):
     """
         Return the attributes for the group or None if it doesn't exist.
     """
 
     return ldap_get_entry_simple({'objectClass': 'group',
-                                  key: groupname})
+                                  key: groupname}, attrlist)
 
 
-def ldap_get_ou(ou_name, key="distinguishedName"):
+def ldap_get_ou(ou_name, key="distinguishedName", attrlist=None):
     """
         Return the attributes for the ou or None if it doesn't exist.
     """
 
     return ldap_get_entry_simple({'objectClass': 'organizationalUnit',
-                                  key: ou_name})
+                                  key: ou_name}, attrlist)
 
 
-def ldap_get_entry_simple(filter_dict):
+def ldap_get_entry_simple(filter_dict, attrlist=None):
     """
         Return the attributes for the entry matching the filter.
         The filter is a key/value dictionary.
         The entry that matches all the values will be returned.
+        attrlist is a list of attributes or the name of one of the
+        LDAP_ATTRIBUTE_PROFILES, by default all attributes are read.
     """
 
     if not filter_dict or not isinstance(filter_dict, dict):
         return False
 
-    for entry in g.ldap_cache.values():
-        for key, value in filter_dict.items():
-            if key not in entry:
-                break
-
-            if isinstance(entry[key], list):
-                if value not in entry[key]:
-                    break
-                continue
-
-            if entry[key] != value:
-                break
-        else:
+    attrlist = _ldap_attrlist(attrlist)
+    if 'connection' in g.ldap:
+        entry = ldap_cache.find(_ldap_cache_scope(), filter_dict, attrlist)
+        if entry:
             # We've got a match!
+            _ldap_expand_primary_groups([entry])
             return entry
 
     ldap_filter = ""
@@ -180,15 +343,15 @@ def ldap_get_entry_simple(filter_dict):
         for key, value in filter_dict.items():
             fields += "(%s=%s)" % (key, value)
         ldap_filter = "(&%s)" % fields
-    return ldap_get_entry(ldap_filter)
+    return ldap_get_entry(ldap_filter, attrlist)
 
 
-def ldap_get_entry(ldap_filter):
+def ldap_get_entry(ldap_filter, attrlist=None):
     """
         Return the attributes for a single entry or None if it doesn't exist or
         if the filter matches multiple entries and False on errors.
     """
-    entries = ldap_get_entries(ldap_filter)
+    entries = ldap_get_entries(ldap_filter, attrlist=attrlist)
     # Only allow a single entry
     if isinstance(entries, list) and len(entries) == 1:
         return entries[0]
@@ -196,25 +359,33 @@ def ldap_get_entry(ldap_filter):
     return None
 
 
-def ldap_get_entries(ldap_filter, base=None, scope=None, attrlist=None, ignore_erros=False):
+def ldap_get_entries(ldap_filter, base=None, scope=None, attrlist=None, ignore_erros=False,
+                     page_size=None, expand_primary_group=True, cache=True):
     """
         Return the attributes for an entry or None if it doesn't exist and
         False on errors.
+        With page_size the search is done in pages of that size, which isn't
+        limited by the server's MaxPageSize.
+        attrlist is a list of attributes or the name of one of the
+        LDAP_ATTRIBUTE_PROFILES, by default all attributes are read.
+        Entries with a primaryGroupID get the DN of that group as
+        __primaryGroup unless expand_primary_group is False.
+        Reads of large attributes pass cache=False so they aren't kept in
+        the entry cache.
     """
     if 'connection' not in g.ldap:
         return False
 
-    if not base:
-        base = g.ldap['dn']
+    attrlist = _ldap_attrlist(attrlist)
 
-    if scope:
-        if scope in LDAP_SCOPES:
-            scope = LDAP_SCOPES[scope]
-        else:
-            return False
-    else:
-        scope = ldap.SCOPE_SUBTREE
+    if scope and scope not in LDAP_SCOPES:
+        return False
+
+    if page_size:
+        return list(ldap_iter_entries(ldap_filter, base, scope, attrlist,
+                                      page_size, expand_primary_group, cache))
 
+    base, scope = _ldap_search_base_scope(base, scope)
     connection = g.ldap['connection']
 
     # Grab the LDAP entry
@@ -223,31 +394,92 @@ def ldap_get_entries(ldap_filter, base=None, scope=None, attrlist=None, ignore_e
     if not result or not result[0] or not result[0][0]:
         return []
 
-    entries = []
-    for entry in result:
-        # Simplify the list by only keeping the attributes we known can contain
-        # multiple values as list and decode everything to unicode.
+    return _ldap_process_entries(result, attrlist, expand_primary_group,
+                                 cache)
 
-        if entry[0] == None:
-            continue
-        attributes = {}
-        for key, value in entry[1].items():
-            attributes[key] = _ldap_decode_attribute(key, value)
 
-        # Expand some attributes
-        if 'primaryGroupID' in attributes:
-            # Retrieve primary group for user
-            group = ldap_get_group('%s-%s' %
-                                   (g.ldap['domain_sid'], attributes['primaryGroupID']), 'objectSid')
-            attributes['__primaryGroup'] = group['distinguishedName']
+def ldap_iter_entries(ldap_filter, base=None, scope=None, attrlist=None, page_size=None,
+                      expand_primary_group=True, cache=True):
+    """
+        Generator over the attributes of the entries matching the filter.
+        Entries are requested page by page with the simple paged results
+        control (RFC 2696) and decoded as each page arrives, so the whole
+        result is never held in memory.
+        Reads of a whole subtree pass cache=False so they don't evict the
+        entries the views are working with.
+    """
+    if 'connection' not in g.ldap:
+        return
+
+    if scope and scope not in LDAP_SCOPES:
+        return
+
+    attrlist = _ldap_attrlist(attrlist)
+
+    base, scope = _ldap_search_base_scope(base, scope)
+    connection = g.ldap['connection']
+
+    if not page_size:
+        page_size = LDAP_PAGE_SIZE
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+
+    while True:
+        msgid = connection.search_ext(base, scope, ldap_filter, attrlist,
+                                      serverctrls=[control])
+        rtype, result, rmsgid, serverctrls = connection.result3(msgid)
 
-        # Cache or refresh the entry
-        if attrlist:
-            g.ldap_cache[attributes[attrlist[0]]] = attributes
+        for entry in _ldap_process_entries(result, attrlist,
+                                           expand_primary_group, cache):
+            yield entry
+
+        cookies = [ctrl.cookie for ctrl in serverctrls
+                   if ctrl.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            break
+        control.cookie = cookies[0]
+
+
+def ldap_get_entries_by_dn(dns, attrlist=None):
+    """
+        Return the entries of a list of distinguishedNames, in the same order,
+        leaving out the ones that don't exist.
+    """
+    return ldap_get_entries_by_key('distinguishedName', dns, attrlist)
+
+
+def ldap_get_entries_by_key(key, values, attrlist=None):
+    """
+        Return the entries whose key, a unique attribute such as
+        distinguishedName or sAMAccountName, is one of values, in the same
+        order, leaving out the ones that don't exist.
+        Cached entries are used as they are, the others are read with one OR
+        filter per LDAP_FILTER_CHUNK_SIZE values.
+    """
+    if 'connection' not in g.ldap:
+        return False
+
+    attrlist = _ldap_attrlist(attrlist)
+    scope = _ldap_cache_scope()
+
+    found = {}
+    missing = []
+    for value in values:
+        entry = ldap_cache.find(scope, {key: value}, attrlist)
+        if entry:
+            found[value.lower()] = entry
         else:
-            g.ldap_cache[attributes['objectGUID']] = attributes
-        entries.append(attributes)
-    return entries
+            missing.append(value)
+    if found:
+        _ldap_expand_primary_groups(list(found.values()))
+
+    for start in range(0, len(missing), LDAP_FILTER_CHUNK_SIZE):
+        ldap_filter = "(|%s)" % "".join(
+            "(%s=%s)" % (key, escape_filter_chars(value))
+            for value in missing[start:start + LDAP_FILTER_CHUNK_SIZE])
+        for entry in ldap_iter_entries(ldap_filter, attrlist=attrlist):
+            found[entry[key].lower()] = entry
+
+    return [found[value.lower()] for value in values if value.lower() in found]
 
 
 def ldap_obj_has_children(base):
@@ -261,6 +493,9 @@ def ldap_obj_has_children(base):
 
 
 def ldap_get_all_users(filter=None, attrset=None):
+    """
+        Generator over all the users below the search DN.
+    """
     base = g.ldap['search_dn']
     scope = 'subtree'
     attrlist = attrset  # set to None if need to get all
@@ -268,37 +503,107 @@ def ldap_get_all_users(filter=None, attrset=None):
         filter = '(objectClass=organizationalPerson)'
     else:
         filter = f'(&(objectClass=organizationalPerson)({filter}))'
-    user_list = ldap_get_entries(filter, base, scope, attrlist)
+    user_list = ldap_iter_entries(filter, base, scope, attrlist)
     return user_list
 
 
+def ldap_suggest_users(prefix, limit=10):
+    """
+        Return up to limit sAMAccountNames of users starting with prefix,
+        case insensitively. They come from an index of all the users rebuilt
+        every USER_INDEX_TTL seconds, so new accounts may take that long to
+        be suggested.
+    """
+    def load():
+        users = ldap_iter_entries('(objectClass=organizationalPerson)',
+                                  g.ldap['search_dn'], 'subtree', 'exists',
+                                  expand_primary_group=False, cache=False)
+        return [entry['sAMAccountName'] for entry in users
+                if 'sAMAccountName' in entry]
+
+    return ldap_user_index.find(_ldap_cache_scope(), prefix, limit, load)
+
+
+def ldap_search_groups(prefix, exclude=None, after=None, limit=20):
+    """
+        Return the (sAMAccountName, distinguishedName) of up to limit groups
+        whose name starts with prefix and sorts after after, in alphabetical
+        order, and the name to pass as after for the next page or None.
+        The server leaves out the groups the entry exclude (as returned by
+        ldap_get_entry_simple with the 'membership' profile) is a direct
+        member of and its primary group.
+        Prefixes shorter than LDAP_GROUP_SEARCH_MIN_PREFIX match nothing.
+    """
+    if len(prefix) < LDAP_GROUP_SEARCH_MIN_PREFIX:
+        return [], None
+
+    ldap_filter = "(&(objectClass=group)(sAMAccountName=%s*)" % \
+        escape_filter_chars(prefix)
+    if after:
+        ldap_filter += "(sAMAccountName>=%s)" % escape_filter_chars(after)
+    if exclude:
+        ldap_filter += "(!(member=%s))" % \
+            escape_filter_chars(exclude['distinguishedName'])
+        if '__primaryGroup' in exclude:
+            ldap_filter += "(!(distinguishedName=%s))" % \
+                escape_filter_chars(exclude['__primaryGroup'])
+    ldap_filter += ")"
+
+    # Only the first page and the one telling there is more are kept
+    groups = heapq.nsmallest(
+        limit + 1,
+        ((entry['sAMAccountName'], entry['distinguishedName'])
+         for entry in ldap_iter_entries(ldap_filter, scope="subtree",
+                                        attrlist='exists',
+                                        expand_primary_group=False)
+         if not after or entry['sAMAccountName'].lower() > after.lower()),
+        key=lambda group: group[0].lower())
+
+    if len(groups) > limit:
+        return groups[:limit], groups[limit - 1][0]
+    return groups, None
+
+
 def ldap_get_members(name=None):
     """
-        Return the list of all groups the entry is a memberOf.
+        Return an iterator over the DNs of all the members of the group or
+        None if it doesn't exist.
+        Members are streamed range by range, a group is never read whole.
     """
 
-    entry = ldap_get_group(name)
+    entry = ldap_get_group(name, attrlist='exists')
     if not entry:
         return None
 
-    members = []
     # Start with all the simple members
-    if 'member' in entry:
-        members += entry['member']
+    members = ldap_iter_attribute(entry['distinguishedName'], 'member')
 
     # Add all the members that have the group as primaryGroup
-    members += [member['distinguishedName']
-                for member in ldap_get_entries(
-                    "primaryGroupID=%s" % entry['objectSid'].split("-")[-1])]
+    primary_members = (member['distinguishedName']
+                       for member in ldap_iter_entries(
+                           "primaryGroupID=%s" % entry['objectSid'].split("-")[-1],
+                           attrlist='exists', expand_primary_group=False))
+
+    return itertools.chain(members, primary_members)
 
-    return members
+
+def ldap_iter_attribute(dn, attribute):
+    """
+        Generator over the decoded values of a multi-valued attribute.
+        Active Directory only returns MaxValRange values (1500 by default) of
+        an attribute per read and flags it as attribute;range=low-high, the
+        following ranges are read as the values are consumed.
+    """
+    for values in _ldap_iter_ranges(dn, attribute):
+        for value in values:
+            yield _ldap_decode_attribute(attribute, value)
 
 
 def ldap_get_membership(name=None):
     """
         Return the list of all groups the entry is a memberOf.
     """
-    entry = ldap_get_entry_simple({'sAMAccountName': name})
+    entry = ldap_get_entry_simple({'sAMAccountName': name}, 'membership')
     if not entry:
         return None
 
@@ -317,36 +622,69 @@ def ldap_get_membership(name=None):
 def ldap_in_group(groupname, username=None):
     """
         Checks whether a user is a member of a given group name.
+        The directory answers it in a single query by reading the user's
+        tokenGroups or with the LDAP_MATCHING_RULE_IN_CHAIN matching rule,
+        servers that support neither get the groups walked one by one.
+        Decisions are cached for AUTHZ_CACHE_TTL seconds.
     """
 
     if not username:
         username = g.ldap['username']
 
-    group = ldap_get_group(groupname)
-    groups = ldap_get_membership(username)
+    allowed = ldap_authz_cache.get(g.ldap['server'], username, groupname)
+    if allowed is None:
+        allowed = _ldap_in_group(groupname, username)
+        if allowed is not None:
+            ldap_authz_cache.set(g.ldap['server'], username, groupname, allowed)
+    return allowed
+
 
+def ldap_forget_authorizations(entries=None):
+    """
+        Drop the cached ldap_in_group decisions about the given entries after
+        their membership changed. Groups can be nested anywhere so changing
+        one, or passing None, drops every decision.
+    """
+    if entries is None or [entry for entry in entries
+                           if 'group' in entry.get('objectClass', [])]:
+        ldap_authz_cache.clear()
+    else:
+        ldap_authz_cache.invalidate_users([entry['sAMAccountName']
+                                           for entry in entries
+                                           if 'sAMAccountName' in entry])
+
+
+def _ldap_in_group(groupname, username):
+    """
+        ldap_in_group without the decision cache.
+    """
+    group = ldap_get_group(groupname, attrlist=['groupType'])
     if group is None:
         return False
+
+    user = ldap_get_entry_simple({'sAMAccountName': username}, 'membership')
+    if not user:
+        return False
+
     # Start by looking at direct membership
+    groups = ldap_get_membership(username)
     if group['distinguishedName'] in groups:
         return True
 
-    # Recurse through all the groups
-    to_check = set(groups)
-    checked = set()
+    support = ldap_in_group_support.setdefault(g.ldap['server'].lower(), {})
 
-    while to_check != checked:
-        for entry in to_check - checked:
-            attr = ldap_get_group(entry, "distinguishedName")
-            if attr is None:
-                return None
-            if 'memberOf' in attr:
-                if group['distinguishedName'] in attr['memberOf']:
-                    return True
-                to_check.update(attr['memberOf'])
-            checked.add(entry)
+    # tokenGroups only holds security groups
+    if support.get('tokenGroups', True) and group.get('groupType', 0) & 2147483648:
+        result = _ldap_in_group_token_groups(user, group, support)
+        if result is not None:
+            return result
 
-    return group['distinguishedName'] in checked
+    if support.get('in_chain', True):
+        result = _ldap_in_group_in_chain(user, group, support)
+        if result is not None:
+            return result
+
+    return _ldap_in_group_walk(group, groups)
 
 
 def ldap_update_attribute(dn, attribute, value=None, new_parent=None, objectClass=None):
@@ -358,7 +696,7 @@ def ldap_update_attribute(dn, attribute, value=None, new_parent=None, objectClas
         return False
 
     connection = g.ldap['connection']
-    current_entry = ldap_get_entry_simple({'distinguishedName': dn})
+    current_entry = ldap_get_entry_simple({'distinguishedName': dn}, [attribute])
     #old_value = current_entry[attribute]
     mod_attrs = []
 
@@ -367,6 +705,7 @@ def ldap_update_attribute(dn, attribute, value=None, new_parent=None, objectClas
 
     if (attribute == 'distinguishedName'):
         connection.rename_s(dn, value, new_parent)
+        _ldap_invalidate_subtree(dn)
 
     # if objectClass and objectClass not in current_entry['objectClass']:
     #     # It's add a new class to the object,  its not an attribute update
@@ -408,6 +747,11 @@ def ldap_update_attribute(dn, attribute, value=None, new_parent=None, objectClas
 
     if len(mod_attrs) != 0:
         connection.modify_s(dn, mod_attrs)
+        if attribute in LDAP_LINKED_ATTRIBUTES:
+            linked = value if isinstance(value, list) else [value]
+            ldap_cache.invalidate(dn, [entry for entry in linked if entry])
+        else:
+            ldap_cache.invalidate(dn)
 
 
 def ldap_update_attribute_old(dn, attribute, value, objectclass=None):
@@ -459,30 +803,99 @@ def ldap_update_attribute_old(dn, attribute, value, objectclass=None):
     return True
 
 
-def ldap_add_users_to_group(dn, attribute, value):
+def ldap_modlist(entry, changes):
+    """
+        Return the modlist that brings entry up to date with changes, a dict
+        of attribute -> new value where an empty value removes the attribute.
+        Attributes whose values don't change are left out, so entry must
+        have been read with every attribute in changes.
+    """
+    mod_attrs = []
+    for attribute, value in changes.items():
+        new_values = _ldap_encode_attribute(attribute, value)
+        old_values = _ldap_encode_attribute(attribute, entry.get(attribute))
+        if sorted(new_values) == sorted(old_values):
+            continue
 
-    if 'connection' not in g.ldap:
-        return False
+        if new_values:
+            mod_attrs.append((ldap.MOD_REPLACE, attribute, new_values))
+        else:
+            mod_attrs.append((ldap.MOD_DELETE, attribute, None))
+    return mod_attrs
 
-    connection = g.ldap['connection']
-    mod_attrs = []
-    new_values = []
 
-    for i in value:
-        a = i.encode('utf-8')
-        new_values.append(a)
+def ldap_apply_changes(entry, changes, new_rdn=None, new_parent=None):
+    """
+        Write changes (see ldap_modlist) to the entry in a single modify
+        request, then rename it to new_rdn and/or move it below new_parent.
+        Return the DN of the entry once the changes are applied.
+    """
+    connection = g.ldap['connection']
+    dn = entry['distinguishedName']
 
-    mod_attrs.append((ldap.MOD_REPLACE, attribute, new_values))
-    if len(mod_attrs) != 0:
+    mod_attrs = ldap_modlist(entry, changes)
+    if mod_attrs:
         connection.modify_s(dn, mod_attrs)
 
+        # Backlinks of the old and new values change with them
+        linked = []
+        for attribute, _, _ in mod_attrs:
+            if attribute in LDAP_LINKED_ATTRIBUTES:
+                for value in (entry.get(attribute), changes[attribute]):
+                    if isinstance(value, list):
+                        linked += value
+                    elif value:
+                        linked.append(value)
+        ldap_cache.invalidate(dn, linked)
+
+    rdn, parent = dn.split(",", 1)
+    if (new_rdn and new_rdn != rdn) or \
+            (new_parent and new_parent.lower() != parent.lower()):
+        connection.rename_s(dn, new_rdn or rdn, new_parent)
+        _ldap_invalidate_subtree(dn)
+        dn = "%s,%s" % (new_rdn or rdn, new_parent or parent)
+
+    return dn
+
+
+def ldap_add_group_members(dn, members):
+    """
+        Add the DNs in members to the group, only the new values are sent.
+        DNs that already are members are skipped.
+        Return the list of DNs that were added.
+    """
+    return _ldap_modify_members(dn, members, ldap.MOD_ADD,
+                                (ldap.TYPE_OR_VALUE_EXISTS,
+                                 ldap.ALREADY_EXISTS))
+
+
+def ldap_remove_group_members(dn, members):
+    """
+        Remove the DNs in members from the group, only the removed values are
+        sent. DNs that aren't members are skipped.
+        Return the list of DNs that were removed.
+    """
+    return _ldap_modify_members(dn, members, ldap.MOD_DELETE,
+                                (ldap.NO_SUCH_ATTRIBUTE,))
+
+
+def ldap_group_has_member(dn, member):
+    """
+        Return True if member is a direct member of the group, the server
+        compares the value so the member list is never read.
+    """
+    result = ldap_get_entries("member=%s" % escape_filter_chars(member),
+                              base=dn, scope="base", attrlist='exists',
+                              expand_primary_group=False)
+    return bool(result)
+
 
 def ldap_user_exists(username=None):
     """
         Return True if the user exists. False otherwise.
     """
 
-    if ldap_get_user(username):
+    if ldap_get_user(username, attrlist='exists'):
         return True
 
     return False
@@ -493,7 +906,7 @@ def ldap_group_exists(groupname=None):
         Return True if the group exists. False otherwise.
     """
 
-    if ldap_get_group(groupname):
+    if ldap_get_group(groupname, attrlist='exists'):
         return True
 
     return False
@@ -504,13 +917,351 @@ def ldap_ou_exists(ou_name=None):
         Return True if the OU exists. False otherwise.
     """
 
-    if ldap_get_ou(ou_name):
+    if ldap_get_ou(ou_name, attrlist='exists'):
         return True
 
     return False
 
 
 # Private
+def _ldap_attrlist(attrlist):
+    """
+        Turn a profile name or a list of attributes into the attribute list
+        to search with, None meaning every attribute.
+    """
+    if attrlist is None:
+        return None
+
+    if isinstance(attrlist, str):
+        attrlist = LDAP_ATTRIBUTE_PROFILES[attrlist]
+
+    result = list(LDAP_KEY_ATTRIBUTES)
+    for attribute in attrlist:
+        if attribute not in result:
+            result.append(attribute)
+    return result
+
+
+def _ldap_search_base_scope(base, scope):
+    """
+        Fill in the defaults for a search base and scope name.
+    """
+    if not base:
+        base = g.ldap['dn']
+
+    if scope:
+        scope = LDAP_SCOPES[scope]
+    else:
+        scope = ldap.SCOPE_SUBTREE
+
+    return base, scope
+
+
+def _ldap_process_entries(result, attrlist, expand_primary_group=True,
+                          cache=True):
+    """
+        Decode a batch of search results, expand them and cache them.
+    """
+    entries = []
+    for entry in result:
+        if entry[0] == None:
+            continue
+
+        # Simplify the list by only keeping the attributes we known can contain
+        # multiple values as list and decode everything to unicode.
+        attributes = {}
+        for key, value in _ldap_complete_ranges(entry[0], entry[1]).items():
+            attributes[key] = _ldap_decode_attribute(key, value)
+        entries.append(attributes)
+
+    # Expand some attributes
+    if expand_primary_group:
+        _ldap_expand_primary_groups(entries)
+
+    # Cache or refresh the entries along with what they have been read with
+    if not cache:
+        return entries
+    for attributes in entries:
+        if 'objectGUID' in attributes:
+            ldap_cache.put(_ldap_cache_scope(), attributes, attrlist)
+    return entries
+
+
+def _ldap_parse_range(key):
+    """
+        Split 'member;range=0-1499' into ('member', 0, 1499), the end being
+        None for the last range. Return None for keys without a range.
+    """
+    name, _, value_range = key.partition(';range=')
+    if not value_range:
+        return None
+    low, _, high = value_range.partition('-')
+    return name, int(low), None if high == '*' else int(high)
+
+
+def _ldap_iter_ranges(dn, attribute, start=0):
+    """
+        Generator over the raw values of an attribute, one range at a time.
+    """
+    connection = g.ldap['connection']
+    while True:
+        result = connection.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                                     ['%s;range=%d-*' % (attribute, start)])
+        if not result or not result[0][0]:
+            return
+
+        for key, values in result[0][1].items():
+            parsed = _ldap_parse_range(key)
+            if parsed is None:
+                # Small enough to come back whole
+                if key.lower() == attribute.lower():
+                    yield values
+                    return
+                continue
+
+            name, low, high = parsed
+            if name.lower() != attribute.lower():
+                continue
+            yield values
+            if high is None:
+                return
+            start = high + 1
+            break
+        else:
+            return
+
+
+def _ldap_complete_ranges(dn, raw_attributes):
+    """
+        Replace the ranged attributes of a search result by all their values.
+    """
+    for key in list(raw_attributes):
+        parsed = _ldap_parse_range(key)
+        if parsed is None:
+            continue
+
+        name, low, high = parsed
+        values = list(raw_attributes.pop(key))
+        if high is not None:
+            for chunk in _ldap_iter_ranges(dn, name, high + 1):
+                values += chunk
+        raw_attributes[name] = values
+    return raw_attributes
+
+
+def _ldap_expand_primary_groups(entries):
+    """
+        Set __primaryGroup on the entries that have a primaryGroupID.
+        Groups are looked up through a map of RIDs shared by the whole
+        process, the ones it doesn't know yet are found with one search.
+    """
+    domain_sid = g.ldap['domain_sid']
+    now = time.monotonic()
+
+    rids = set(entry['primaryGroupID'] for entry in entries
+               if 'primaryGroupID' in entry and '__primaryGroup' not in entry)
+    groups = {}
+    for rid in rids:
+        cached = ldap_primary_groups.get((domain_sid, rid))
+        if cached and cached[0] > now:
+            groups[rid] = cached[1]
+
+    missing = sorted(rids - set(groups))
+    for start in range(0, len(missing), LDAP_FILTER_CHUNK_SIZE):
+        sids = "".join("(objectSid=%s-%s)" % (domain_sid, rid)
+                       for rid in missing[start:start + LDAP_FILTER_CHUNK_SIZE])
+        for group in ldap_iter_entries("(&(objectClass=group)(|%s))" % sids,
+                                       attrlist='exists',
+                                       expand_primary_group=False):
+            rid = group['objectSid'].split("-")[-1]
+            groups[rid] = group['distinguishedName']
+            ldap_primary_groups[(domain_sid, rid)] = (
+                now + LDAP_PRIMARY_GROUP_TTL, group['distinguishedName'])
+
+    for entry in entries:
+        if entry.get('primaryGroupID') in groups:
+            entry['__primaryGroup'] = groups[entry['primaryGroupID']]
+
+
+def _ldap_cache_scope():
+    """
+        The identity cached entries are visible to.
+    """
+    return (g.ldap['server'].lower(), g.ldap['username'].lower())
+
+
+def _ldap_modify_members(dn, members, operation, noop_errors):
+    """
+        Send members to the group as MOD_ADD or MOD_DELETE values of member,
+        LDAP_MODIFY_CHUNK_SIZE values per request. A chunk the server refuses
+        with one of noop_errors is retried value by value and the values that
+        fail again are skipped.
+    """
+    connection = g.ldap['connection']
+    members = list(dict.fromkeys(members))
+    done = []
+
+    for start in range(0, len(members), LDAP_MODIFY_CHUNK_SIZE):
+        chunk = members[start:start + LDAP_MODIFY_CHUNK_SIZE]
+        try:
+            connection.modify_s(dn, [(operation, 'member',
+                                      [value.encode('utf-8') for value in chunk])])
+            done += chunk
+            continue
+        except noop_errors:
+            pass
+        except ldap.UNWILLING_TO_PERFORM:
+            # Active Directory refuses to remove a DN that isn't a member
+            if operation != ldap.MOD_DELETE:
+                raise
+
+        for value in chunk:
+            try:
+                connection.modify_s(dn, [(operation, 'member',
+                                          [value.encode('utf-8')])])
+                done.append(value)
+            except noop_errors:
+                pass
+            except ldap.UNWILLING_TO_PERFORM:
+                if operation != ldap.MOD_DELETE or \
+                        ldap_group_has_member(dn, value):
+                    raise
+
+    if done:
+        ldap_cache.invalidate(dn, done)
+    return done
+
+
+def _ldap_invalidate_subtree(dn):
+    """
+        Forget everything cached about dn and the entries below it after it
+        has been moved or deleted.
+    """
+    ldap_cache.invalidate(dn, subtree=True)
+
+    suffix = ",%s" % dn.lower()
+    for key, (expires, group_dn) in list(ldap_primary_groups.items()):
+        if group_dn.lower() == dn.lower() or group_dn.lower().endswith(suffix):
+            ldap_primary_groups.pop(key, None)
+
+
+def _ldap_in_group_token_groups(user, group, support):
+    """
+        Look for the group's SID in the constructed tokenGroups of the user,
+        which holds every security group the user is in, nested or primary.
+        Return None if the server doesn't send any, which is only remembered
+        in support when it says it can't: an entry without tokenGroups says
+        nothing about the others. Other errors are raised.
+    """
+    connection = g.ldap['connection']
+    try:
+        result = connection.search_s(user['distinguishedName'], ldap.SCOPE_BASE,
+                                     '(objectClass=*)', ['tokenGroups'])
+    except LDAP_UNSUPPORTED_ERRORS:
+        support['tokenGroups'] = False
+        return None
+
+    if not result or not result[0][0] or 'tokenGroups' not in result[0][1]:
+        return None
+    support['tokenGroups'] = True
+
+    sids = _ldap_decode_attribute('tokenGroups', result[0][1]['tokenGroups'])
+    return group['objectSid'] in sids
+
+
+def _ldap_in_group_in_chain(user, group, support):
+    """
+        Ask whether the user, or its primary group, is a nested member of the
+        group with LDAP_MATCHING_RULE_IN_CHAIN.
+        Return None if the server doesn't implement the matching rule, which
+        is remembered in support, or if that can't be told yet. Other errors
+        are raised.
+    """
+    connection = g.ldap['connection']
+    dns = [user['distinguishedName']]
+    if '__primaryGroup' in user:
+        dns.append(user['__primaryGroup'])
+
+    ldap_filter = "(&(|%s)(memberOf:%s:=%s))" % (
+        "".join("(distinguishedName=%s)" % escape_filter_chars(dn) for dn in dns),
+        LDAP_MATCHING_RULE_IN_CHAIN,
+        escape_filter_chars(group['distinguishedName']))
+    try:
+        result = connection.search_s(g.ldap['dn'], ldap.SCOPE_SUBTREE,
+                                     ldap_filter, ['distinguishedName'])
+    except LDAP_UNSUPPORTED_ERRORS:
+        support['in_chain'] = False
+        return None
+
+    if [entry for entry in result if entry[0]]:
+        support['in_chain'] = True
+        return True
+
+    # Older servers ignore unknown matching rules and match nothing, check
+    # once that a direct membership of the user is found through the rule
+    if 'in_chain' not in support:
+        if not user.get('memberOf'):
+            # Nothing to check the rule with, an answer wouldn't be verified
+            return None
+        ldap_filter = "(memberOf:%s:=%s)" % (
+            LDAP_MATCHING_RULE_IN_CHAIN,
+            escape_filter_chars(user['memberOf'][0]))
+        try:
+            probe = connection.search_s(user['distinguishedName'],
+                                        ldap.SCOPE_BASE, ldap_filter,
+                                        ['distinguishedName'])
+        except LDAP_UNSUPPORTED_ERRORS:
+            probe = []
+        if not [entry for entry in probe if entry[0]]:
+            support['in_chain'] = False
+            return None
+        support['in_chain'] = True
+
+    return False
+
+
+def _ldap_in_group_walk(group, groups):
+    """
+        Walk the memberOf of every group reachable from groups looking for
+        the group, one lookup per group.
+    """
+
+    # Recurse through all the groups
+    to_check = set(groups)
+    checked = set()
+
+    while to_check != checked:
+        for entry in to_check - checked:
+            attr = ldap_get_group(entry, "distinguishedName", 'membership')
+            if attr is None:
+                return None
+            if 'memberOf' in attr:
+                if group['distinguishedName'] in attr['memberOf']:
+                    return True
+                to_check.update(attr['memberOf'])
+            checked.add(entry)
+
+    return group['distinguishedName'] in checked
+
+
+def _ldap_linked_values(attributes):
+    """
+        Return the DNs an entry links to from a raw attribute dict.
+    """
+    linked = []
+    for attribute in LDAP_LINKED_ATTRIBUTES:
+        values = attributes.get(attribute)
+        if not values:
+            continue
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            linked.append(value)
+    return linked
+
+
 def _ldap_authenticate():
     """Sends a 401 response that enables basic auth"""
     return Response('Could not verify your access level for that URL.\n'
@@ -518,6 +1269,26 @@ def _ldap_authenticate():
                     {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
 
+def _ldap_open(server):
+    """
+        Open a new, unbound connection to the server with LDAP_BACKEND.
+    """
+    connection = LDAP_BACKENDS[LDAP_BACKEND](server)
+    if LDAP_TRACE:
+        return LDAPTracedConnection(connection)
+    return connection
+
+
+def _ldap_open_memory(server):
+    return memory_directory(LDAP_MEMORY_FIXTURE).connect()
+
+
+# Functions opening an unbound connection to a server, anything answering
+# the python-ldap LDAPObject methods used here will do
+LDAP_BACKENDS = {'ldap': lambda server: ldap.initialize(LDAP_URI % server),
+                 'memory': _ldap_open_memory}
+
+
 def _ldap_connect(username, password):
     # Already connected
     if 'connection' in g.ldap:
@@ -533,30 +1304,76 @@ def _ldap_connect(username, password):
         servers = [g.ldap['server']]
 
     for server in servers:
-        connection = ldap.initialize("ldaps://%s:636" % server)
         try:
-            connection.simple_bind_s("%s@%s" % (username, g.ldap['domain']),
-                                     password)
-
-            g.ldap['connection'] = connection
-            g.ldap['server'] = server
-            g.ldap['username'] = username
+            bind_dn = LDAP_BIND_FORMAT % {'username': username,
+                                          'domain': g.ldap['domain'],
+                                          'dn': g.ldap['dn']}
+            pooled = ldap_pool.acquire(server, username, password, bind_dn,
+                                       _ldap_open)
+        except ldap.INVALID_CREDENTIALS:
+            return False
 
-            # Get domain SID
-            # Can't go through ldap_get_entry as it requires domain_sid be set.
-            result = connection.search_s(g.ldap['dn'], ldap.SCOPE_BASE)
-            g.ldap['domain_sid'] = _ldap_decode_attribute(
+        g.ldap['pooled'] = pooled
+        g.ldap['connection'] = pooled.connection
+        g.ldap['server'] = server
+        g.ldap['username'] = username
+
+        # Get domain SID, it never changes so only ask each server once
+        # Can't go through ldap_get_entry as it requires domain_sid be set.
+        domain_sid = ldap_pool.get_domain_sid(server)
+        if not domain_sid:
+            try:
+                result = pooled.connection.search_s(g.ldap['dn'], ldap.SCOPE_BASE,
+                                                    attrlist=['objectSid'])
+            except ldap.LDAPError:
+                ldap_release_connection(discard=True)
+                raise
+            domain_sid = _ldap_decode_attribute(
                 "objectSid", result[0][1]['objectSid'])
+            ldap_pool.set_domain_sid(server, domain_sid)
+        g.ldap['domain_sid'] = domain_sid
 
-            return True
-        except ldap.INVALID_CREDENTIALS:
-            return False
+        return True
         # except:
         #   continue
 
     #raise Exception("No server reachable at this point.")
 
 
+def ldap_bind(ldap_settings, username, password):
+    """
+        Connect outside of a request, e.g. from a background job, with the
+        domain, dn, server and search_dn of ldap_settings. Return False if the
+        credentials are refused.
+        The connection must be given back with ldap_release_connection().
+    """
+    g.ldap = dict(ldap_settings)
+    return _ldap_connect(username, password)
+
+
+def ldap_release_connection(discard=False):
+    """
+        Hand the connection of the current request back to the pool.
+    """
+    ldap_settings = g.get('ldap')
+    if not ldap_settings or 'pooled' not in ldap_settings:
+        return
+
+    pooled = ldap_settings.pop('pooled')
+    ldap_settings.pop('connection', None)
+    ldap_pool.release(pooled, discard=discard)
+
+
+def _ldap_error_message(error):
+    """
+        Return the message of an ldap.LDAPError to show to the user.
+    """
+    info = error.args[0] if error.args else {}
+    if not isinstance(info, dict):
+        return str(error)
+    return info.get('info') or info.get('desc') or str(error)
+
+
 def _ldap_sid2str(sid):
     version = struct.unpack('B', sid[0:1])[0]
     assert version == 1, version
@@ -612,6 +1429,31 @@ def _ldap_decode_attribute(key, value):
         return value
 
 
+def _ldap_encode_attribute(key, value):
+    """
+        Return the list of raw values a decoded attribute is written as, the
+        reverse of _ldap_decode_attribute. Empty values are dropped.
+    """
+    if not isinstance(value, list):
+        value = [value]
+
+    encoded = []
+    for item in value:
+        if item is None or item == '':
+            continue
+        if isinstance(item, bytes):
+            encoded.append(item)
+        elif key in LDAP_AD_BOOL_ATTRIBUTES:
+            encoded.append(b"TRUE" if item else b"FALSE")
+        elif key in LDAP_AD_UINT_ATTRIBUTES:
+            # Stored signed, decoded unsigned
+            item = struct.unpack("i", struct.pack("I", int(item) & 0xFFFFFFFF))[0]
+            encoded.append(str(item).encode('utf-8'))
+        else:
+            encoded.append(str(item).encode('utf-8'))
+    return encoded
+
+
 # Decorators
 def ldap_auth(group=None):
     def _my_decorator(view_func):
@@ -644,3 +1486,4 @@ def move(dn, attribute, value):
     connection = g.ldap['connection']
     attribute = [attribute.encode('utf-8')]
     connection.rename_s(dn, "%s=%s" % (attribute, value))
+    _ldap_invalidate_subtree(dn)
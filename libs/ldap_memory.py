@@ -0,0 +1,1049 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import collections
+import itertools
+import re
+import struct
+import threading
+import time
+import uuid
+
+import ldap
+import ldif
+from ldap.controls import SimplePagedResultsControl
+
+# Attributes holding DNs, compared as DNs
+MEMORY_DN_ATTRIBUTES = {'distinguishedname', 'member', 'memberof', 'manager',
+                        'managedby', 'directreports', 'secretary', 'seealso'}
+
+# Attributes compared byte for byte
+MEMORY_BINARY_ATTRIBUTES = {'objectsid', 'objectguid', 'tokengroups',
+                            'jpegphoto', 'thumbnailphoto', 'usercertificate',
+                            'unicodepwd', 'userpassword'}
+
+# Attributes compared as numbers
+MEMORY_INTEGER_ATTRIBUTES = {'useraccountcontrol', 'grouptype',
+                             'primarygroupid', 'samaccounttype',
+                             'instancetype', 'admincount', 'systemflags'}
+
+# Attributes the server computes, they can't be written
+MEMORY_CONSTRUCTED_ATTRIBUTES = {'memberof', 'tokengroups',
+                                 'distinguishedname'}
+
+# Attributes searches never return
+MEMORY_HIDDEN_ATTRIBUTES = {'unicodepwd', 'userpassword'}
+
+# Attributes with an index, equality filters on them don't scan the scope
+MEMORY_INDEXED_ATTRIBUTES = {'objectclass', 'samaccountname',
+                             'distinguishedname', 'objectsid', 'objectguid',
+                             'userprincipalname'}
+
+# Values of an attribute returned at once before ranged retrieval kicks in,
+# AD's MaxValRange
+MEMORY_MAX_VALUE_RANGE = 1500
+
+# Object classes given an objectSid when created
+MEMORY_SECURITY_PRINCIPALS = {b'user', b'group', b'computer'}
+
+MEMORY_DEFAULT_DOMAIN_SID = "S-1-5-21-1004336348-1177238915-682003330"
+
+LDAP_MATCHING_RULE_IN_CHAIN = "1.2.840.113556.1.4.1941"
+LDAP_MATCHING_RULE_BIT_AND = "1.2.840.113556.1.4.803"
+LDAP_MATCHING_RULE_BIT_OR = "1.2.840.113556.1.4.804"
+
+_DN_SEPARATOR = re.compile(r'(?<!\\),')
+
+
+def normalize_dn(dn):
+    """
+        Return the form DNs are compared in: lower case, no spaces around
+        the RDNs.
+    """
+    return ",".join(rdn.strip() for rdn in _DN_SEPARATOR.split(dn.lower()))
+
+
+def sid_to_bytes(sid):
+    """
+        Return the binary form of a SID string, as objectSid holds it.
+    """
+    parts = [int(part) for part in sid.split("-")[1:]]
+    return (struct.pack('BB', parts[0], len(parts) - 2) +
+            struct.pack('>Q', parts[1])[2:] +
+            b"".join(struct.pack('<L', value) for value in parts[2:]))
+
+
+def normalize_value(key, value):
+    """
+        Return the form a value of the attribute key is compared in.
+    """
+    if key in MEMORY_DN_ATTRIBUTES:
+        return normalize_dn(value.decode('utf-8', 'replace'))
+    if key in MEMORY_BINARY_ATTRIBUTES:
+        return value
+    if key in MEMORY_INTEGER_ATTRIBUTES:
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value.decode('utf-8', 'replace').lower()
+
+
+def _error(exception, info):
+    return exception({'desc': exception.__name__.replace('_', ' ').lower(),
+                      'info': info})
+
+
+class _Entry(object):
+    __slots__ = ('dn', 'ndn', 'parent', 'attributes', 'normalized')
+
+    def __init__(self, dn, attributes):
+        self.dn = dn
+        self.ndn = normalize_dn(dn)
+        parts = _DN_SEPARATOR.split(self.ndn, 1)
+        self.parent = parts[1] if len(parts) > 1 else ""
+        # lower case name -> (name, [values])
+        self.attributes = attributes
+        # lower case name -> frozenset of normalized values
+        self.normalized = {}
+
+    def values(self, key):
+        return self.attributes.get(key, (None, []))[1]
+
+
+class MemoryDirectory(object):
+    """
+        An Active Directory look-alike held in memory, loaded from an LDIF
+        fixture. Meant for deterministic benchmarks and development without
+        a domain controller, not for production.
+
+        Besides filters, scopes and writes it computes what AD does:
+        memberOf from the member of groups, tokenGroups, ranged retrieval of
+        large attributes, objectSid, objectGUID and distinguishedName of new
+        entries and the LDAP_MATCHING_RULE_IN_CHAIN and bitwise matching
+        rules. Equality filters on MEMORY_INDEXED_ATTRIBUTES go through
+        indexes. Every operation is counted in operations.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._children = collections.defaultdict(dict)
+        self._index = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+        # ndn -> ndns of the groups it is a direct member of
+        self._member_of = collections.defaultdict(set)
+        self._filters = {}
+        self._rid = itertools.count(1100)
+        self.domain_sid = MEMORY_DEFAULT_DOMAIN_SID
+        self.operations = collections.Counter()
+        if path:
+            self.load(path)
+
+    def load(self, path):
+        """
+            Add the entries of an LDIF file. memberOf and tokenGroups found
+            in it are ignored, they are computed from the groups.
+        """
+        records = []
+
+        class Parser(ldif.LDIFParser):
+            def handle(self, dn, entry):
+                records.append((dn, entry))
+
+        with open(path, 'rb') as fixture:
+            Parser(fixture).parse()
+
+        with self._lock:
+            for dn, entry in records:
+                for value in entry.get('objectSid', []):
+                    if _DN_SEPARATOR.split(dn)[0].lower().startswith('dc='):
+                        self.domain_sid = self._sid_string(value)
+                        break
+            for dn, entry in records:
+                attributes = {}
+                for name, values in entry.items():
+                    if name.lower() in ('memberof', 'tokengroups'):
+                        continue
+                    attributes[name.lower()] = (name, list(values))
+                self._insert(_Entry(dn, attributes), check_parent=False)
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    # Operations, see MemoryConnection for the python-ldap interface
+
+    def bind(self, who, password):
+        with self._lock:
+            self.operations['bind'] += 1
+            entry = self._principal(who)
+            if entry is None or not password or \
+                    not self._password_matches(entry, password):
+                raise _error(ldap.INVALID_CREDENTIALS,
+                             "80090308: LdapErr: DSID-0C09044E, comment: "
+                             "AcceptSecurityContext error, data 52e, v4563")
+            return entry
+
+    def search(self, base, scope, filterstr=None, attrlist=None):
+        with self._lock:
+            self.operations['search'] += 1
+            nbase = normalize_dn(base)
+            if nbase not in self._entries:
+                raise _error(ldap.NO_SUCH_OBJECT,
+                             "0000208D: NameErr: DSID-03100241, problem "
+                             "2001 (NO_OBJECT)")
+
+            node = self._parse(filterstr or "(objectClass=*)")
+            match = self._compile(node)
+            candidates = self._candidates(node)
+            if candidates is None:
+                entries = self._scope(nbase, scope)
+            else:
+                entries = (self._entries[ndn] for ndn in sorted(candidates)
+                           if self._in_scope(ndn, nbase, scope))
+
+            base_scope = scope == ldap.SCOPE_BASE
+            return [(entry.dn, self._project(entry, attrlist, base_scope))
+                    for entry in entries if match(entry)]
+
+    def add(self, dn, modlist):
+        with self._lock:
+            self.operations['add'] += 1
+            if normalize_dn(dn) in self._entries:
+                raise _error(ldap.ALREADY_EXISTS,
+                             "00000524: UpdErr: DSID-031A11E0, problem 6005 "
+                             "(ENTRY_EXISTS)")
+            attributes = {}
+            for name, values in modlist:
+                key = name.lower()
+                if key in MEMORY_CONSTRUCTED_ATTRIBUTES:
+                    raise _error(ldap.UNWILLING_TO_PERFORM,
+                                 "%s can't be written" % name)
+                values = [values] if isinstance(values, bytes) else \
+                    list(values or [])
+                if key == 'unicodepwd':
+                    attributes.pop('userpassword', None)
+                if values:
+                    attributes[key] = (name, values)
+
+            object_classes = {value.lower() for value in
+                              attributes.get('objectclass', (None, []))[1]}
+            if object_classes & MEMORY_SECURITY_PRINCIPALS and \
+                    'objectsid' not in attributes:
+                attributes['objectsid'] = ('objectSid', [sid_to_bytes(
+                    "%s-%d" % (self.domain_sid, next(self._rid)))])
+            now = time.strftime("%Y%m%d%H%M%S.0Z", time.gmtime()).encode()
+            attributes['whencreated'] = ('whenCreated', [now])
+            attributes['whenchanged'] = ('whenChanged', [now])
+            self._insert(_Entry(dn, attributes), check_parent=True)
+
+    def modify(self, dn, modlist):
+        with self._lock:
+            self.operations['modify'] += 1
+            entry = self._get(dn)
+            attributes = {key: (name, list(values)) for key, (name, values)
+                          in entry.attributes.items()}
+
+            for operation, name, values in modlist:
+                key = name.lower()
+                if key in MEMORY_CONSTRUCTED_ATTRIBUTES:
+                    raise _error(ldap.UNWILLING_TO_PERFORM,
+                                 "%s can't be written" % name)
+                values = [values] if isinstance(values, bytes) else \
+                    list(values or [])
+                name, current = attributes.get(key, (name, []))
+
+                if key == 'unicodepwd':
+                    if operation == ldap.MOD_DELETE:
+                        # Change of their own password by a user
+                        if not values or not self._password_matches(
+                                entry, _unicode_password(values[0])):
+                            raise _error(ldap.CONSTRAINT_VIOLATION,
+                                         "0000056B: AtrErr: DSID-03191083, "
+                                         "#1: 0: 00000056: 2 (unicodePwd)")
+                        continue
+                    attributes.pop('userpassword', None)
+                    current = values[-1:]
+                elif operation == ldap.MOD_ADD:
+                    existing = {normalize_value(key, value)
+                                for value in current}
+                    for value in values:
+                        if normalize_value(key, value) in existing:
+                            raise _error(ldap.TYPE_OR_VALUE_EXISTS,
+                                         "00002083: AtrErr: DSID-03151904, "
+                                         "#1: 0: 00002083: %s" % name)
+                        existing.add(normalize_value(key, value))
+                        current.append(value)
+                elif operation == ldap.MOD_DELETE:
+                    if not current:
+                        raise _error(ldap.NO_SUCH_ATTRIBUTE,
+                                     "00002080: AtrErr: DSID-03080155, #1: "
+                                     "0: 00002080: %s" % name)
+                    if values:
+                        for value in values:
+                            wanted = normalize_value(key, value)
+                            matching = [existing for existing in current
+                                        if normalize_value(key, existing) ==
+                                        wanted]
+                            if not matching:
+                                raise _error(
+                                    ldap.NO_SUCH_ATTRIBUTE,
+                                    "00002080: AtrErr: DSID-03080155, #1: "
+                                    "0: 00002080: %s" % name)
+                            current.remove(matching[0])
+                    else:
+                        current = []
+                elif operation == ldap.MOD_REPLACE:
+                    current = values
+
+                if current:
+                    attributes[key] = (name, current)
+                else:
+                    attributes.pop(key, None)
+
+            now = time.strftime("%Y%m%d%H%M%S.0Z", time.gmtime()).encode()
+            attributes['whenchanged'] = ('whenChanged', [now])
+
+            self._unlink(entry)
+            self._unindex(entry)
+            entry.attributes = attributes
+            entry.normalized = {}
+            self._reindex(entry)
+            self._link(entry)
+
+    def delete(self, dn):
+        with self._lock:
+            self.operations['delete'] += 1
+            entry = self._get(dn)
+            if self._children.get(entry.ndn):
+                raise _error(ldap.NOT_ALLOWED_ON_NONLEAF,
+                             "00000010: UpdErr: DSID-030A0BB3, problem 6003 "
+                             "(CANT_ON_NON_LEAF)")
+            # Links to the entry go away with it
+            for group in list(self._member_of.get(entry.ndn, ())):
+                self._remove_member(self._entries[group], entry.ndn)
+            self._unlink(entry)
+            self._member_of.pop(entry.ndn, None)
+            self._unindex(entry)
+            del self._entries[entry.ndn]
+            self._children[entry.parent].pop(entry.ndn, None)
+            self._children.pop(entry.ndn, None)
+
+    def rename(self, dn, new_rdn, new_parent=None, delete_old=True):
+        with self._lock:
+            self.operations['rename'] += 1
+            entry = self._get(dn)
+            if new_parent is None:
+                new_parent = ",".join(_DN_SEPARATOR.split(entry.dn)[1:])
+            new_dn = "%s,%s" % (new_rdn, new_parent)
+            nparent = normalize_dn(new_parent)
+            if nparent not in self._entries:
+                raise _error(ldap.NO_SUCH_OBJECT,
+                             "0000208D: NameErr: DSID-03100241, problem "
+                             "2001 (NO_OBJECT)")
+            if nparent == entry.ndn or nparent.endswith("," + entry.ndn):
+                raise _error(ldap.UNWILLING_TO_PERFORM,
+                             "An entry can't be moved under itself")
+            if normalize_dn(new_dn) in self._entries and \
+                    normalize_dn(new_dn) != entry.ndn:
+                raise _error(ldap.ALREADY_EXISTS,
+                             "00000524: UpdErr: DSID-031A11E0, problem 6005 "
+                             "(ENTRY_EXISTS)")
+
+            moved = list(self._scope(entry.ndn, ldap.SCOPE_SUBTREE))
+            depth = len(_DN_SEPARATOR.split(entry.dn))
+            # Groups pointing at the moved entries will point at their new DN
+            member_of = {}
+            for moved_entry in moved:
+                if self._member_of.get(moved_entry.ndn):
+                    member_of[moved_entry.ndn] = set(
+                        self._member_of.pop(moved_entry.ndn))
+            renamed = {}
+            for moved_entry in moved:
+                self._unlink(moved_entry)
+                self._unindex(moved_entry)
+                del self._entries[moved_entry.ndn]
+                self._children[moved_entry.parent].pop(moved_entry.ndn, None)
+                self._children.pop(moved_entry.ndn, None)
+
+                parts = _DN_SEPARATOR.split(moved_entry.dn)
+                renamed[moved_entry.ndn] = ",".join(
+                    parts[:len(parts) - depth] + [new_dn])
+
+            # Keep the RDN attribute and name in step with the new RDN
+            attribute, _, value = new_rdn.partition("=")
+            value = re.sub(r'\\(.)', r'\1', value).encode('utf-8')
+            old_attribute = _DN_SEPARATOR.split(entry.dn)[0] \
+                .partition("=")[0].strip().lower()
+            name, values = entry.attributes.pop(old_attribute, (None, []))
+            if not delete_old and values:
+                entry.attributes[old_attribute] = (name, values)
+            if attribute.lower() != old_attribute:
+                name = attribute
+            name, values = entry.attributes.get(attribute.lower(),
+                                                (name, []))
+            if value not in values:
+                values = values + [value]
+            entry.attributes[attribute.lower()] = (name, values)
+            entry.attributes['name'] = ('name', [value])
+
+            for moved_entry in moved:
+                old_ndn = moved_entry.ndn
+                moved_entry.dn = renamed[old_ndn]
+                moved_entry.ndn = normalize_dn(moved_entry.dn)
+                moved_entry.parent = _DN_SEPARATOR.split(moved_entry.ndn, 1)[1]
+                moved_entry.attributes['distinguishedname'] = (
+                    'distinguishedName', [moved_entry.dn.encode('utf-8')])
+                moved_entry.normalized = {}
+                self._entries[moved_entry.ndn] = moved_entry
+                self._children[moved_entry.parent][moved_entry.ndn] = None
+
+            for old_ndn, groups in member_of.items():
+                new_ndn = normalize_dn(renamed[old_ndn])
+                for group in groups:
+                    group = normalize_dn(renamed.get(group, group))
+                    if group in self._entries:
+                        self._replace_member(self._entries[group], old_ndn,
+                                             renamed[old_ndn])
+
+            for moved_entry in moved:
+                self._reindex(moved_entry)
+                self._link(moved_entry)
+            for old_ndn, groups in member_of.items():
+                self._member_of[normalize_dn(renamed[old_ndn])].update(
+                    normalize_dn(renamed.get(group, group))
+                    for group in groups)
+
+    # Storage
+
+    def _get(self, dn):
+        entry = self._entries.get(normalize_dn(dn))
+        if entry is None:
+            raise _error(ldap.NO_SUCH_OBJECT,
+                         "0000208D: NameErr: DSID-03100241, problem 2001 "
+                         "(NO_OBJECT)")
+        return entry
+
+    def _insert(self, entry, check_parent):
+        if check_parent and entry.parent not in self._entries:
+            raise _error(ldap.NO_SUCH_OBJECT,
+                         "0000208D: NameErr: DSID-03100241, problem 2001 "
+                         "(NO_OBJECT)")
+        rdn = _DN_SEPARATOR.split(entry.dn)[0].partition("=")[2].strip()
+        entry.attributes['distinguishedname'] = (
+            'distinguishedName', [entry.dn.encode('utf-8')])
+        entry.attributes.setdefault('name', (
+            'name', [re.sub(r'\\(.)', r'\1', rdn).encode('utf-8')]))
+        entry.attributes.setdefault('objectguid', (
+            'objectGUID', [uuid.uuid5(uuid.NAMESPACE_X500, entry.ndn)
+                           .bytes_le]))
+
+        self._entries[entry.ndn] = entry
+        self._children[entry.parent][entry.ndn] = None
+        self._reindex(entry)
+        self._link(entry)
+
+    def _reindex(self, entry):
+        for key in MEMORY_INDEXED_ATTRIBUTES:
+            for value in self._normalized(entry, key):
+                self._index[key][value].add(entry.ndn)
+
+    def _unindex(self, entry):
+        for key in MEMORY_INDEXED_ATTRIBUTES:
+            for value in self._normalized(entry, key):
+                self._index[key][value].discard(entry.ndn)
+
+    def _link(self, entry):
+        """
+            Record the entry as the group of each of its members.
+        """
+        for member in self._normalized(entry, 'member'):
+            self._member_of[member].add(entry.ndn)
+
+    def _unlink(self, entry):
+        for member in self._normalized(entry, 'member'):
+            self._member_of[member].discard(entry.ndn)
+
+    def _remove_member(self, group, ndn):
+        name, values = group.attributes.get('member', ('member', []))
+        values = [value for value in values
+                  if normalize_value('member', value) != ndn]
+        self._unlink(group)
+        if values:
+            group.attributes['member'] = (name, values)
+        else:
+            group.attributes.pop('member', None)
+        group.normalized.pop('member', None)
+        self._link(group)
+
+    def _replace_member(self, group, ndn, dn):
+        name, values = group.attributes['member']
+        group.attributes['member'] = (name, [
+            dn.encode('utf-8') if normalize_value('member', value) == ndn
+            else value for value in values])
+        group.normalized.pop('member', None)
+
+    def _normalized(self, entry, key):
+        if key == 'memberof':
+            return self._member_of.get(entry.ndn, frozenset())
+        normalized = entry.normalized.get(key)
+        if normalized is None:
+            normalized = frozenset(normalize_value(key, value)
+                                   for value in entry.values(key))
+            entry.normalized[key] = normalized
+        return normalized
+
+    # Searches
+
+    def _scope(self, nbase, scope):
+        if scope == ldap.SCOPE_BASE:
+            return [self._entries[nbase]]
+        if scope == ldap.SCOPE_ONELEVEL:
+            return [self._entries[ndn] for ndn in self._children.get(nbase, ())]
+        return self._subtree(nbase)
+
+    def _subtree(self, nbase):
+        pending = [nbase]
+        while pending:
+            ndn = pending.pop()
+            yield self._entries[ndn]
+            pending.extend(reversed(list(self._children.get(ndn, ()))))
+
+    def _in_scope(self, ndn, nbase, scope):
+        if ndn not in self._entries:
+            return False
+        if scope == ldap.SCOPE_BASE:
+            return ndn == nbase
+        if scope == ldap.SCOPE_ONELEVEL:
+            return self._entries[ndn].parent == nbase
+        return ndn == nbase or ndn.endswith("," + nbase)
+
+    def _project(self, entry, attrlist, base_scope):
+        if attrlist and list(attrlist) == ['1.1']:
+            return {}
+
+        result = {}
+        if not attrlist or '*' in attrlist:
+            for key, (name, values) in entry.attributes.items():
+                if key not in MEMORY_HIDDEN_ATTRIBUTES:
+                    _put(result, name, values, None)
+            _put(result, 'memberOf', self._member_of_values(entry), None)
+            attrlist = [name for name in attrlist or [] if name != '*']
+
+        for requested in attrlist:
+            name, _, value_range = requested.partition(';range=')
+            key = name.lower()
+            if key in MEMORY_HIDDEN_ATTRIBUTES:
+                continue
+            if key == 'memberof':
+                name, values = 'memberOf', self._member_of_values(entry)
+            elif key == 'tokengroups':
+                # Only computed for the entry a search is based on
+                if not base_scope:
+                    continue
+                name, values = 'tokenGroups', self._token_groups(entry)
+            elif key in entry.attributes:
+                name, values = entry.attributes[key]
+            else:
+                continue
+            _put(result, name, values, value_range)
+        return result
+
+    def _member_of_values(self, entry):
+        return [self._entries[group].dn.encode('utf-8')
+                for group in sorted(self._member_of.get(entry.ndn, ()))
+                if group in self._entries]
+
+    def _groups(self, ndn):
+        """
+            Return the groups ndn is a member of, directly or not.
+        """
+        groups = set()
+        pending = [ndn]
+        while pending:
+            for group in self._member_of.get(pending.pop(), ()):
+                if group not in groups:
+                    groups.add(group)
+                    pending.append(group)
+        return groups
+
+    def _members(self, ndn):
+        """
+            Return the members of the group ndn, directly or not.
+        """
+        members = set()
+        pending = [ndn]
+        while pending:
+            entry = self._entries.get(pending.pop())
+            if entry is None:
+                continue
+            for member in self._normalized(entry, 'member'):
+                if member not in members:
+                    members.add(member)
+                    pending.append(member)
+        return members
+
+    def _token_groups(self, entry):
+        groups = self._groups(entry.ndn)
+        for rid in entry.values('primarygroupid'):
+            sid = sid_to_bytes("%s-%s" % (self.domain_sid, rid.decode()))
+            for group in self._index['objectsid'].get(sid, ()):
+                groups.add(group)
+                groups.update(self._groups(group))
+
+        sids = []
+        for group in sorted(groups):
+            group = self._entries.get(group)
+            if group is None:
+                continue
+            group_type = self._normalized(group, 'grouptype')
+            if any(isinstance(value, int) and value & 0x80000000
+                   for value in group_type):
+                sids.extend(group.values('objectsid'))
+        return sids
+
+    def _principal(self, who):
+        if "=" in who:
+            return self._entries.get(normalize_dn(who))
+        candidates = set()
+        if "@" in who:
+            candidates = self._index['userprincipalname'].get(who.lower())
+            if not candidates:
+                who = who.split("@")[0]
+        elif "\\" in who:
+            who = who.split("\\", 1)[1]
+        if not candidates:
+            candidates = self._index['samaccountname'].get(who.lower())
+        for ndn in sorted(candidates or ()):
+            return self._entries[ndn]
+        return None
+
+    def _password_matches(self, entry, password):
+        for value in entry.values('unicodepwd'):
+            if _unicode_password(value) == password:
+                return True
+        for value in entry.values('userpassword'):
+            if value.decode('utf-8', 'replace') == password:
+                return True
+        return False
+
+    def _sid_string(self, value):
+        count = value[1]
+        authority = struct.unpack('>Q', b'\x00\x00' + value[2:8])[0]
+        return "S-%d-%d-%s" % (value[0], authority, "-".join(
+            str(part) for part in struct.unpack('<%dL' % count,
+                                                value[8:8 + 4 * count])))
+
+    # Filters
+
+    def _parse(self, text):
+        node = self._filters.get(text)
+        if node is None:
+            node = parse_filter(text)
+            if len(self._filters) > 4096:
+                self._filters.clear()
+            self._filters[text] = node
+        return node
+
+    def _candidates(self, node):
+        """
+            Return the ndns an indexed lookup says can match the filter, or
+            None when the scope has to be scanned.
+        """
+        kind = node[0]
+        if kind == 'eq' and node[1] in MEMORY_INDEXED_ATTRIBUTES:
+            return self._index[node[1]].get(
+                _filter_value(node[1], node[2]), set())
+        if kind == 'and':
+            best = None
+            for child in node[1]:
+                candidates = self._candidates(child)
+                if candidates is not None and \
+                        (best is None or len(candidates) < len(best)):
+                    best = candidates
+            return best
+        if kind == 'or':
+            union = set()
+            for child in node[1]:
+                candidates = self._candidates(child)
+                if candidates is None:
+                    return None
+                union |= candidates
+            return union
+        return None
+
+    def _compile(self, node):
+        """
+            Turn a parsed filter into a function of an entry. Nested
+            memberships are worked out here, once per search.
+        """
+        kind = node[0]
+        if kind in ('and', 'or'):
+            children = [self._compile(child) for child in node[1]]
+            if kind == 'and':
+                return lambda entry: all(child(entry) for child in children)
+            return lambda entry: any(child(entry) for child in children)
+        if kind == 'not':
+            child = self._compile(node[1])
+            return lambda entry: not child(entry)
+
+        key = node[1]
+        if kind == 'present':
+            if key == 'objectclass':
+                return lambda entry: True
+            if key == 'tokengroups':
+                return lambda entry: False
+            return lambda entry: bool(self._normalized(entry, key))
+
+        if kind == 'eq':
+            value = _filter_value(key, node[2])
+            return lambda entry: value in self._normalized(entry, key)
+
+        if kind == 'substrings':
+            initial, middle, final = [
+                None if part is None else part.decode('utf-8', 'replace')
+                .lower() if isinstance(part, bytes) else
+                [value.decode('utf-8', 'replace').lower() for value in part]
+                for part in node[2:]]
+
+            def substrings(entry):
+                for value in self._normalized(entry, key):
+                    if isinstance(value, str) and \
+                            _match_substrings(value, initial, middle, final):
+                        return True
+                return False
+            return substrings
+
+        if kind in ('ge', 'le'):
+            value = _filter_value(key, node[2])
+            greater = kind == 'ge'
+
+            def ordering(entry):
+                for candidate in self._normalized(entry, key):
+                    try:
+                        if (candidate >= value) if greater else \
+                                (candidate <= value):
+                            return True
+                    except TypeError:
+                        continue
+                return False
+            return ordering
+
+        # Extensible match
+        rule, value = node[2], node[3]
+        if rule == LDAP_MATCHING_RULE_IN_CHAIN:
+            target = normalize_dn(value.decode('utf-8', 'replace'))
+            if key == 'memberof':
+                members = self._members(target)
+                return lambda entry: entry.ndn in members
+            if key == 'member':
+                groups = self._groups(target)
+                return lambda entry: entry.ndn in groups
+            return lambda entry: False
+        if rule in (LDAP_MATCHING_RULE_BIT_AND, LDAP_MATCHING_RULE_BIT_OR):
+            bits = int(value)
+            if rule == LDAP_MATCHING_RULE_BIT_AND:
+                return lambda entry: any(
+                    isinstance(candidate, int) and candidate & bits == bits
+                    for candidate in self._normalized(entry, key))
+            return lambda entry: any(
+                isinstance(candidate, int) and candidate & bits
+                for candidate in self._normalized(entry, key))
+        # Unknown matching rules match nothing, as on AD
+        return lambda entry: False
+
+
+class MemoryConnection(object):
+    """
+        The part of python-ldap's LDAPObject the application uses, answered
+        by a MemoryDirectory. Asynchronous operations are carried out at
+        once and their outcome kept for result()/result3().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.bound = None
+        self._msgids = itertools.count(1)
+        self._cookies = itertools.count(1)
+        self._results = {}
+        self._pages = {}
+
+    def simple_bind_s(self, who='', cred='', serverctrls=None,
+                      clientctrls=None):
+        self.bound = self.directory.bind(who, cred)
+        return ldap.RES_BIND, [], next(self._msgids), []
+
+    def whoami_s(self, serverctrls=None, clientctrls=None):
+        self._check_bound()
+        return "u:%s" % self.bound.values('samaccountname')[0].decode('utf-8')
+
+    def unbind_s(self):
+        self.bound = None
+
+    def unbind(self):
+        self.bound = None
+
+    def set_option(self, option, invalue):
+        pass
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        self._check_bound()
+        return self.directory.search(base, scope, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        self._check_bound()
+        paging = [control for control in serverctrls or []
+                  if control.controlType ==
+                  SimplePagedResultsControl.controlType]
+
+        def search():
+            if paging and paging[0].cookie:
+                entries = self._pages.pop(paging[0].cookie, None)
+                if entries is None:
+                    raise _error(ldap.UNWILLING_TO_PERFORM,
+                                 "Unknown paged results cookie")
+            else:
+                entries = self.directory.search(base, scope, filterstr,
+                                                 attrlist)
+            if not paging:
+                return entries, []
+
+            size = paging[0].size or len(entries)
+            cookie = b""
+            if len(entries) > size:
+                cookie = str(next(self._cookies)).encode()
+                self._pages[cookie] = entries[size:]
+            return entries[:size], [SimplePagedResultsControl(
+                True, size=paging[0].size, cookie=cookie)]
+
+        return self._run(ldap.RES_SEARCH_RESULT, search)
+
+    def add_s(self, dn, modlist, serverctrls=None, clientctrls=None):
+        self._check_bound()
+        self.directory.add(dn, modlist)
+        return ldap.RES_ADD, []
+
+    def add(self, dn, modlist):
+        return self._run(ldap.RES_ADD, self.add_s, dn, modlist)
+
+    def modify_s(self, dn, modlist, serverctrls=None, clientctrls=None):
+        self._check_bound()
+        self.directory.modify(dn, modlist)
+        return ldap.RES_MODIFY, []
+
+    def modify(self, dn, modlist):
+        return self._run(ldap.RES_MODIFY, self.modify_s, dn, modlist)
+
+    def delete_s(self, dn, serverctrls=None, clientctrls=None):
+        self._check_bound()
+        self.directory.delete(dn)
+        return ldap.RES_DELETE, []
+
+    def delete(self, dn):
+        return self._run(ldap.RES_DELETE, self.delete_s, dn)
+
+    def rename_s(self, dn, newrdn, newsuperior=None, delold=1,
+                 serverctrls=None, clientctrls=None):
+        self._check_bound()
+        self.directory.rename(dn, newrdn, newsuperior, bool(delold))
+        return ldap.RES_MODRDN, []
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1):
+        return self._run(ldap.RES_MODRDN, self.rename_s, dn, newrdn,
+                         newsuperior, delold)
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        if msgid == ldap.RES_ANY:
+            msgid = min(self._results)
+        outcome = self._results.pop(msgid)
+        if isinstance(outcome, ldap.LDAPError):
+            raise outcome
+        rtype, data, controls = outcome
+        return rtype, data, msgid, controls
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        rtype, data, msgid, controls = self.result3(msgid, all, timeout)
+        return rtype, data
+
+    def _run(self, rtype, function, *args):
+        msgid = next(self._msgids)
+        try:
+            outcome = function(*args)
+        except ldap.LDAPError as e:
+            self._results[msgid] = e
+        else:
+            if rtype == ldap.RES_SEARCH_RESULT:
+                self._results[msgid] = (rtype, outcome[0], outcome[1])
+            else:
+                self._results[msgid] = (rtype, [], [])
+        return msgid
+
+    def _check_bound(self):
+        if self.bound is None:
+            raise _error(ldap.OPERATIONS_ERROR,
+                         "000004DC: LdapErr: DSID-0C090A71, comment: In "
+                         "order to perform this operation a successful bind "
+                         "must be completed on the connection.")
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+def memory_directory(path):
+    """
+        Return the MemoryDirectory of the fixture, loaded once per process
+        and shared by every connection.
+    """
+    with _directories_lock:
+        directory = _directories.get(path)
+        if directory is None:
+            directory = _directories[path] = MemoryDirectory(path)
+        return directory
+
+
+def parse_filter(text):
+    """
+        Parse an LDAP filter (RFC 4515) into nested tuples:
+        ('and'|'or', [children]), ('not', child), ('present', key),
+        ('eq'|'ge'|'le', key, value), ('substrings', key, initial, [middle],
+        final) and ('extensible', key, rule, value), keys being lower case
+        and values bytes.
+    """
+    text = text.strip()
+    if not text.startswith("("):
+        text = "(%s)" % text
+    try:
+        node, position = _parse_filter(text, 0)
+    except (IndexError, ValueError):
+        raise _error(ldap.FILTER_ERROR, "Bad search filter: %s" % text)
+    if position != len(text):
+        raise _error(ldap.FILTER_ERROR, "Bad search filter: %s" % text)
+    return node
+
+
+def _parse_filter(text, position):
+    if text[position] != "(":
+        raise ValueError(text)
+    position += 1
+    operator = text[position]
+    if operator in "&|":
+        children = []
+        position += 1
+        while text[position] == "(":
+            child, position = _parse_filter(text, position)
+            children.append(child)
+        if text[position] != ")":
+            raise ValueError(text)
+        return ('and' if operator == "&" else 'or', children), position + 1
+    if operator == "!":
+        child, position = _parse_filter(text, position + 1)
+        if text[position] != ")":
+            raise ValueError(text)
+        return ('not', child), position + 1
+
+    end = text.index(")", position)
+    return _parse_item(text[position:end]), end + 1
+
+
+def _parse_item(item):
+    equals = item.index("=")
+    if item[equals - 1] == ":":
+        # attribute[:dn][:rule]:=value
+        parts = item[:equals - 1].split(":")
+        rule = parts[-1] if len(parts) > 1 and parts[-1] != "dn" else None
+        return ('extensible', parts[0].lower(), rule,
+                _unescape(item[equals + 1:]))
+
+    key = item[:equals].rstrip("<>~").lower()
+    value = item[equals + 1:]
+    if item[equals - 1] == ">":
+        return ('ge', key, _unescape(value))
+    if item[equals - 1] == "<":
+        return ('le', key, _unescape(value))
+    if item[equals - 1] == "~" or "*" not in value:
+        return ('eq', key, _unescape(value))
+    if value == "*":
+        return ('present', key)
+    parts = value.split("*")
+    return ('substrings', key, _unescape(parts[0]) if parts[0] else None,
+            [_unescape(part) for part in parts[1:-1] if part],
+            _unescape(parts[-1]) if parts[-1] else None)
+
+
+def _unescape(value):
+    output = bytearray()
+    position = 0
+    while position < len(value):
+        if value[position] == "\\":
+            output.append(int(value[position + 1:position + 3], 16))
+            position += 3
+        else:
+            output.extend(value[position].encode('utf-8'))
+            position += 1
+    return bytes(output)
+
+
+def _filter_value(key, value):
+    # AD takes SIDs in their string form as well
+    if key == 'objectsid' and value.upper().startswith(b"S-1-"):
+        return sid_to_bytes(value.decode('ascii'))
+    return normalize_value(key, value)
+
+
+def _match_substrings(value, initial, middle, final):
+    position = 0
+    if initial is not None:
+        if not value.startswith(initial):
+            return False
+        position = len(initial)
+    for part in middle:
+        found = value.find(part, position)
+        if found < 0:
+            return False
+        position = found + len(part)
+    if final is not None:
+        return len(value) - len(final) >= position and value.endswith(final)
+    return True
+
+
+def _unicode_password(value):
+    return value.decode('utf-16-le').strip('"')
+
+
+def _put(result, name, values, value_range):
+    """
+        Add the values of an attribute to a search result, a range of them
+        under name;range=low-high when asked for one or there are more than
+        MEMORY_MAX_VALUE_RANGE.
+    """
+    if not values:
+        return
+    if not value_range and len(values) <= MEMORY_MAX_VALUE_RANGE:
+        result[name] = list(values)
+        return
+
+    low, high = 0, None
+    if value_range:
+        low, _, high = value_range.partition("-")
+        low, high = int(low), None if high in ("*", "") else int(high)
+    last = low + MEMORY_MAX_VALUE_RANGE - 1
+    if high is not None:
+        last = min(last, high)
+    end = "*" if last >= len(values) - 1 else str(last)
+    result["%s;range=%d-%s" % (name, low, end)] = values[low:last + 1]
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+
+import ldap
+
+
+class PooledConnection(object):
+    """
+        An authenticated LDAP connection together with the bookkeeping the
+        pool needs to decide whether it can be handed out again.
+    """
+
+    def __init__(self, key, connection, secret):
+        self.key = key
+        self.connection = connection
+        self.secret = secret
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.last_bind = self.created
+        self.last_check = self.created
+
+    def close(self):
+        try:
+            self.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+class LDAPConnectionPool(object):
+    """
+        Keeps authenticated connections per (server, username) alive across
+        requests so a page view doesn't pay for a TLS handshake and a bind.
+
+        A connection is checked out for the duration of a request and given
+        back with release(). Idle connections are reaped after idle_timeout
+        seconds, checked with a whoami before reuse once they have been idle
+        for more than check_interval seconds, and re-bound with the
+        presented password every rebind_interval seconds so disabled
+        accounts and changed passwords are noticed.
+    """
+
+    def __init__(self, max_size=20, max_per_user=2, idle_timeout=300,
+                 check_interval=30, rebind_interval=300):
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.rebind_interval = rebind_interval
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._in_use = 0
+        self._domain_sids = {}
+        # Passwords are never kept, only a keyed digest to compare against
+        self._salt = os.urandom(32)
+
+    def _digest(self, password):
+        return hmac.new(self._salt, password.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def _idle_count(self):
+        return sum(len(entries) for entries in self._idle.values())
+
+    def acquire(self, server, username, password, bind_dn, open_connection):
+        """
+            Return a bound connection for username on server.
+            A pooled connection is reused when the password matches, otherwise
+            open_connection(server) is called and the new connection bound
+            with bind_dn. ldap.INVALID_CREDENTIALS is propagated.
+        """
+        key = (server.lower(), username.lower())
+        secret = self._digest(password)
+
+        self.reap()
+
+        while True:
+            with self._lock:
+                entries = self._idle.get(key)
+                pooled = entries.pop() if entries else None
+                if pooled:
+                    self._in_use += 1
+            if not pooled:
+                break
+
+            try:
+                if self._revalidate(pooled, secret, bind_dn, password):
+                    pooled.last_used = time.monotonic()
+                    return pooled
+            except ldap.INVALID_CREDENTIALS:
+                self.release(pooled, discard=True)
+                raise
+            self.release(pooled, discard=True)
+
+        connection = open_connection(server)
+        try:
+            connection.simple_bind_s(bind_dn, password)
+        except ldap.LDAPError:
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                pass
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return PooledConnection(key, connection, secret)
+
+    def _revalidate(self, pooled, secret, bind_dn, password):
+        now = time.monotonic()
+        try:
+            if not hmac.compare_digest(pooled.secret, secret) or \
+                    now - pooled.last_bind > self.rebind_interval:
+                # Let the server decide, a wrong password fails here
+                pooled.connection.simple_bind_s(bind_dn, password)
+                pooled.secret = secret
+                pooled.last_bind = now
+                pooled.last_check = now
+            elif now - pooled.last_check > self.check_interval:
+                pooled.connection.whoami_s()
+                pooled.last_check = now
+        except ldap.INVALID_CREDENTIALS:
+            raise
+        except ldap.LDAPError:
+            logging.debug("Discarding stale pooled LDAP connection")
+            return False
+        return True
+
+    def release(self, pooled, discard=False):
+        """
+            Give a connection back to the pool, or close it if the pool is full
+            or the connection is known to be broken.
+        """
+        with self._lock:
+            self._in_use -= 1
+            entries = self._idle.setdefault(pooled.key, [])
+            if not discard and len(entries) < self.max_per_user and \
+                    self._idle_count() + self._in_use < self.max_size:
+                pooled.last_used = time.monotonic()
+                entries.append(pooled)
+                return
+            if not entries:
+                del self._idle[pooled.key]
+        pooled.close()
+
+    def reap(self):
+        """
+            Close the connections that have been idle for too long.
+        """
+        expired = []
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for key in list(self._idle):
+                entries = self._idle[key]
+                expired += [entry for entry in entries
+                            if entry.last_used < deadline]
+                entries[:] = [entry for entry in entries
+                              if entry.last_used >= deadline]
+                if not entries:
+                    del self._idle[key]
+        for pooled in expired:
+            pooled.close()
+
+    def clear(self):
+        with self._lock:
+            pooled = [entry for entries in self._idle.values()
+                      for entry in entries]
+            self._idle = {}
+        for entry in pooled:
+            entry.close()
+
+    def get_domain_sid(self, server):
+        return self._domain_sids.get(server.lower())
+
+    def set_domain_sid(self, server, domain_sid):
+        self._domain_sids[server.lower()] = domain_sid
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import collections
+import re
+import time
+
+from flask import g, has_app_context, render_template
+
+# Kinds of operations, in the order Server-Timing lists them
+TRACE_OPERATIONS = ['bind', 'search', 'add', 'modify', 'delete', 'rename']
+
+_FILTER_VALUE = re.compile(r'=([^()]*)\)')
+
+
+def _filter_shape(ldap_filter):
+    """
+        Return the filter with its assertion values replaced by ?, so
+        queries differing only by what they look for compare equal.
+    """
+    if not ldap_filter:
+        return ldap_filter
+    return _FILTER_VALUE.sub(lambda match: "=*)" if match.group(1) == "*"
+                             else "=?)", ldap_filter)
+
+
+def _entries_size(entries):
+    size = 0
+    for dn, attributes in entries:
+        size += len(dn or "")
+        if isinstance(attributes, dict):
+            for name, values in attributes.items():
+                size += len(name) + sum(len(value) for value in values)
+    return size
+
+
+def _modlist_size(modlist):
+    size = 0
+    for item in modlist or []:
+        values = item[-1]
+        if isinstance(values, bytes):
+            size += len(values)
+        elif values:
+            size += sum(len(value) for value in values)
+    return size
+
+
+class LDAPOperation(object):
+    """
+        One operation sent to the directory during a request.
+        Asynchronous operations last from their submission to their result.
+    """
+
+    __slots__ = ('op', 'base', 'scope', 'filter', 'attrlist', 'count',
+                 'bytes', 'started', 'duration')
+
+    def __init__(self, op, base, scope=None, ldap_filter=None, attrlist=None):
+        self.op = op
+        self.base = base
+        self.scope = scope
+        self.filter = ldap_filter
+        self.attrlist = list(attrlist) if attrlist else None
+        self.count = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def finish(self, count=0, size=0):
+        self.count = count
+        self.bytes = size
+        self.duration = time.perf_counter() - self.started
+
+    @property
+    def shape(self):
+        return (self.op, self.scope, _filter_shape(self.filter),
+                tuple(self.attrlist or ()))
+
+
+class LDAPTrace(object):
+    """
+        The LDAP operations of a request, and the time it spent waiting on
+        the directory. A finished trace records nothing more, so what the
+        reporting itself asks for doesn't show up.
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.pending = {}
+        self.waiting = 0.0
+        self.started = time.perf_counter()
+        self.duration = None
+
+    @property
+    def finished(self):
+        return self.duration is not None
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+
+    def totals(self):
+        """
+            Return {kind: (count, seconds)} of the operations.
+        """
+        totals = collections.OrderedDict()
+        for kind in TRACE_OPERATIONS:
+            operations = [operation for operation in self.operations
+                          if operation.op == kind]
+            if operations:
+                totals[kind] = (len(operations), sum(
+                    operation.duration or 0 for operation in operations))
+        return totals
+
+    def server_timing(self):
+        """
+            Return the Server-Timing header value: the time spent waiting on
+            the directory, each kind of operation and the whole request.
+        """
+        metrics = ['ldap;dur=%.1f;desc="%d LDAP operations"' % (
+            self.waiting * 1000, len(self.operations))]
+        for kind, (count, seconds) in self.totals().items():
+            metrics.append('ldap-%s;dur=%.1f;desc="%d"' % (kind, seconds * 1000,
+                                                          count))
+        if self.duration is not None:
+            metrics.append('total;dur=%.1f' % (self.duration * 1000))
+        return ", ".join(metrics)
+
+    def repeated(self, threshold):
+        """
+            Return the (shape, operations) of the queries sent threshold
+            times or more with different bases or values, N+1 patterns
+            usually. Pages of one search don't count.
+        """
+        shapes = collections.OrderedDict()
+        for operation in self.operations:
+            shapes.setdefault(operation.shape, []).append(operation)
+        return [(shape, operations) for shape, operations in shapes.items()
+                if len({(operation.base, operation.filter)
+                        for operation in operations}) >= threshold]
+
+
+class LDAPTracedConnection(object):
+    """
+        Wraps a connection to record its operations in the trace of the
+        request it is used for. Connections outlive requests in the pool, so
+        the trace is looked up on every call and keeps the operations
+        waiting for their result.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def _call(self, operation, function, *args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return function(*args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            if operation is not None:
+                operation.finish()
+            raise
+        finally:
+            trace.waiting += time.perf_counter() - started
+            if operation is not None:
+                trace.operations.append(operation)
+
+    def _submit(self, operation, function, *args, **kwargs):
+        msgid = self._call(None, function, *args, **kwargs)
+        trace = current_trace()
+        if trace is not None:
+            trace.operations.append(operation)
+            trace.pending[(id(self), msgid)] = operation
+        return msgid
+
+    def simple_bind_s(self, who='', cred='', *args, **kwargs):
+        operation = LDAPOperation('bind', who)
+        result = self._call(operation, self._connection.simple_bind_s, who,
+                            cred, *args, **kwargs)
+        operation.finish(1)
+        return result
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, *args, **kwargs):
+        operation = LDAPOperation('search', base, scope, filterstr, attrlist)
+        result = self._call(operation, self._connection.search_s, base, scope,
+                            filterstr, attrlist, *args, **kwargs)
+        operation.finish(len([entry for entry in result if entry[0]]),
+                         _entries_size(result))
+        return result
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, *args, **kwargs):
+        return self._submit(LDAPOperation('search', base, scope, filterstr,
+                                          attrlist),
+                            self._connection.search_ext, base, scope,
+                            filterstr, attrlist, *args, **kwargs)
+
+    def add_s(self, dn, modlist, *args, **kwargs):
+        operation = LDAPOperation('add', dn, attrlist=[
+            item[0] for item in modlist])
+        result = self._call(operation, self._connection.add_s, dn, modlist,
+                            *args, **kwargs)
+        operation.finish(1, _modlist_size(modlist))
+        return result
+
+    def add(self, dn, modlist, *args, **kwargs):
+        operation = LDAPOperation('add', dn, attrlist=[
+            item[0] for item in modlist])
+        operation.bytes = _modlist_size(modlist)
+        return self._submit(operation, self._connection.add, dn, modlist,
+                            *args, **kwargs)
+
+    def modify_s(self, dn, modlist, *args, **kwargs):
+        operation = LDAPOperation('modify', dn, attrlist=[
+            item[1] for item in modlist])
+        result = self._call(operation, self._connection.modify_s, dn, modlist,
+                            *args, **kwargs)
+        operation.finish(1, _modlist_size(modlist))
+        return result
+
+    def modify(self, dn, modlist, *args, **kwargs):
+        operation = LDAPOperation('modify', dn, attrlist=[
+            item[1] for item in modlist])
+        operation.bytes = _modlist_size(modlist)
+        return self._submit(operation, self._connection.modify, dn, modlist,
+                            *args, **kwargs)
+
+    def delete_s(self, dn, *args, **kwargs):
+        operation = LDAPOperation('delete', dn)
+        result = self._call(operation, self._connection.delete_s, dn, *args,
+                            **kwargs)
+        operation.finish(1)
+        return result
+
+    def delete(self, dn, *args, **kwargs):
+        return self._submit(LDAPOperation('delete', dn),
+                            self._connection.delete, dn, *args, **kwargs)
+
+    def rename_s(self, dn, newrdn, newsuperior=None, *args, **kwargs):
+        operation = LDAPOperation('rename', dn)
+        result = self._call(operation, self._connection.rename_s, dn, newrdn,
+                            newsuperior, *args, **kwargs)
+        operation.finish(1)
+        return result
+
+    def rename(self, dn, newrdn, newsuperior=None, *args, **kwargs):
+        return self._submit(LDAPOperation('rename', dn),
+                            self._connection.rename, dn, newrdn, newsuperior,
+                            *args, **kwargs)
+
+    def result3(self, msgid=-1, *args, **kwargs):
+        result = self._wait(self._connection.result3, msgid, *args, **kwargs)
+        if msgid == -1:
+            # Any message, the result tells which one
+            self._finish(self._pop(result[2]), result[1])
+        return result
+
+    def result(self, msgid=-1, *args, **kwargs):
+        return self._wait(self._connection.result, msgid, *args, **kwargs)
+
+    def _wait(self, function, msgid, *args, **kwargs):
+        operation = self._pop(msgid)
+        try:
+            result = self._call(None, function, msgid, *args, **kwargs)
+        except Exception:
+            if operation is not None:
+                operation.finish()
+            raise
+        self._finish(operation, result[1])
+        return result
+
+    def _pop(self, msgid):
+        trace = current_trace()
+        if trace is None:
+            return None
+        return trace.pending.pop((id(self), msgid), None)
+
+    def _finish(self, operation, data):
+        if operation is None:
+            return
+        if operation.op == 'search':
+            operation.finish(len([entry for entry in data or [] if entry[0]]),
+                             _entries_size(data or []))
+        else:
+            operation.finish(1, operation.bytes)
+
+
+def trace_start():
+    """
+        Give the request a new trace.
+    """
+    g.ldap_trace = LDAPTrace()
+
+
+def trace_end():
+    """
+        Drop the trace of the request and the operations it was waiting for,
+        whether the request succeeded or not.
+    """
+    trace = g.pop('ldap_trace', None)
+    if trace is not None:
+        trace.finish()
+        trace.pending.clear()
+
+
+def current_trace():
+    """
+        Return the trace of the current request while it records, else None.
+    """
+    if not has_app_context():
+        return None
+    trace = g.get('ldap_trace')
+    if trace is None or trace.finished:
+        return None
+    return trace
+
+
+def trace_footer(response, trace, threshold):
+    """
+        Add the operations of the trace and its repeated queries at the end
+        of an HTML page.
+    """
+    if response.mimetype != 'text/html' or response.is_streamed or \
+            response.direct_passthrough:
+        return
+    html = response.get_data(as_text=True)
+    position = html.rfind("</body>")
+    if position < 0:
+        return
+    footer = render_template("ldap_trace.html", trace=trace,
+                             repeated=trace.repeated(threshold),
+                             threshold=threshold)
+    response.set_data(html[:position] + footer + html[position:])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import os
+import sqlite3
+import stat
+import tempfile
+
+
+def _check_private(path, info):
+    if info.st_uid != os.geteuid():
+        raise PermissionError("%s is owned by another user" % path)
+    if info.st_mode & 0o077:
+        raise PermissionError("%s is accessible to other users" % path)
+
+
+def private_directory(name):
+    """
+        Return the path of a directory only the user running the
+        application can use, created in the temporary directory if needed.
+        Raise PermissionError when it exists and belongs to someone else,
+        is a symbolic link or others may use it.
+    """
+    path = os.path.join(tempfile.gettempdir(),
+                        "%s-%d" % (name, os.geteuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError("%s isn't a directory" % path)
+    _check_private(path, info)
+    return path
+
+
+def connect_private(path, timeout=5):
+    """
+        Connect to the SQLite database in path, creating it readable and
+        writable by the current user only. Its content is trusted, so raise
+        sqlite3.DatabaseError when another user owns it or may write to it.
+    """
+    try:
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT |
+                             getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            _check_private(path, os.fstat(descriptor))
+        finally:
+            os.close(descriptor)
+    except OSError as e:
+        raise sqlite3.DatabaseError("Refusing to use %s: %s" % (path, e))
+    return sqlite3.connect(path, timeout=timeout)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import csv
+import io
+import itertools
+import os
+
+import ldap.dn
+import ldif
+from flask import g
+from libs.common import (get_encoded_list, get_valid_macs,
+                         password_error_messages, password_is_valid)
+from libs.ldap_func import (ldap_batch, ldap_get_entries_by_dn,
+                            ldap_get_entries_by_key)
+from settings import Settings
+
+# Rows validated and sent to the directory at once
+USER_IMPORT_CHUNK_SIZE = getattr(Settings, 'USER_IMPORT_CHUNK_SIZE', 200)
+
+USER_IMPORT_FORMATS = ['csv', 'ldif']
+
+# Attributes an imported user can be given, the ones of the add user form
+USER_IMPORT_ATTRIBUTES = ['givenName', 'sn', 'sAMAccountName', 'mail',
+                          'otherMailbox', 'manager', 'streetAddress',
+                          'otherHomePhone', 'otherMobile', 'otherTelephone',
+                          'employeeID', 'title', 'macAddress',
+                          'userAccountControl']
+
+# Attributes holding several values, separated by ';' in CSV files
+USER_IMPORT_MULTIVALUED = ['otherMailbox', 'otherHomePhone', 'otherMobile',
+                           'otherTelephone', 'macAddress']
+
+# Column or LDIF attribute holding the password in clear text
+USER_IMPORT_PASSWORD = 'password'
+
+# LDIF attributes that are derived from the others and left out
+USER_IMPORT_IGNORED = ['objectclass', 'cn', 'name', 'distinguishedname',
+                       'displayname', 'userprincipalname']
+
+# Longest values the add user form accepts
+USER_IMPORT_MAX_LENGTHS = {'givenName': 64, 'sn': 64, 'sAMAccountName': 20,
+                           'mail': 256}
+
+
+def user_attributes(values, domain):
+    """
+        Return the attributes a user is created with from values, a dict of
+        attribute: value or list of values, manager being a DN, jpegPhoto
+        bytes and userAccountControl an int (512 if missing).
+    """
+    attributes = {'objectClass': [b'top', b'ieee802Device', b'person',
+                                  b'organizationalPerson', b'user',
+                                  b'inetOrgPerson'],
+                  'UserPrincipalName': [("%s@%s" % (values['sAMAccountName'],
+                                                    domain)).encode('utf-8')],
+                  'accountExpires': [b"0"],
+                  'lockoutTime': [b"0"],
+                  'userAccountControl': [
+                      str(values.get('userAccountControl') or 512).encode(
+                          'utf-8')],
+                  }
+
+    for attribute, value in values.items():
+        if attribute == 'userAccountControl' or not value:
+            continue
+        if isinstance(value, bytes):
+            attributes[attribute] = [value]
+        elif isinstance(value, list):
+            attributes[attribute] = get_encoded_list(value)
+        else:
+            attributes[attribute] = [value.encode('utf-8')]
+
+    if values.get('sn'):
+        attributes['displayName'] = [
+            ("%s %s" % (values['givenName'], values['sn'])).encode('utf-8')]
+    else:
+        attributes['displayName'] = attributes['givenName']
+    return attributes
+
+
+def read_rows(stream, file_format):
+    """
+        Parse a binary stream of users in file_format one row at a time.
+        Rows are dicts with the line they start at, the values of
+        USER_IMPORT_ATTRIBUTES, the password, the DN for LDIF records and an
+        error if they can't be parsed.
+    """
+    if file_format == 'csv':
+        return _read_csv(stream)
+    if file_format == 'ldif':
+        return _read_ldif(stream)
+    raise ValueError("Unknown import format: %s" % file_format)
+
+
+def count_rows(stream, file_format):
+    """
+        Return the number of rows of the stream without validating them.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        if file_format == 'csv':
+            # Same reader as _read_csv(), which leaves out blank lines
+            return sum(1 for record in csv.DictReader(text))
+        return sum(1 for line in text if line.lower().startswith('dn:'))
+    finally:
+        text.detach()
+
+
+def import_users(rows, base, report, cancelled=None):
+    """
+        Validate and create the users of rows, USER_IMPORT_CHUNK_SIZE at a
+        time. CSV rows are created in base, LDIF records at their DN.
+        Each chunk is checked with one lookup of the managers it refers to,
+        then sent as pipelined adds followed by pipelined password sets.
+        report() gets the (name, error) of the rows of each chunk, error
+        being None for the users that were created.
+        Stops between two chunks once cancelled() returns True.
+    """
+    seen = set()
+    rows = iter(rows)
+    while True:
+        if cancelled and cancelled():
+            return
+        chunk = list(itertools.islice(rows, USER_IMPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        report(_import_chunk(chunk, base, seen))
+
+
+def import_users_job(job, path, file_format, base):
+    """
+        Job running import_users() on an uploaded file, which is deleted once
+        done as it holds passwords.
+    """
+    try:
+        with open(path, 'rb') as stream:
+            import_users(read_rows(stream, file_format), base, job.report,
+                         job.cancelled)
+    finally:
+        os.unlink(path)
+
+
+def _import_chunk(chunk, base, seen):
+    results = []
+    for row in chunk:
+        name = "%s (line %d)" % (row['values'].get('sAMAccountName') or '?',
+                                 row['line'])
+        results.append([name, row.get('error') or _validate(row, seen)])
+
+    managers = {row['values']['manager'] for row, result in zip(chunk, results)
+                if not result[1] and row['values'].get('manager')}
+    if managers:
+        # A manager is given by DN, as exported, or by sAMAccountName
+        by_dn = sorted(manager for manager in managers
+                       if ldap.dn.is_dn(manager))
+        by_name = sorted(managers.difference(by_dn))
+        manager_dns = {_manager_key(entry['distinguishedName']):
+                       entry['distinguishedName'] for entry in
+                       ldap_get_entries_by_dn(by_dn, 'exists') or []}
+        manager_dns.update({_manager_key(entry['sAMAccountName']):
+                            entry['distinguishedName'] for entry in
+                            ldap_get_entries_by_key('sAMAccountName', by_name,
+                                                    'exists') or []})
+        for row, result in zip(chunk, results):
+            manager = row['values'].get('manager')
+            if result[1] or not manager:
+                continue
+            if _manager_key(manager) in manager_dns:
+                row['values']['manager'] = manager_dns[_manager_key(manager)]
+            else:
+                result[1] = "That manager doesn't exists"
+
+    pending = []
+    for index, (row, result) in enumerate(zip(chunk, results)):
+        if result[1]:
+            continue
+        values = row['values']
+        dn = row.get('dn') or "cn=%s,%s" % (values['sAMAccountName'], base)
+        pending.append((index, dn, user_attributes(values, g.ldap['domain'])))
+
+    added = []
+    operations = [('add', dn, attributes) for index, dn, attributes in pending]
+    for (index, dn, attributes), (_, error) in zip(pending,
+                                                   ldap_batch(operations)):
+        if error:
+            results[index][1] = error
+        else:
+            added.append((index, dn))
+
+    operations = [('password', dn, chunk[index]['password'])
+                  for index, dn in added]
+    for (index, dn), (_, error) in zip(added, ldap_batch(operations)):
+        if error:
+            results[index][1] = "Created but the password wasn't set: %s" \
+                % error
+
+    return [tuple(result) for result in results]
+
+
+def _manager_key(manager):
+    """
+        Return what manager is matched on, DNs being compared whatever
+        their case and spacing.
+    """
+    if ldap.dn.is_dn(manager):
+        return ldap.dn.dn2str(ldap.dn.str2dn(manager)).lower()
+    return manager.lower()
+
+
+def _validate(row, seen):
+    values = row['values']
+    for attribute in ('sAMAccountName', 'givenName'):
+        if not values.get(attribute):
+            return "Missing %s" % attribute
+    for attribute, length in USER_IMPORT_MAX_LENGTHS.items():
+        if len(values.get(attribute) or '') > length:
+            return "%s is longer than %d characters" % (attribute, length)
+
+    username = values['sAMAccountName'].lower()
+    if username in seen:
+        return "%s is already in the file" % values['sAMAccountName']
+    seen.add(username)
+
+    if not row.get('password'):
+        return "Missing password"
+    password_validation = password_is_valid(row['password'])
+    if password_validation:
+        return ", ".join(password_error_messages(password_validation))
+
+    if values.get('macAddress'):
+        macs = get_valid_macs(values['macAddress'], report=False)
+        if macs['invalid']:
+            return "Invalid MAC address: %s" % ", ".join(macs['invalid'])
+        values['macAddress'] = macs['valid']
+
+    if values.get('userAccountControl'):
+        try:
+            values['userAccountControl'] = int(values['userAccountControl'])
+        except ValueError:
+            return "userAccountControl must be a number"
+    return None
+
+
+def _row(line, values, dn=None):
+    """
+        Map the attribute names of a parsed row, whatever their case, to
+        USER_IMPORT_ATTRIBUTES.
+    """
+    attributes = {attribute.lower(): attribute
+                  for attribute in USER_IMPORT_ATTRIBUTES}
+    row = {'line': line, 'values': {}, 'password': None, 'dn': dn}
+    for key, value in values.items():
+        key = (key or '').strip()
+        if key.lower() == USER_IMPORT_PASSWORD:
+            row['password'] = value[0] if value else None
+        elif key.lower() in attributes:
+            attribute = attributes[key.lower()]
+            if attribute in USER_IMPORT_MULTIVALUED:
+                row['values'][attribute] = value
+            else:
+                row['values'][attribute] = value[0] if value else None
+        elif key.lower() not in USER_IMPORT_IGNORED and value:
+            row.setdefault('error', "Unknown attribute: %s" % key)
+    return row
+
+
+def _read_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    multivalued = [attribute.lower() for attribute in USER_IMPORT_MULTIVALUED]
+    reader = csv.DictReader(text)
+    for record in reader:
+        values = {}
+        for key, value in record.items():
+            # Cells past the header end up in a list under None
+            if isinstance(value, list):
+                value = ";".join(value)
+            value = value or ''
+            name = (key or '').strip().lower()
+            if name == USER_IMPORT_PASSWORD:
+                # Taken as it is written, spaces and ';' included
+                values[key] = [value] if value else []
+            elif name in multivalued:
+                values[key] = [item.strip() for item in value.split(';')
+                               if item.strip()]
+            else:
+                values[key] = [value.strip()] if value.strip() else []
+        yield _row(reader.line_num, values)
+
+
+def _read_ldif(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    lines = []
+    first_line = None
+    for number, line in enumerate(itertools.chain(text, ['']), start=1):
+        if line.strip():
+            if first_line is None:
+                first_line = number
+            lines.append(line)
+            continue
+        if not lines:
+            continue
+
+        # One record at a time, python-ldap takes care of base64 and folding
+        parser = ldif.LDIFRecordList(io.StringIO("".join(lines)))
+        try:
+            parser.parse()
+        except ValueError as e:
+            yield {'line': first_line, 'values': {}, 'password': None,
+                   'error': "Can't parse the record: %s" % e}
+        else:
+            for dn, entry in parser.all_records:
+                try:
+                    values = {key: [value.decode('utf-8') for value in values]
+                              for key, values in entry.items()}
+                except UnicodeDecodeError:
+                    yield {'line': first_line, 'values': {}, 'password': None,
+                           'error': "Values must be UTF-8 text"}
+                    continue
+                yield _row(first_line, values, dn)
+        lines = []
+        first_line = None
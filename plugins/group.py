@@ -23,16 +23,20 @@ from flask import abort, flash, g, redirect, render_template, request
 from flask_wtf import FlaskForm
 from libs.common import iri_for as url_for
 from libs.common import namefrom_dn
-from libs.ldap_func import (LDAP_AD_GROUPTYPE_VALUES, ldap_add_users_to_group,
-                            ldap_auth, ldap_create_entry, ldap_delete_entry,
-                            ldap_get_entry_simple, ldap_get_group,
-                            ldap_get_members, ldap_get_membership,
-                            ldap_group_exists, ldap_in_group,
-                            ldap_update_attribute)
+from libs.ldap_func import (LDAP_AD_GROUPTYPE_VALUES, ldap_add_group_members,
+                            ldap_apply_changes, ldap_auth, ldap_create_entry,
+                            ldap_delete_entry, ldap_forget_authorizations,
+                            ldap_get_entries_by_dn, ldap_get_entry_simple,
+                            ldap_get_group, ldap_get_members,
+                            ldap_get_membership, ldap_group_exists,
+                            ldap_group_has_member, ldap_in_group,
+                            ldap_remove_group_members)
 from settings import Settings
 from wtforms import RadioField, StringField, TextAreaField
 from wtforms.validators import DataRequired
 
+MEMBERS_PER_PAGE = getattr(Settings, 'MEMBERS_PER_PAGE', 100)
+
 
 class GroupDelMember(FlaskForm):
     pass
@@ -118,25 +122,25 @@ def init(app):
         group_fields = [('sAMAccountName', "Name"),
                         ('description', u"Description")]
 
-        group = ldap_get_group(groupname=groupname)
+        group = ldap_get_group(groupname=groupname, attrlist='group_overview')
 
         admin = ldap_in_group(Settings.ADMIN_GROUP) and not group['groupType'] & 1
 
-        group_details = [ldap_get_group(entry, 'distinguishedName')
+        group_details = [ldap_get_group(entry, 'distinguishedName', 'tree')
                          for entry in ldap_get_membership(groupname)]
 
         group_details = list(filter(None, group_details))
         groups = sorted(group_details, key=lambda entry: entry['sAMAccountName'])
 
-        member_list = []
-        for entry in ldap_get_members(groupname):
-            member = ldap_get_entry_simple({'distinguishedName': entry})
-            if 'sAMAccountName' not in member:
-                continue
-            member_list.append(member)
+        # Only the members shown on the page are read, in bulk
+        member_dns = sorted(ldap_get_members(groupname),
+                            key=lambda entry: namefrom_dn(entry).lower())
+        pages = max(1, -(-len(member_dns) // MEMBERS_PER_PAGE))
+        page = min(max(request.args.get('page', 1, type=int), 1), pages)
+        page_dns = member_dns[(page - 1) * MEMBERS_PER_PAGE:page * MEMBERS_PER_PAGE]
 
-        members = sorted(member_list, key=lambda entry:
-                         entry['sAMAccountName'])
+        members = [member for member in ldap_get_entries_by_dn(page_dns, 'tree')
+                   if 'sAMAccountName' in member]
 
         parent = ",".join(group['distinguishedName'].split(',')[1:])
         parent_name = namefrom_dn(parent)
@@ -144,7 +148,8 @@ def init(app):
                                group=group, identity_fields=identity_fields,
                                group_fields=group_fields, admin=admin,
                                groups=groups, members=members, parent=parent,
-                               parent_name=parent_name,
+                               parent_name=parent_name, page=page, pages=pages,
+                               member_count=len(member_dns),
                                grouptype_values=LDAP_AD_GROUPTYPE_VALUES)
 
     @app.route('/group/<groupname>/+delete', methods=['GET', 'POST'])
@@ -160,7 +165,7 @@ def init(app):
 
         if form.validate_on_submit():
             try:
-                group = ldap_get_group(groupname=groupname)
+                group = ldap_get_group(groupname=groupname, attrlist='exists')
                 ldap_delete_entry(group['distinguishedName'])
                 flash(u"Group removed successfully.", "success")
                 return redirect(url_for('core_index'))
@@ -207,31 +212,23 @@ def init(app):
 
         if form.validate_on_submit():
             try:
+                changes = {}
+                new_rdn = None
                 for attribute, field in field_mapping:
                     value = field.data
-                    if value != group.get(attribute):
-                        if attribute == 'sAMAccountName':
+                    if attribute == 'sAMAccountName':
+                        if value != group.get(attribute):
                             # Rename the account
-                            ldap_update_attribute(group['distinguishedName'],
-                                                  "sAMAccountName", value)
+                            changes[attribute] = value
                             # Finish by renaming the whole record
-                            dn: str = group['distinguishedName'].split(",", 1)[1]
-                            dn = "CN={0},{1}".format(value, dn)
-                            ldap_update_attribute(group['distinguishedName'],
-                                                  "distinguishedName", "CN={0}".format(value))
-                            group['distinguishedName'] = dn
-                        elif attribute == "groupType":
-                            group_type = int(form.group_type.data) + \
-                                int(form.group_flags.data)
-                            ldap_update_attribute(
-                                group['distinguishedName'], attribute,
-                                str(
-                                    struct.unpack(
-                                        "i", struct.pack(
-                                            "I", int(group_type)))[0]))
-                        elif attribute:
-                            ldap_update_attribute(group['distinguishedName'],
-                                                  attribute, value)
+                            new_rdn = "CN={0}".format(value)
+                    elif attribute == "groupType":
+                        changes[attribute] = int(form.group_type.data) + \
+                            int(form.group_flags.data)
+                    elif attribute:
+                        changes[attribute] = value
+
+                ldap_apply_changes(group, changes, new_rdn)
 
                 flash(u"Successfully modified group.", "success")
                 return redirect(url_for('group_overview',
@@ -271,24 +268,24 @@ def init(app):
         form.visible_fields = [form.new_members]
 
         if form.validate_on_submit():
-            group = ldap_get_group(groupname)
-            if 'member' in group:
-                entries = set(group['member'])
-            else:
-                entries = set()
+            group = ldap_get_group(groupname, attrlist='exists')
 
+            new_members = []
             for line in form.new_members.data.split("\n"):
-                entry = ldap_get_entry_simple({'sAMAccountName': line.strip()})
+                entry = ldap_get_entry_simple({'sAMAccountName': line.strip()},
+                                              'exists')
                 if not entry:
                     error = u"Invalid username: %s" % line
                     flash(error, "error")
                     break
 
-                entries.add(entry['distinguishedName'])
+                new_members.append(entry)
             else:
                 try:
-                    ldap_add_users_to_group(group['distinguishedName'],
-                                          "member", list(entries))
+                    ldap_add_group_members(group['distinguishedName'],
+                                           [entry['distinguishedName']
+                                            for entry in new_members])
+                    ldap_forget_authorizations(new_members)
                     flash("Added users.", "success")
                     return redirect(url_for('group_overview',
                                             groupname=groupname))
@@ -309,24 +306,25 @@ def init(app):
     def group_delmember(groupname, member):
         title = "Remove from group"
 
-        group = ldap_get_group(groupname)
-        if not group or 'member' not in group:
+        group = ldap_get_group(groupname, attrlist='exists')
+        if not group:
             abort(404)
 
-        member = ldap_get_entry_simple({'sAMAccountName': member})
+        member = ldap_get_entry_simple({'sAMAccountName': member}, 'exists')
         if not member:
             abort(404)
 
-        if not member['distinguishedName'] in group['member']:
+        if not ldap_group_has_member(group['distinguishedName'],
+                                     member['distinguishedName']):
             abort(404)
 
         form = GroupDelMember(request.form)
 
         if form.validate_on_submit():
             try:
-                members = group['member']
-                members.remove(member['distinguishedName'])
-                ldap_update_attribute(group['distinguishedName'],"member", members)
+                ldap_remove_group_members(group['distinguishedName'],
+                                          [member['distinguishedName']])
+                ldap_forget_authorizations([member])
                 flash("Member of group X %s eliminated" % group['sAMAccountName'], "success")
                 return redirect(url_for('user_overview', username=member['sAMAccountName']))
             except ldap.LDAPError as e:
@@ -0,0 +1,47 @@
+from flask import abort, g, jsonify, redirect, render_template, request
+from flask_wtf import FlaskForm
+from libs.common import iri_for as url_for
+from libs.common import local_url
+from libs.jobs import JOB_QUEUED, JOB_RUNNING, job_runner
+from libs.ldap_func import ldap_auth
+from settings import Settings
+
+
+class JobCancel(FlaskForm):
+    pass
+
+
+def init(app):
+    def get_job(job_id, offset=0):
+        """
+        returns the job if it was submitted by the current user, aborts with a 404 otherwise
+        """
+        job = job_runner.get(job_id, offset)
+        if not job or job['owner'].lower() != g.ldap['username'].lower():
+            abort(404)
+        return job
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def job_overview(job_id):
+        job = get_job(job_id)
+        form = JobCancel(request.form)
+        return render_template("pages/job_es.html", title=job['title'],
+                               job=job, form=form,
+                               running=job['status'] in (JOB_QUEUED, JOB_RUNNING),
+                               parent=local_url(request.args.get('parent'), url_for('tree_base')))
+
+    @app.route('/jobs/<job_id>/+status', methods=['GET'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def job_status(job_id):
+        offset = request.args.get('offset', 0, type=int)
+        return jsonify(get_job(job_id, offset))
+
+    @app.route('/jobs/<job_id>/+cancel', methods=['POST'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def job_cancel(job_id):
+        get_job(job_id)
+        form = JobCancel(request.form)
+        if form.validate_on_submit():
+            job_runner.cancel(job_id)
+        return redirect(url_for('job_overview', job_id=job_id))
@@ -2,8 +2,8 @@ from urllib import parse
 import ldap
 from flask import jsonify, request, flash, redirect, url_for, render_template
 from libs.common import namefrom_dn
-from libs.ldap_func import (ldap_auth, ldap_create_entry, ldap_delete_entry,
-                            ldap_get_ou, ldap_ou_exists, ldap_update_attribute)
+from libs.ldap_func import (ldap_apply_changes, ldap_auth, ldap_create_entry,
+                            ldap_delete_entry, ldap_get_ou, ldap_ou_exists)
 from settings import Settings
 from flask_cors import cross_origin, CORS
 from flask_wtf import FlaskForm
@@ -64,7 +64,7 @@ def init(app):
 
         if form.validate_on_submit():
             try:
-                ou = ldap_get_ou(ou_name=ou_name)
+                ou = ldap_get_ou(ou_name=ou_name, attrlist='exists')
                 ldap_delete_entry(ou['distinguishedName'])
                 flash(u"OU removed successfully.", "success")
                 return redirect(url_for('tree_base'))
@@ -99,21 +99,18 @@ def init(app):
 
         if form.validate_on_submit():
             try:
+                changes = {}
+                new_rdn = None
                 for attribute, field in field_mapping:
                     value = field.data
-                    if value != ou.get(attribute):
-                        if attribute == 'distinguishedName':
-                            dn: str = ou['distinguishedName'].split(",", 1)[1]
-                            dn = "OU={0},{1}".format(value, dn)
-                            ldap_update_attribute(ou['distinguishedName'],
-                                                  "distinguishedName", "OU={0}".format(value))
-                            ou['distinguishedName'] = dn
-                        elif attribute:
-                            ldap_update_attribute(ou['distinguishedName'],
-                                                  attribute, value)
+                    if attribute == 'distinguishedName':
+                        new_rdn = "OU={0}".format(value)
+                    elif attribute:
+                        changes[attribute] = value
 
+                dn = ldap_apply_changes(ou, changes, new_rdn)
                 flash(u"Successfully modified OU.", "success")
-                return redirect(url_for('tree_base', base=ou['distinguishedName']))
+                return redirect(url_for('tree_base', base=dn))
 
             except ldap.LDAPError as e:
                 e = dict(e.args[0])
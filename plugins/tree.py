@@ -1,28 +1,40 @@
 from cgitb import reset
+import itertools
+import logging
 from fnmatch import translate
 from time import process_time_ns
 from urllib import parse, response
 from warnings import filters
+import time
 
 import ldap
-from flask import (Flask, abort, flash, g, jsonify, redirect, render_template,
-                   request)
+from flask import (Flask, Response, abort, flash, g, jsonify, redirect,
+                   render_template, request, stream_with_context)
 from flask_cors import CORS
 from flask_wtf import FlaskForm
+from itsdangerous import BadSignature, URLSafeSerializer
+from ldap.filter import escape_filter_chars
 from libs.common import get_objclass
 from libs.common import iri_for as url_for
 from libs.common import namefrom_dn
-from libs.ldap_func import (ldap_auth, ldap_delete_entry, ldap_get_entries,
-                            ldap_get_group, ldap_get_ou, ldap_get_user,
-                            ldap_in_group, ldap_obj_has_children,
-                            ldap_update_attribute, move)
+from libs.export import (EXPORT_DEFAULT_ATTRIBUTES, EXPORT_FORMATS,
+                         EXPORT_OBJECTS, export_entries, parse_attributes)
+from libs.jobs import ldap_batch_job, submit_ldap_job
+from libs.ldap_func import (LDAP_PAGE_SIZE, ldap_auth, ldap_get_entries,
+                            ldap_in_group, move)
 from settings import Settings
 from wtforms import SelectField, StringField, SubmitField
+from wtforms.validators import DataRequired
+
+
+SEARCH_MATCHES = [('contains', 'Contains'), ('startswith', 'Starts with'),
+                  ('exact', 'Exact match')]
 
 
 class FilterTreeView(FlaskForm):
     filter_str = StringField()
     filter_select = SelectField(choices=Settings.SEARCH_ATTRS)
+    filter_match = SelectField(choices=SEARCH_MATCHES)
     search = SubmitField('Search')
 
 
@@ -40,7 +52,17 @@ class BatchMoveToRoot(FlaskForm):
 class BatchMoveOneLevelUp(FlaskForm):
     up_aLevel = SubmitField("Move One Level Up")
 
+
+class TreeExport(FlaskForm):
+    objects = SelectField('Entries', choices=[(key, value[0]) for key, value in EXPORT_OBJECTS.items()])
+    attributes = StringField('Attributes', [DataRequired()],
+                             default=EXPORT_DEFAULT_ATTRIBUTES)
+    file_format = SelectField('Format', choices=[(key, value[0]) for key, value in EXPORT_FORMATS.items()])
+
 def init(app):
+    selection_serializer = URLSafeSerializer(app.config['SECRET_KEY'],
+                                             salt='tree-selection')
+
     @app.route('/tree', methods=['GET', 'POST'])
     @app.route('/tree/<base>', methods=['GET', 'POST'])
     @ldap_auth("Domain Users")
@@ -73,27 +95,26 @@ def init(app):
             moveToRoot = BatchMoveToRoot()
             moveOneLevelUp = BatchMoveOneLevelUp()
 
+            search_info = None
             if form.search.data and form.validate():
                 filter_str = form.filter_str.data
                 filter_select = form.filter_select.data
                 scope = "subtree"
-                entries = get_entries(filter_str, filter_select, base, scope)
-                print('1',entries)    
+                started = time.perf_counter()
+                entries = get_entries(filter_str, filter_select, base, scope,
+                                      form.filter_match.data)
+                search_info = {'count': len(entries),
+                               'elapsed': (time.perf_counter() - started) * 1000}
             else:
                 filter_str = None
                 scope = "onelevel"
-                entries = get_entries("top", "objectClass", base, scope)
+                entries = get_entries(None, None, base, scope)
            #TODO: batch delete confirmation page
            ##batch delete
             if batch_delete.delete.data:
                 checkedData = request.form.getlist("checkedItems") #returns an array of Strings, tho the strings have dict format
                 toDelete = translation(checkedData)
-                try:
-                    deleted_list = delete_batch(toDelete)
-                    flash_amount(deleted_list, deleted=True)
-                except ldap.LDAPError as e:
-                    flash(e,"error")
-                return redirect(url_for('tree_base', base=base))
+                return show_job(delete_batch(toDelete), url_for('tree_base', base=base))
             ##batch move (1 in)
             elif paste.paste.data:
                 checkedData = request.form.getlist("checkedItems")
@@ -102,60 +123,96 @@ def init(app):
                 moveTo = parse.unquote(moveTo.split("tree/")[1])
                 print(moveTo)
                 toMove = translation(checkedData)
-                try:
-                    moved_list = move_batch(toMove,moveTo)
-                    flash_amount(moved_list,deleted=False)
-                except ldap.LDAPError as e:
-                    e = dict(e.args[0])
-                    flash(e['info'], "error")
-                return redirect(url_for('tree_base', base=base))
+                return show_job(move_batch(toMove,moveTo), url_for('tree_base', base=base))
             ##batch move (to root)
             elif moveToRoot.toRoot.data:
                 checkedData = request.form.getlist("checkedItems")
                 moveTo = g.ldap['search_dn']
                 print(checkedData)
                 toMove = translation(checkedData)
-                try:
-                    moved_list = move_batch(toMove,moveTo)
-                    flash_amount(moved_list, deleted=False)
-                except ldap.LDAPError as e:
-                    e = dict(e.args[0])
-                    flash(e['info'], "error")
-                return redirect(url_for('tree_base'))
+                return show_job(move_batch(toMove,moveTo), url_for('tree_base'))
             ##batch move (1 out)
             elif moveOneLevelUp.up_aLevel.data:
                 checkedData = request.form.getlist("checkedItems")
                 moveTo = parse.unquote(parent)
                 toMove = translation(checkedData)
-                try:
-                    moved_list = move_batch(toMove,moveTo)
-                    flash_amount(moved_list, deleted=False)
-                    pass
-                except ldap.LDAPError as e:
-                    e = dict(e.args[0])
-                    flash(e['info'], "error")
-                return redirect(url_for('tree_base', base=base))
+                return show_job(move_batch(toMove,moveTo), url_for('tree_base', base=base))
 
         name = namefrom_dn(base)
         objclass = get_objclass(base)
         return render_template("pages/tree_base_es.html", form=form, parent=parent, batch_delete=batch_delete,
                                 paste=paste,moveOneLevelUp=moveOneLevelUp,moveToRoot=moveToRoot,
                                 admin=admin, base=base.upper(), entries=entries,entry_fields=entry_fields, 
-                               root=g.ldap['search_dn'].upper(), name=name, objclass=objclass)
+                               root=g.ldap['search_dn'].upper(), name=name, objclass=objclass,
+                               search_info=search_info)
+
+    @app.route('/tree/<base>/+export', methods=['GET', 'POST'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def tree_export(base):
+        title = "Export %s" % namefrom_dn(base)
+        form = TreeExport(request.form)
+        form.visible_fields = [form.objects, form.attributes, form.file_format]
+        if form.validate_on_submit():
+            try:
+                attributes = parse_attributes(form.attributes.data)
+                chunks = export_entries(base, form.objects.data, attributes,
+                                        form.file_format.data)
+                # The first chunk is read here so a search that fails right
+                # away is reported on the form instead of as a broken download
+                first = next(chunks, "")
+                _, mimetype, extension = EXPORT_FORMATS[form.file_format.data]
+                filename = "%s.%s" % (namefrom_dn(base), extension)
+                return Response(stream_with_context(itertools.chain([first], chunks)),
+                                mimetype=mimetype,
+                                headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
+            except ValueError as e:
+                flash(str(e), "error")
+            except ldap.LDAPError as e:
+                e = dict(e.args[0])
+                flash(e.get('info') or e.get('desc'), "error")
+                logging.exception("Got an exception")
+        elif form.errors:
+            flash("Some fields failed validation.", "error")
 
-    def get_entries(filter_str, filter_select, base, scope):
+        return render_template("forms/basicform.html", form=form, title=title,
+                               action="Export",
+                               parent=url_for('tree_base', base=base))
+
+    def get_search_filter(filter_str, filter_select, filter_match):
+        """
+        Build the LDAP filter for a tree search, the users whose
+        ``filter_select`` attribute contains, starts with or is ``filter_str``
+        """
+        value = escape_filter_chars(filter_str or "")
+        if not value:
+            condition = "(%s=*)" % filter_select
+        elif filter_match == "exact":
+            condition = "(%s=%s)" % (filter_select, value)
+        elif filter_match == "startswith":
+            condition = "(%s=%s*)" % (filter_select, value)
+        else:
+            condition = "(%s=*%s*)" % (filter_select, value)
+        return "(&(objectClass=user)(sAMAccountName=*)%s)" % condition
+
+    def get_entries(filter_str, filter_select, base, scope, filter_match="contains"):
         """
-        Get all entries that will be displayed in the tree
+        Get all entries that will be displayed in the tree.
+        Without ``filter_str`` every child of ``base`` is listed, otherwise only the users
+        matching the search, which is done by the directory server
         """
         result = []
 
-        entries = ldap_get_entries("objectClass=top", base, scope, ignore_erros=True)
+        if filter_select:
+            ldap_filter = get_search_filter(filter_str, filter_select, filter_match)
+        else:
+            ldap_filter = "objectClass=top"
+        entries = ldap_get_entries(ldap_filter, base, scope, attrlist='tree',
+                                   ignore_erros=True, page_size=LDAP_PAGE_SIZE,
+                                   expand_primary_group=False)
         users = filter(lambda entry: 'sAMAccountName' in entry, entries)
         users = filter(lambda entry: 'user' in entry['objectClass'], users)
-        users = filter(lambda entry: filter_select in entry, users)
-        users = filter(lambda entry: filter_str in entry[filter_select], users)
         users = sorted(users, key=lambda entry: entry['sAMAccountName'])
-        if filter_str == "top":
+        if not filter_select:
             other_entries = filter(lambda entry: 'user' not in entry['objectClass'], entries)
             other_entries = sorted(other_entries, key=lambda entry: entry['name'])
         
@@ -210,99 +267,85 @@ def init(app):
             if 'showInAdvancedViewOnly' in entry and entry['showInAdvancedViewOnly']:
                 continue
             result.append(entry)
+
+        # What translation() needs is carried, signed, by the checkbox of the entry
+        for entry in result:
+            entry['__selection'] = selection_serializer.dumps({
+                'name': entry['name'], 'type': entry['__type'],
+                'dn': entry['distinguishedName']})
         return result
 
     def translation(checkedData:list):
         '''
-        recieves a list of strings with format 
-        ``["{name:<>, type:<>, target:<>}",...]`` \n
+        recieves a list of the signed selections set as value of the checkboxes by ``get_entries()``
         and translates them into dicts with keys: 
-        ``name``, ``type``, ``username``(except if type is Organization Unit), and ``dn``;
-        extracted from those string
+        ``name``, ``type`` and ``dn``;
+        the directory isn't asked for anything, a selection whose signature doesn't match is skipped with an error flash
         and returns them in a new list
         '''
 
         translated = []
         for x in checkedData:
-            dicts = {}
-            key1 = x.split("name:'")[1].split("'")[0] #name of the object
-            key2 = x.split("type:'")[1].split("'")[0] #User, Group, Organization Unit, Container
-            key3 = x.split("target:'")[1].replace("'}", "")
-            key4 = parse.unquote(key3.split("/")[2]) #username
-            if key2 == "User":
-                user = ldap_get_user(username=key4)
-                key5 = user['distinguishedName']
-            elif key2 == "Group":
-                group = ldap_get_group(groupname=key1)
-                key5 = group['distinguishedName']
-            elif key2 == "Organization Unit":
-                key5 = parse.unquote(key4)
-            dicts['name'] = key1
-            dicts['type'] = key2
-            if key2 != 'Organization Unit':
-                dicts['username'] = key4
-            dicts['dn'] = key5
-            translated.append(dicts)
+            try:
+                translated.append(selection_serializer.loads(x))
+            except BadSignature:
+                flash("Invalid selection, reload the page and try again", "error")
         return translated
     
     def delete_batch(translatedList:list):
         """
         Deletes the objects in the ``translatedList`` and saves the names of each element on a list to be returned
-        OU objects with children will not be deleted and will have an error flash
+        OU objects with children are refused by the server, the job reports them as failed
+        The deletes run in a background job, see ``run_batch()``
         \n
         recieves a ``translatedList`` with the format returned by ``translation()``
         \n
-        Return: a list with the names of the deleted elements
+        Return: the id of the job or None if nothing can be deleted
         """
-        deleted_list=[]
+        operations = []
+        names = []
         for obj in translatedList:
-            #since now there is a dn key there is no need to check what type is the current element to user the
-            #ldap_get_ou(), ldap_get_user(), ldap_get_group() just to get their dn
             if obj['type'] != 'Container':
-                if obj['type'] != "Organization Unit":
-                    ldap_delete_entry(obj['dn'])
-                    deleted_list.append(obj['name'])
-                else:
-                    canDelete = not ldap_obj_has_children(obj['dn'])
-                    if canDelete:
-                        ldap_delete_entry(obj['dn'])
-                        deleted_list.append(obj['name'])
-                    else:
-                        flash(f"Can't delete OU: '{obj['name']}' because is not empty", "error")
+                operations.append(('delete', obj['dn']))
+                names.append(obj['name'])
             else:
                 flash(f"Can't delete {obj['name']} Container", "error")
-        return deleted_list
+        return run_batch(operations, names, "delete")
 
     def move_batch(translatedList: list, moveTo: str):
         """moves the elements from the list to the selected OU
+        The moves run in a background job, see ``run_batch()``
 
         Args:
-            translatedList (list): _description_
-            moveTo (str): _description_
+            translatedList (list): elements as returned by ``translation()``
+            moveTo (str): DN of the new parent
 
         Returns:
-            a list with the names of the moved elements
+            the id of the job or None if there is nothing to move
         """
-        print(moveTo)
-        moved_list = []
+        operations = []
+        names = []
         for obj in translatedList:
-            moved_list.append(obj['name'])
-            ldap_update_attribute(dn=obj["dn"], attribute="distinguishedName", value=obj["dn"].split(",")[0], new_parent=moveTo)
-            #since now there is a dn key there is no need to check what type is the current element to user the 
-            #ldap_get_ou(), ldap_get_user(), ldap_get_group() just to get their dn
-        return moved_list
-    
-    def flash_amount(namesList:list, deleted:bool):
+            operations.append(('rename', obj["dn"], obj["dn"].split(",")[0], moveTo))
+            names.append(obj['name'])
+        return run_batch(operations, names, "move")
+
+    def run_batch(operations: list, names: list, action: str):
         """
-        flashes how many elements were moved/deleted
-        recieves the list returned by ``move_batch()`` or ``delete_batch()`` and an extra argument to know if elements were moved or deleted
+        submits a background job running the ``operations`` with ``ldap_batch()``
+        \n
+        Return: the id of the job or None if there is nothing to do
         """
-        if deleted:
-            action = "deleted"
-        else:
-            action = "moved"
-        if len(namesList):
-            if len(namesList) == 1:
-                flash("1 element "+ action+ " successfully.", "success")
-            else:
-                flash(f"{len(namesList)} elements " +action+ " successfully", "success")
+        if not operations:
+            return None
+        title = f"{action.capitalize()} {len(operations)} element" + ("s" if len(operations) > 1 else "")
+        return submit_ldap_job(title, len(operations), ldap_batch_job,
+                               operations, names)
+
+    def show_job(job_id, parent: str):
+        """
+        redirects to the progress page of the job, or back to ``parent`` if no job was submitted
+        """
+        if not job_id:
+            return redirect(parent)
+        return redirect(url_for('job_overview', job_id=job_id, parent=parent))
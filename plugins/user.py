@@ -1,27 +1,35 @@
-import base64
-from io import BytesIO
 import logging
+import os
+import tempfile
 
 import ldap
-from flask import abort, flash, g, redirect, render_template, request
+from flask import (Response, abort, flash, g, jsonify, redirect,
+                   render_template, request)
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField
-from libs.common import (flash_password_errors, get_attr, get_encoded_list,
+from libs.common import (flash_password_errors, get_attr,
                          get_parsed_pager_attribute, get_valid_macs)
 from libs.common import iri_for as url_for
 from libs.common import namefrom_dn, password_is_valid
-from libs.ldap_func import (LDAP_AD_USERACCOUNTCONTROL_VALUES, ldap_auth,
-                            ldap_change_password, ldap_create_entry,
-                            ldap_delete_entry, ldap_get_all_users,
+from libs.images import (PHOTO_MAX_AGE, InvalidPhoto, photo_etag, photo_size,
+                         photo_thumbnail, process_photo, read_upload)
+from libs.jobs import submit_ldap_job
+from libs.ldap_func import (LDAP_AD_USERACCOUNTCONTROL_VALUES,
+                            LDAP_GROUP_SEARCH_MIN_PREFIX,
+                            ldap_add_group_members, ldap_apply_changes,
+                            ldap_auth, ldap_change_password, ldap_create_entry,
+                            ldap_delete_entry, ldap_forget_authorizations,
                             ldap_get_entries, ldap_get_entry_simple,
-                            ldap_get_group, ldap_get_membership, ldap_get_user,
-                            ldap_in_group, ldap_update_attribute,
+                            ldap_get_group, ldap_get_membership,
+                            ldap_get_user, ldap_in_group, ldap_search_groups,
+                            ldap_suggest_users, ldap_update_attribute,
                             ldap_user_exists)
-from PIL import Image
+from libs.user_import import (USER_IMPORT_FORMATS, count_rows,
+                              import_users_job, user_attributes)
 from settings import Settings
-from wtforms import (BooleanField, DecimalField, EmailField, IntegerField,
-                     PasswordField, SelectField, SelectMultipleField,
-                     StringField, TextAreaField)
+from wtforms import (DecimalField, EmailField, HiddenField,
+                     IntegerField, PasswordField, SelectField,
+                     SelectMultipleField, StringField, TextAreaField)
 from wtforms.validators import DataRequired, EqualTo, Length, Optional
 
 
@@ -30,7 +38,7 @@ class UserSSHEdit(FlaskForm):
 
 
 class UserAddGroup(FlaskForm):
-    available_groups = SelectField('Groups')
+    group_dn = HiddenField('Group')
 
 
 class UserProfileEdit(FlaskForm):
@@ -75,6 +83,13 @@ class UserAdd(UserProfileEdit):
                                               message=u'Passwords must match')])
 
 
+class UserImport(FlaskForm):
+    multipart = True
+    users_file = FileField('CSV or LDIF file')
+    file_format = SelectField('Format', choices=[(file_format, file_format.upper())
+                                                 for file_format in USER_IMPORT_FORMATS])
+
+
 class PasswordChange(FlaskForm):
     password = PasswordField(u'New Password', [DataRequired()])
     password_confirm = PasswordField(u'Repeat New Password',
@@ -87,19 +102,11 @@ class PasswordChangeUser(PasswordChange):
     oldpassword = PasswordField(u'Current password', [DataRequired()])
 
 
-class GifNotAllowed(Exception):
-    pass
-
-
 def init(app):
     @app.route('/users/+add/<base>', methods=['GET', 'POST'])
     @ldap_auth(Settings.ADMIN_GROUP)
     def user_add(base):
         title = "Add User"
-        users = ldap_get_all_users()
-        user_list = []
-        for user in users:
-            user_list.append(user['sAMAccountName'])
         form = UserAdd(request.form)
         field_mapping = [('givenName', form.first_name),
                          ('sn', form.last_name),
@@ -125,74 +132,38 @@ def init(app):
             (key, value[0]) for key, value in LDAP_AD_USERACCOUNTCONTROL_VALUES.items()]
         if form.validate_on_submit():
             try:
-                # Default attributes
-                upn = "%s@%s" % (form.user_name.data, g.ldap['domain'])
-                attributes = {'objectClass': [b'top', b'ieee802Device', b'person', b'organizationalPerson', b'user', b'inetOrgPerson'],
-                              'UserPrincipalName': [upn.encode('utf-8')],
-                              'accountExpires': [b"0"],
-                              'lockoutTime': [b"0"],
-                              }
-
+                values = {}
                 for attribute, field in field_mapping:
                     if attribute == 'userAccountControl':
                         current_uac = 512
                         for key, flag in (LDAP_AD_USERACCOUNTCONTROL_VALUES.items()):
                             if flag[1] and key in field.data:
                                 current_uac += key
-                        attributes[attribute] = [
-                            str(current_uac).encode('utf-8')]
+                        values[attribute] = current_uac
                     elif attribute == 'otherMailbox' or attribute == 'otherHomePhone' or \
                             attribute == 'otherMobile' or attribute == 'otherTelephone':
-                        list_to_encode = list(
+                        values[attribute] = list(
                             filter(None, request.form.getlist(attribute)))
-                        if len(list_to_encode) > 0:
-                            attributes[attribute] = get_encoded_list(
-                                list_to_encode)
                     elif attribute == 'macAddress':
                         list_to_encode = list(
                             filter(None, request.form.getlist(attribute)))
                         if len(list_to_encode):
-                            valid_macs = get_valid_macs(
+                            values[attribute] = get_valid_macs(
                                 list_to_encode)['valid']
-                            attributes[attribute] = get_encoded_list(
-                                valid_macs)
                     elif attribute == 'manager' and field.data:
-                        manager = ldap_get_user(field.data)
+                        manager = ldap_get_user(field.data, attrlist='exists')
                         if manager:
-                            attributes[attribute] = manager['distinguishedName'].encode(
-                                'utf-8')
+                            values[attribute] = manager['distinguishedName']
                         else:
                             raise Exception("That manager doesn't exists")
                     elif attribute == 'jpegPhoto' and request.files is not None:
-                        data = request.files
-                        data_dict = data.to_dict(flat=False)
-                        file = data_dict['profile_photo'][0]
-                        if(file.filename):
-                            image = Image.open(file)
-                            if(image.format == 'GIF'):
-                                raise GifNotAllowed(
-                                    'No gifs allowed in user profile picture')
-                            jpeg_binary = BytesIO()
-                            rgb_image = image.convert('RGB')
-                            rgb_image.save(jpeg_binary, format='JPEG')
-                            attributes[attribute] = jpeg_binary.getvalue()
+                        file = request.files.get('profile_photo')
+                        if file and file.filename:
+                            values[attribute] = process_photo(
+                                read_upload(file))
                     elif attribute and field.data:
-                        if isinstance(field, BooleanField):
-                            if field.data:
-                                attributes[attribute] = 'TRUE'.encode('utf-8')
-                            else:
-                                attributes[attribute] = 'FALSE'.encode('utf-8')
-                        else:
-                            attributes[attribute] = [
-                                field.data.encode('utf-8')]
-                if 'sn' in attributes:
-                    attributes['displayName'] = attributes['givenName'][0].decode('utf-8') + " " + attributes[
-                        'sn'][0].decode('utf-8')
-                    attributes['displayName'] = [
-                        attributes['displayName'].encode('utf-8')]
-                else:
-                    attributes['sn'] = ''
-                    attributes['displayName'] = attributes['givenName']
+                        values[attribute] = field.data
+                attributes = user_attributes(values, g.ldap['domain'])
                 password_validation = password_is_valid(form.password.data)
                 if not password_validation:
                     ldap_create_entry("cn=%s,%s" %
@@ -200,7 +171,6 @@ def init(app):
                     ldap_change_password(
                         None, form.password.data, form.user_name.data)
                     flash(u"User created successfully.", "success")
-                    created_user = ldap_get_user(username=form.user_name.data)
                     return redirect(url_for('user_overview', username=form.user_name.data))
                 else:
                     flash_password_errors(password_validation)
@@ -208,7 +178,7 @@ def init(app):
                 e = dict(e.args[0])
                 flash(e['info'], "error")
                 logging.exception("Got an exception")
-            except GifNotAllowed as e:
+            except InvalidPhoto as e:
                 flash(e, 'error')
                 logging.exception("Got an exception")
             except Exception as e:
@@ -218,9 +188,56 @@ def init(app):
             flash("Some fields failed validation.", "error")
 
         return render_template("forms/user_add.html", form=form, title=title,
-                               action="Add User", user_list=user_list,
+                               action="Add User",
                                parent=url_for('tree_base'))
 
+    @app.route('/users/+import/<base>', methods=['GET', 'POST'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def user_import(base):
+        title = "Import Users"
+        form = UserImport(request.form)
+        form.visible_fields = [form.users_file, form.file_format]
+        if form.validate_on_submit():
+            file = request.files.get('users_file')
+            if file and file.filename:
+                # Kept aside for the job, readable by this user only as it
+                # holds passwords, the job deletes it when done
+                fd, path = tempfile.mkstemp(prefix="adwebmanager-import-")
+                try:
+                    with os.fdopen(fd, 'wb') as temp:
+                        file.save(temp)
+                    with open(path, 'rb') as stream:
+                        total = count_rows(stream, form.file_format.data)
+                    job_id = submit_ldap_job("Import %d users into %s" % (total, namefrom_dn(base)),
+                                             total, import_users_job, path,
+                                             form.file_format.data, base)
+                except UnicodeDecodeError:
+                    os.unlink(path)
+                    flash("The file must be UTF-8 encoded.", "error")
+                except Exception:
+                    os.unlink(path)
+                    raise
+                else:
+                    return redirect(url_for('job_overview', job_id=job_id,
+                                            parent=url_for('tree_base', base=base)))
+            else:
+                flash("Choose a file to import.", "error")
+        elif form.errors:
+            flash("Some fields failed validation.", "error")
+
+        return render_template("forms/basicform.html", form=form, title=title,
+                               action="Import",
+                               parent=url_for('tree_base', base=base))
+
+    @app.route('/api/users/suggest', methods=['GET'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def user_suggest():
+        prefix = request.args.get('q', '').strip()
+        limit = min(request.args.get('limit', 10, type=int), 50)
+        if not prefix or limit < 1:
+            return jsonify([])
+        return jsonify(ldap_suggest_users(prefix, limit))
+
     @app.route('/user/<username>', methods=['GET', 'POST'])
     @ldap_auth("Domain Users")
     def user_overview(username):
@@ -230,7 +247,7 @@ def init(app):
             flash(f"The user: {username}, doesn't exists (err404)", "error")
             return redirect(url_for('tree_base'))
 
-        user = ldap_get_user(username=username)
+        user = ldap_get_user(username=username, attrlist='user_overview')
         admin = ldap_in_group(Settings.ADMIN_GROUP)
         logged_user = g.ldap['username']
         if logged_user == user['sAMAccountName'] or admin:
@@ -247,11 +264,6 @@ def init(app):
             if 'telephoneNumber' in user:
                 identity_fields.append(('telephoneNumber', "Telephone"))
 
-            if 'jpegPhoto' in user:
-                imgbase64 = base64.b64encode(user['jpegPhoto']).decode()
-                user['jpegPhoto'] = 'data:image/jpeg;base64,' + imgbase64
-                identity_fields.append(('Profile Photo', 'jpegPhoto'))
-
             group_fields = [('sAMAccountName', "Name"),
                             ('description', u"Description")]
 
@@ -259,45 +271,26 @@ def init(app):
             group_membership = ldap_get_membership(username)
             for group in group_membership:
                 group_details.append(ldap_get_group(
-                    group, 'distinguishedName'))
+                    group, 'distinguishedName', 'tree'))
 
             group_details = list(filter(None, group_details))
 
             groups = sorted(
                 group_details, key=lambda entry: entry['sAMAccountName'])
 
-            available_groups = ldap_get_entries(
-                ldap_filter="(objectclass=group)", scope="subtree")
-            group_choices = [("_", "Select a Group")]
-
-            for group_entry in available_groups:
-                if not group_entry['distinguishedName'] in group_membership:
-                    # if not ldap_in_group(group_entry['sAMAccountName'], username):
-                    group_choices += [(group_entry['distinguishedName'],
-                                       group_entry['sAMAccountName'])]
-
+            # The groups to add the user to are searched by user_group_suggest
             form = UserAddGroup(request.form)
-            form.available_groups.choices = group_choices
-
-            if not form.is_submitted():
-                form.available_groups.data = "_"
 
             if form.validate_on_submit():
                 try:
-                    group_to_add = form.available_groups.data
-                    if group_to_add == "_":
+                    group_to_add = form.group_dn.data
+                    if not group_to_add:
                         flash(
-                            u"You must choose a group from the drop-down list.", "error")
+                            u"You must choose a group from the list.", "error")
                     else:
-                        group = ldap_get_entry_simple(
-                            {'objectClass': 'group', 'distinguishedName': group_to_add})
-                        if 'member' in group:
-                            entries = set(group['member'])
-                        else:
-                            entries = set()
-                        entries.add(user['distinguishedName'])
-                        ldap_update_attribute(
-                            group_to_add, "member", list(entries))
+                        ldap_add_group_members(
+                            group_to_add, [user['distinguishedName']])
+                        ldap_forget_authorizations([user])
                         flash(u"User successfully added to group.", "success")
                     return redirect(url_for('user_overview', username=username))
                 except ldap.LDAPError as e:
@@ -314,7 +307,55 @@ def init(app):
         return render_template("pages/user_overview_es.html", g=g, title=title, form=form,
                                user=user, identity_fields=identity_fields,
                                group_fields=group_fields, admin=admin, groups=groups,
-                               parent=parent, uac_values=LDAP_AD_USERACCOUNTCONTROL_VALUES, name=name)
+                               parent=parent, uac_values=LDAP_AD_USERACCOUNTCONTROL_VALUES, name=name,
+                               group_search_min_prefix=LDAP_GROUP_SEARCH_MIN_PREFIX)
+
+    @app.route('/api/users/<username>/groups/suggest', methods=['GET'])
+    @ldap_auth(Settings.ADMIN_GROUP)
+    def user_group_suggest(username):
+        user = ldap_get_entry_simple({'sAMAccountName': username}, 'membership')
+        if not user:
+            abort(404)
+
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        groups, after = ldap_search_groups(request.args.get('q', '').strip(),
+                                           exclude=user,
+                                           after=request.args.get('after'),
+                                           limit=limit)
+        return jsonify({'groups': [{'name': name, 'dn': dn}
+                                   for name, dn in groups],
+                        'after': after})
+
+    @app.route('/user/<username>/photo', methods=['GET'])
+    @ldap_auth("Domain Users")
+    def user_photo(username):
+        if g.ldap['username'].lower() != username.lower() and \
+                not ldap_in_group(Settings.ADMIN_GROUP):
+            abort(401)
+
+        user = ldap_get_user(username=username,
+                             attrlist=['objectGUID', 'whenChanged'])
+        if not user:
+            abort(404)
+
+        size = photo_size(request.args.get('size', type=int))
+        etag = photo_etag(user['objectGUID'], user.get('whenChanged'), size)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            # Only read when sent, and kept out of the entry cache
+            photos = ldap_get_entries("objectClass=*",
+                                      base=user['distinguishedName'],
+                                      scope="base", attrlist=['jpegPhoto'],
+                                      expand_primary_group=False, cache=False)
+            if not photos or 'jpegPhoto' not in photos[0]:
+                abort(404)
+            response = Response(photo_thumbnail(photos[0]['jpegPhoto'], size),
+                                mimetype='image/jpeg')
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = PHOTO_MAX_AGE
+        return response
 
     @app.route('/user/<username>/+changepw', methods=['GET', 'POST'])
     @ldap_auth("Domain Users")
@@ -372,7 +413,7 @@ def init(app):
 
         if form.validate_on_submit():
             try:
-                user = ldap_get_user(username=username)
+                user = ldap_get_user(username=username, attrlist='exists')
                 ldap_delete_entry(user['distinguishedName'])
                 flash(u"User deleted successfully.", "success")
                 return redirect(url_for('core_index'))
@@ -398,10 +439,6 @@ def init(app):
 
         user = ldap_get_user(username=username)
         attr_compilation = get_attr(user)
-        users = ldap_get_all_users()
-        user_list = []
-        for data in users:
-            user_list.append(data['sAMAccountName'])
         form = UserProfileEdit(request.form)
         field_mapping = [('givenName', form.first_name),
                          ('jpegPhoto', form.profile_pic),
@@ -425,91 +462,52 @@ def init(app):
         form.visible_fields = [field[1] for field in field_mapping]
         if form.validate_on_submit():
             try:
+                changes = {}
+                new_rdn = None
                 for attribute, field in field_mapping:
-                    has_attribute = user.get(attribute) != None
-                    if attribute != 'jpegPhoto':
-                        value = field.data
-                    else:
-                        value = request.files
-                    given_name = user.get('givenName')
-                    last_name = user.get('sn')
-                    if value != user.get(attribute) or not has_attribute:
-                        if attribute == 'sAMAccountName':
+                    value = field.data
+                    if attribute == 'sAMAccountName':
+                        if value != user.get(attribute):
                             # Rename the account
-                            ldap_update_attribute(
-                                user['distinguishedName'], "sAMAccountName", value)
-                            ldap_update_attribute(user['distinguishedName'], "userPrincipalName",
-                                                  "%s@%s" % (value, g.ldap['domain']))
+                            changes[attribute] = value
+                            changes['userPrincipalName'] = "%s@%s" % (
+                                value, g.ldap['domain'])
                             # Finish by renaming the whole record
-                            # TODO: refactor this to use rename_s instead of update
-                            rdn = f'CN={value}'
-                            ldap_update_attribute(
-                                user['distinguishedName'], "distinguishedName", rdn)
-                            user = ldap_get_user(value)
-                        elif attribute == 'userAccountControl':
-                            current_uac = 512
-                            for key, flag in (LDAP_AD_USERACCOUNTCONTROL_VALUES.items()):
-                                if flag[1] and key in field.data:
-                                    current_uac += key
-                            ldap_update_attribute(
-                                user['distinguishedName'], attribute, str(current_uac))
-                        elif attribute == 'givenName':
-                            given_name = value
-                            ldap_update_attribute(
-                                user['distinguishedName'], attribute, value)
-                            displayName = given_name + ' ' + last_name
-                            ldap_update_attribute(
-                                user['distinguishedName'], 'displayName', displayName)
-                        elif attribute == 'sn':
-                            last_name = value
-                            ldap_update_attribute(
-                                user['distinguishedName'], attribute, value)
-                            displayName = given_name + ' ' + last_name
-                            ldap_update_attribute(
-                                user['distinguishedName'], 'displayName', displayName)
-                        elif attribute == 'otherMailbox' or attribute == 'otherHomePhone' or \
-                                attribute == 'otherMobile' or attribute == 'otherTelephone':
-                            given_list = list(
-                                filter(None, request.form.getlist(attribute)))
-                            if len(given_list):
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute, given_list)
-                            else:
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute)
-                        elif attribute == 'macAddress':
-                            given_list = list(
-                                filter(None, request.form.getlist(attribute)))
-                            valid_macs = get_valid_macs(given_list)['valid']
-                            if len(valid_macs):
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute, valid_macs)
-                            else:
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute)
-                        elif attribute == 'manager' and value:
-                            manager = ldap_get_user(value)
-                            if manager:
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute, manager['distinguishedName'])
-                            else:
-                                raise Exception("That manager doesn't exists")
-                        elif attribute == 'jpegPhoto':
-                            data_dict = value.to_dict(flat=False)
-                            file = data_dict['profile_photo'][0]
-                            if(file.filename):
-                                image = Image.open(file)
-                                if(image.format == 'GIF'):
-                                    raise GifNotAllowed(
-                                        'No gifs allowed in user profile picture')
-                                jpeg_binary = BytesIO()
-                                rgb_image = image.convert('RGB')
-                                rgb_image.save(jpeg_binary, format='JPEG')
-                                ldap_update_attribute(
-                                    user['distinguishedName'], attribute, jpeg_binary.getvalue())
+                            new_rdn = f'CN={value}'
+                    elif attribute == 'userAccountControl':
+                        current_uac = 512
+                        for key, flag in (LDAP_AD_USERACCOUNTCONTROL_VALUES.items()):
+                            if flag[1] and key in field.data:
+                                current_uac += key
+                        changes[attribute] = current_uac
+                    elif attribute == 'otherMailbox' or attribute == 'otherHomePhone' or \
+                            attribute == 'otherMobile' or attribute == 'otherTelephone':
+                        changes[attribute] = list(
+                            filter(None, request.form.getlist(attribute)))
+                    elif attribute == 'macAddress':
+                        given_list = list(
+                            filter(None, request.form.getlist(attribute)))
+                        changes[attribute] = get_valid_macs(given_list)['valid']
+                    elif attribute == 'manager' and value:
+                        manager = ldap_get_user(value, attrlist='exists')
+                        if manager:
+                            changes[attribute] = manager['distinguishedName']
                         else:
-                            ldap_update_attribute(
-                                user['distinguishedName'], attribute, value)
+                            raise Exception("That manager doesn't exists")
+                    elif attribute == 'jpegPhoto':
+                        file = request.files.get('profile_photo')
+                        if file and file.filename:
+                            changes[attribute] = process_photo(
+                                read_upload(file))
+                    else:
+                        changes[attribute] = value
+
+                if changes['givenName'] != user.get('givenName') or \
+                        changes['sn'] != user.get('sn'):
+                    changes['displayName'] = changes['givenName'] + ' ' + \
+                        changes['sn']
+
+                ldap_apply_changes(user, changes, new_rdn)
                 flash(u"Profile updated successfully.", "success")
                 return redirect(url_for('user_overview', username=form.user_name.data))
 
@@ -517,7 +515,7 @@ def init(app):
                 e = dict(e.args[0])
                 flash(e['info'], "error")
                 logging.exception("Got an exception")
-            except GifNotAllowed as e:
+            except InvalidPhoto as e:
                 flash(e, 'error')
                 logging.exception("Got an exception")
             except Exception as e:
@@ -533,7 +531,8 @@ def init(app):
             form.mail.data = user.get('mail')
             if 'manager' in user.keys():
                 managerDN = user.get('manager')
-                manager = ldap_get_user(managerDN, key="distinguishedName")
+                manager = ldap_get_user(managerDN, key="distinguishedName",
+                                        attrlist='exists')
                 form.manager.data = manager['sAMAccountName']
             if 'streetAddress' in user.keys():
                 form.address.data = user.get('streetAddress')
@@ -546,14 +545,16 @@ def init(app):
                                    LDAP_AD_USERACCOUNTCONTROL_VALUES.items()
                                    if (flag[1] and
                                        user['userAccountControl'] & key)]
-        return render_template("forms/user_edit.html", form=form, title=title, user_list=user_list,
+        return render_template("forms/user_edit.html", form=form, title=title,
                                action="Save changes", username=username,
                                othermails=attr_compilation['otherMailbox'],
                                mac_address=attr_compilation['macAddress'],
                                phones_home=attr_compilation['otherHomePhone'],
                                phones_mobile=attr_compilation['otherMobile'],
                                phones_office=attr_compilation['otherTelephone'],
-                               profile_pic=attr_compilation['jpegPhoto'],
+                               profile_pic=url_for('user_photo', username=username,
+                                                   v=user.get('whenChanged'))
+                               if 'jpegPhoto' in user else None,
                                parent=url_for('user_overview',
                                               username=username))
 
@@ -0,0 +1,91 @@
+/*Searches the groups a user can be added to as the admin types, the chosen
+group's DN is what the form submits*/
+(function () {
+    const groupFieldDiv = document.getElementById("group-field-div");
+    const groupField = document.getElementById("group-field");
+    const groupDn = document.getElementById("group-dn");
+    const suggestUrl = groupFieldDiv.dataset.suggestUrl;
+    /*shorter names would match most of the groups of the domain*/
+    const minLength = parseInt(groupFieldDiv.dataset.minLength, 10) || 2;
+    let timer;
+    let lastQuery;
+
+    groupField.addEventListener("input", function (e) {
+        const val = this.value;
+        /*typing again discards the group chosen before*/
+        groupDn.value = "";
+        clearTimeout(timer);
+        closeList();
+        if (val.length < minLength) {
+            lastQuery = null;
+            return;
+        }
+        timer = setTimeout(function () { suggest(val, null, null); }, 250);
+    });
+
+    groupField.addEventListener("focus", function (e) {
+        if (this.value.length >= minLength &&
+                !document.getElementById("group-fieldautocomplete-list")) {
+            suggest(this.value, null, null);
+        }
+    });
+
+    function suggest(val, after, list) {
+        lastQuery = val;
+        let url = suggestUrl + "?q=" + encodeURIComponent(val);
+        if (after) {
+            url += "&after=" + encodeURIComponent(after);
+        }
+        fetch(url, { credentials: "same-origin" })
+            .then(function (response) { return response.ok ? response.json() : { groups: [] }; })
+            .then(function (data) {
+                /*an answer to an older query*/
+                if (val !== lastQuery || val !== groupField.value) { return; }
+                showList(val, data, list);
+            });
+    }
+
+    function showList(val, data, list) {
+        if (!list) {
+            closeList();
+            list = document.createElement("DIV");
+            list.setAttribute("id", "group-fieldautocomplete-list");
+            list.setAttribute("class", "autocomplete-items");
+            groupFieldDiv.appendChild(list);
+        }
+        data.groups.forEach(function (group) {
+            const item = document.createElement("DIV");
+            item.textContent = group.name;
+            item.addEventListener("click", function (e) {
+                groupField.value = group.name;
+                groupDn.value = group.dn;
+                closeList();
+            });
+            list.appendChild(item);
+        });
+        if (data.after) {
+            /*the next page is only asked for when wanted*/
+            const more = document.createElement("DIV");
+            more.textContent = "More...";
+            more.addEventListener("click", function (e) {
+                e.stopPropagation();
+                more.remove();
+                suggest(val, data.after, list);
+            });
+            list.appendChild(more);
+        }
+    }
+
+    function closeList() {
+        const list = document.getElementById("group-fieldautocomplete-list");
+        if (list) {
+            list.remove();
+        }
+    }
+
+    document.addEventListener("click", function (e) {
+        if (e.target !== groupField) {
+            closeList();
+        }
+    });
+})();
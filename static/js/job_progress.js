@@ -0,0 +1,37 @@
+// Polls the status of a background job and appends the results of its items
+$(document).ready(function () {
+    const job = $("#job")
+    if (job.data("running") !== true) {
+        return
+    }
+    let offset = $("#job-items li").length
+
+    const poll = function () {
+        $.getJSON(job.data("status-url"), { offset: offset }, function (data) {
+            const count = data.done + data.failed
+            $("#job-progress").val(count)
+            $("#job-count").text(count + " / " + data.total)
+            $("#job-status").text(data.status)
+            $("#job-done").text(data.done)
+            $("#job-failed").text(data.failed)
+            $("#job-error").text(data.error || "")
+            data.items.forEach(function (item) {
+                const li = $("<li>")
+                if (item.error) {
+                    li.addClass("flash-messages error").text(item.name + ": " + item.error)
+                } else {
+                    li.text(item.name)
+                }
+                $("#job-items").append(li)
+            })
+            offset += data.items.length
+
+            if (data.status === "queued" || data.status === "running") {
+                setTimeout(poll, 1000)
+            } else {
+                $("#job-cancel").remove()
+            }
+        })
+    }
+    setTimeout(poll, 1000)
+})
@@ -1,43 +1,59 @@
-function autocomplete(inp, arr) {
+function autocomplete(inp, suggestUrl) {
     /*the autocomplete function takes two arguments,
-    the text field element and an array of possible autocompleted values:*/
+    the text field element and the url suggesting values for what was typed:*/
     let currentFocus;
-    /*execute a function when someone writes in the text field:*/
+    let timer;
+    let lastQuery;
+    /*ask for suggestions once the user stops typing for a moment:*/
     inp.addEventListener("input", function (e) {
-        let a, b, i, val = this.value;
+        const val = this.value;
+        clearTimeout(timer);
         /*close any already open lists of autocompleted values*/
         closeAllLists();
         if (!val) { return false; }
+        timer = setTimeout(function () { suggest(val); }, 250);
+    });
+    function suggest(val) {
+        lastQuery = val;
+        fetch(suggestUrl + "?q=" + encodeURIComponent(val), { credentials: "same-origin" })
+            .then(function (response) { return response.ok ? response.json() : []; })
+            .then(function (arr) {
+                /*an answer to an older query or the field changed meanwhile*/
+                if (val !== lastQuery || val !== inp.value) { return; }
+                showList(val, arr);
+            });
+    }
+    function showList(val, arr) {
+        let a, b, i;
+        closeAllLists();
         currentFocus = -1;
         /*create a DIV element that will contain the items (values):*/
         a = document.createElement("DIV");
-        a.setAttribute("id", this.id + "autocomplete-list");
+        a.setAttribute("id", inp.id + "autocomplete-list");
         a.setAttribute("class", "autocomplete-items");
         /*append the DIV element as a child of the autocomplete container:*/
-        this.parentNode.appendChild(a);
-        /*for each item in the array...*/
+        inp.parentNode.appendChild(a);
+        /*for each suggested item...*/
         for (i = 0; i < arr.length; i++) {
-            /*check if the item starts with the same letters as the text field value:*/
-            if (arr[i].substr(0, val.length).toUpperCase() == val.toUpperCase()) {
-                /*create a DIV element for each matching element:*/
-                b = document.createElement("DIV");
-                /*make the matching letters bold:*/
-                b.innerHTML = "<strong>" + arr[i].substr(0, val.length) + "</strong>";
-                b.innerHTML += arr[i].substr(val.length);
-                /*insert a input field that will hold the current array item's value:*/
-                b.innerHTML += "<input type='hidden' value='" + arr[i] + "'>";
-                /*execute a function when someone clicks on the item value (DIV element):*/
-                b.addEventListener("click", function (e) {
-                    /*insert the value for the autocomplete text field:*/
-                    inp.value = this.getElementsByTagName("input")[0].value;
-                    /*close the list of autocompleted values,
-                    (or any other open lists of autocompleted values:*/
-                    closeAllLists();
-                });
-                a.appendChild(b);
-            }
+            const value = arr[i];
+            /*create a DIV element for each matching element:*/
+            b = document.createElement("DIV");
+            /*make the matching letters bold:*/
+            const strong = document.createElement("STRONG");
+            strong.textContent = value.substr(0, val.length);
+            b.appendChild(strong);
+            b.appendChild(document.createTextNode(value.substr(val.length)));
+            /*execute a function when someone clicks on the item value (DIV element):*/
+            b.addEventListener("click", function (e) {
+                /*insert the value for the autocomplete text field:*/
+                inp.value = value;
+                /*close the list of autocompleted values,
+                (or any other open lists of autocompleted values:*/
+                closeAllLists();
+            });
+            a.appendChild(b);
         }
-    });
+    }
     /*execute a function presses a key on the keyboard:*/
     inp.addEventListener("keydown", function (e) {
         let x = document.getElementById(this.id + "autocomplete-list");
@@ -95,8 +111,6 @@ function autocomplete(inp, arr) {
     });
 }
 
-/*An array containing all the names:*/
 const managerFieldDiv = document.getElementById("manager-field-div");
 const managerField = document.getElementById("manager-field");
-const userlist = managerFieldDiv.dataset.userlist.replaceAll("[","").replaceAll("]","").replaceAll("'","").replaceAll(" ","").split(",");
-autocomplete(managerField, userlist);
\ No newline at end of file
+autocomplete(managerField, managerFieldDiv.dataset.suggestUrl);
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+from libs.ldap_cache import LDAPEntryCache
+
+ENTRY = {'objectGUID': 'guid-1', 'objectClass': ['top', 'user'],
+         'distinguishedName': 'CN=John Doe,OU=Staff,DC=example,DC=com',
+         'sAMAccountName': 'JDoe', 'mail': 'jdoe@example.com'}
+
+
+def test_find_samaccountname_ignores_case():
+    cache = LDAPEntryCache()
+    cache.put('admin', ENTRY)
+
+    for username in ('JDoe', 'jdoe', 'JDOE'):
+        entry = cache.find('admin', {'objectClass': 'user',
+                                     'sAMAccountName': username})
+        assert entry['sAMAccountName'] == 'JDoe'
+    assert cache.find('admin', {'sAMAccountName': 'jdoe2'}) is None
+    assert cache.find('other', {'sAMAccountName': 'jdoe'}) is None
+
+
+def test_find_distinguishedname_ignores_case():
+    cache = LDAPEntryCache()
+    cache.put('admin', ENTRY)
+
+    entry = cache.find('admin', {'distinguishedName': ENTRY[
+        'distinguishedName'].lower()})
+    assert entry['objectGUID'] == 'guid-1'
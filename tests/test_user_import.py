@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can find the license on Debian systems in the file
+# /usr/share/common-licenses/GPL-2
+
+import io
+
+import pytest
+
+pytest.importorskip('ldif')
+
+from libs.user_import import count_rows, read_rows  # noqa: E402
+
+CSV = (u"sAMAccountName,givenName,title,otherMobile,password\r\n"
+       u"jdoe, John ,\"Head; Sales\", 555-1; 555-2 ,\" P@ss;word1 \"\r\n"
+       u"\r\n"
+       u"asmith,Anna,,,Secret;42\r\n")
+
+
+def test_csv_only_splits_multivalued_columns():
+    rows = list(read_rows(io.BytesIO(CSV.encode('utf-8')), 'csv'))
+
+    assert [row.get('error') for row in rows] == [None, None]
+    assert rows[0]['values']['givenName'] == 'John'
+    assert rows[0]['values']['title'] == 'Head; Sales'
+    assert rows[0]['values']['otherMobile'] == ['555-1', '555-2']
+    assert rows[0]['password'] == ' P@ss;word1 '
+    assert rows[1]['values']['title'] is None
+    assert rows[1]['password'] == 'Secret;42'
+
+
+def test_csv_count_matches_rows():
+    assert count_rows(io.BytesIO(CSV.encode('utf-8')), 'csv') == 2